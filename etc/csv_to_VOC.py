@@ -1,11 +1,15 @@
 import os
 import csv
-from xml.dom import minidom
-import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
 
 '''
 Script created by Daniel Oliveira
 it reads a csv file and creates a PASCAL VOC format dataset file
+
+The rows are grouped by image and each image gets a single xml file with
+all its objects, built from a text template and written by a thread pool.
 '''
 
 def read_csv(csv_file):
@@ -30,62 +34,83 @@ def read_csv(csv_file):
             height.append(row['height'])
     return image,xmin,xmax,ymin,ymax,label,width,height
 
-def convert_to_vocxml(image,xmin,xmax,ymin,ymax,label,width,height):
-    #Cria os labels utilizados no XML do VOC
-    annotation = ET.Element('annotation')
-    folder = ET.SubElement(annotation,'folder')
-    filename = ET.SubElement(annotation,'filename')
-    path = ET.SubElement(annotation,'path')
-    source = ET.SubElement(annotation,'source')
-    size = ET.SubElement(annotation,'size')
-    segmented = ET.SubElement(annotation,'segmented')
-    object = ET.SubElement(annotation,'object')
-
-    database = ET.SubElement(source,'database')
-    width_xml = ET.SubElement(size,"width")
-    height_xml = ET.SubElement(size,"height")
-    depth = ET.SubElement(size,"depth")
-
-    nome = ET.SubElement(object,'name')
-    pose = ET.SubElement(object,'pose')
-    truncated = ET.SubElement(object,'truncated')
-    difficult = ET.SubElement(object,'difficult')
-    bndbox = ET.SubElement(object,'bndbox')
-
-    xmin_xml = ET.SubElement(bndbox,'xmin')
-    ymin_xml = ET.SubElement(bndbox,'ymin')
-    xmax_xml = ET.SubElement(bndbox,'xmax')
-    ymax_xml = ET.SubElement(bndbox,'ymax')
-
-    #Coloca os valores do csv no XML
-    size = len(image)
-    for i in range(size):
-        folder.text = label[i]
-        filename.text = image[i]
-        path.text ='/your/path/' + image[i]
-        database.text = 'Unknown'
-        width_xml.text = width[i]
-        height_xml.text = height[i]
-        depth.text = '3'
-        segmented.text = '0'
-        nome.text = label[i]
-        pose.text = "Unspecified"
-        truncated.text = '0'
-        difficult.text = '0'
-        xmax_xml.text = xmax[i]
-        ymax_xml.text = ymax[i]
-        xmin_xml.text = xmin[i]
-        ymin_xml.text = ymin[i]
+ANNOTATION_TEMPLATE = """<?xml version="1.0" ?>
+<annotation>
+   <folder>{folder}</folder>
+   <filename>{filename}</filename>
+   <path>{path}</path>
+   <source>
+      <database>Unknown</database>
+   </source>
+   <size>
+      <width>{width}</width>
+      <height>{height}</height>
+      <depth>3</depth>
+   </size>
+   <segmented>0</segmented>
+{objects}</annotation>
+"""
+
+OBJECT_TEMPLATE = """   <object>
+      <name>{name}</name>
+      <pose>Unspecified</pose>
+      <truncated>0</truncated>
+      <difficult>0</difficult>
+      <bndbox>
+         <xmin>{xmin}</xmin>
+         <ymin>{ymin}</ymin>
+         <xmax>{xmax}</xmax>
+         <ymax>{ymax}</ymax>
+      </bndbox>
+   </object>
+"""
+
+def xml_text(text):
+    return escape(text, {'"': '&quot;'})
+
+def group_by_image(image,xmin,xmax,ymin,ymax,label,width,height):
+    """Groups the csv rows by image, keeping the order of the first appearance of each image."""
+    images = OrderedDict()
+    for i in range(len(image)):
+        if image[i] not in images:
+            images[image[i]] = {'width': width[i], 'height': height[i], 'objects': []}
+        images[image[i]]['objects'].append((label[i], xmin[i], ymin[i], xmax[i], ymax[i]))
+    return images
+
+def annotation_xml(image_name, width, height, objects):
+    """Builds the PASCAL VOC xml of an image with all its objects."""
+    objects_xml = ''.join(OBJECT_TEMPLATE.format(name=xml_text(name), xmin=xml_text(xmin), ymin=xml_text(ymin),
+                                                 xmax=xml_text(xmax), ymax=xml_text(ymax))
+                          for name, xmin, ymin, xmax, ymax in objects)
+    return ANNOTATION_TEMPLATE.format(folder=xml_text(objects[0][0]), filename=xml_text(image_name),
+                                      path=xml_text('/your/path/' + image_name), width=xml_text(width),
+                                      height=xml_text(height), objects=objects_xml)
 
+def write_annotation(path_file, xmlstr):
+    with open(path_file, "w") as f:
+        f.write(xmlstr)
+
+def convert_to_vocxml(image,xmin,xmax,ymin,ymax,label,width,height,num_threads=16):
+    """
+    Writes one xml file per image, with all its objects. The file is saved in the
+    folder named after the label of the first object of the image.
+    """
+    images = group_by_image(image,xmin,xmax,ymin,ymax,label,width,height)
+
+    paths, xmls = [], []
+    for image_name, annotation in images.items():
         #Cria as pastas e o arquivo XML
-        folder_xml = label[i] + '/'
-        file = image[i].replace('.jpg','')
-        path_file = folder_xml + file + ".xml"
-        if not os.path.exists(folder_xml):
+        folder_xml = annotation['objects'][0][0] + '/'
+        file = image_name.replace('.jpg','')
+        paths.append(folder_xml + file + ".xml")
+        xmls.append(annotation_xml(image_name, annotation['width'], annotation['height'], annotation['objects']))
+
+    for folder_xml in set(os.path.dirname(path_file) for path_file in paths):
+        if folder_xml and not os.path.exists(folder_xml):
             os.makedirs(folder_xml)
-        xmlstr = minidom.parseString(ET.tostring(annotation)).toprettyxml(indent="   ")
-        with open(path_file, "w") as f:
-            f.write(xmlstr)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(write_annotation, paths, xmls))
 
 
 def main():
@@ -94,4 +119,5 @@ def main():
     convert_to_vocxml(image,xmin,xmax,ymin,ymax,label,width,height)
 
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,100 @@
+import os
 import cv2
 import glob
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
 '''
 This script generates a new dataset from a video file.
 You can choose the final image resolution in the main function.
+
+Only the sampled frames are decoded: the capture seeks (CAP_PROP_POS_FRAMES) to
+the far away frames and skips the close ones with grab(), which does not
+retrieve the frame. The videos are processed in parallel worker processes and
+the resize and JPEG encoding of the frames run in a thread pool.
+
+Each process saves the frames of its video under temporary names. The images are
+then renamed in the order of the videos, so they are numbered consecutively
+whatever the number of frames actually read.
 '''
 
-def image_extractor(targetSize, target_folder, source_files):
+def sample_frame_indices(frame_count, number_of_photos):
+    '''
+    Indices of the frames extracted from a video: one every frame_count / number_of_photos frames.
+    '''
+    step = max(1, int(frame_count / number_of_photos))
+    # (i+1) to account for the right number of photos
+    return list(range(step - 1, frame_count, step))
+
+def read_frames(cap, frame_indices, max_grab=30):
+    '''
+    Yields (index, frame) for the given increasing frame indices.
+
+    Arguments:
+        cap (cv2.VideoCapture): the opened video
+        frame_indices (list): increasing frame indices
+        max_grab (int, default: 30): frames closer than this are reached with grab(),
+            the others with a seek
+    '''
+    position = 0
+    for index in frame_indices:
+        if index - position > max_grab:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+        else:
+            while position < index:
+                if not cap.grab():
+                    return
+                position += 1
+        ret, frame = cap.read()
+        # if ret = False, video finished
+        if not ret:
+            return
+        position = index + 1
+        yield index, frame
+
+def save_frame(frame, targetSize, path):
+    frame = cv2.resize(frame, targetSize, interpolation = cv2.INTER_AREA)
+    cv2.imwrite(path, frame)
+
+def temporary_frame_path(target_folder, video_number, frame_number):
+    return target_folder + '.video_{:05d}_frame_{:06d}.jpg'.format(video_number, frame_number)
+
+def extract_video_frames(file, frame_indices, targetSize, target_folder, video_number, num_threads=4,
+                         max_pending=None):
+    '''
+    Extracts the given frames of a video and saves them under the temporary names
+    temporary_frame_path(target_folder, video_number, i), i = 0, 1, ...
+
+    Arguments:
+        max_pending (int, default: None): maximum number of decoded frames waiting to be
+            resized and saved. Defaults to 2 * num_threads
+
+    Returns:
+        int: number of frames saved
+    '''
+    print(file)
+    # Opens the Video file
+    cap = cv2.VideoCapture(file)
+    # the capture does not wait for the encoding threads, so the decoded frames are bounded
+    pending = threading.BoundedSemaphore(max_pending or 2 * num_threads)
+    futures = []
+    try:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for i, (index, frame) in enumerate(read_frames(cap, frame_indices)):
+                pending.acquire()
+                future = executor.submit(save_frame, frame, targetSize,
+                                         temporary_frame_path(target_folder, video_number, i))
+                future.add_done_callback(lambda f: pending.release())
+                futures.append(future)
+    finally:
+        cap.release()
+    for future in futures:
+        future.result()
+    return len(futures)
+
+def image_extractor(targetSize, target_folder, source_files, number_of_photos=20, first_number=320,
+                    num_workers=None, num_threads=4):
     '''
     Extract frames from videos and save them into .jpg files in the target folder.
 
@@ -14,56 +102,44 @@ def image_extractor(targetSize, target_folder, source_files):
         targetSize (tuple, default : (1000, 1000)): Target images resolution
         target_folder (str) : absolute folder path
         source_files (list) : list of the video's absolute paths
+        number_of_photos (int, default: 20): number of frames extracted from each video
+        first_number (int, default: 320): number of the first saved image. The images of each
+            video are numbered after the ones of the previous video
+        num_workers (int, default: None): number of video processes. Defaults to the number of CPU cores
+        num_threads (int, default: 4): number of resize/encoding threads of each process
     '''
-    source_files = source_files[16:-1]
-    img_number=320
-    for file in source_files:
-        print(file)
-        # Opens the Video file
+    tasks = []
+    for video_number, file in enumerate(source_files):
         cap = cv2.VideoCapture(file)
-
-        # Number of frames in the video
+        # only used to choose the sampled frames, it can be inaccurate
         frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        frame_indices = sample_frame_indices(frame_count, number_of_photos)
+        tasks.append((file, frame_indices, targetSize, target_folder, video_number, num_threads))
 
-        # Number of steps / photos extracted
-        number_of_photos = 20
-        step = int(frame_count / number_of_photos)
-
-        # print("Number of frames: ", frame_count)
-        # print("Step: ", step)
-        i=0
-        while(cap.isOpened()):
-            # if ret = False, video finished
-            ret, frame = cap.read()
-            
-            # (i+1) to account for the right number of photos
-            if not (i + 1) % step:
-                # a = cv2.waitKey(0) # close window when ESC is pressed
-
-                # if a == 27:
-                    # break               
-
-                if ret == False:
-                    cap.release()
-                    cv2.destroyAllWindows()
-                
-                else:
-                    # cv2.imshow('image', frame)
-                    frame = cv2.resize(frame, targetSize, interpolation = cv2.INTER_AREA)
-                    cv2.imwrite(target_folder + str(img_number)+'.jpg', frame)
-                    print('Position:', int(cap.get(cv2.CAP_PROP_POS_FRAMES)))
-                    img_number+=1
-
-            i+=1
+    img_number = first_number
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        # the videos come back in order: the frames really saved are numbered consecutively
+        for video_number, count in enumerate(pool.starmap(extract_video_frames, tasks, chunksize=1)):
+            for i in range(count):
+                os.replace(temporary_frame_path(target_folder, video_number, i),
+                           target_folder + str(img_number) + '.jpg')
+                img_number += 1
+    finally:
+        pool.close()
+        pool.join()
+    print('Number of images saved: ', img_number - first_number)
 
 def main():
     # Set the targetSize
     target_folder='D:/1. Github/object_detection_for_grasping/images_teste_3/' # do not forget to add '/' at the end
     source_files = glob.glob("D:/1. Github/object_detection_for_grasping/images_teste_3/videos/*.mp4")
     print('Number of files: ', len(source_files))
+    source_files = source_files[16:-1]
 
     targetSize = (800, 800) #  width / height
     image_extractor(targetSize, target_folder, source_files)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
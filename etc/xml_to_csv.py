@@ -1,50 +1,92 @@
-# adapted from: 
+# adapted from:
 # https://gist.github.com/rotemtam/88d9a4efae243fc77ed4a0f9917c8f6c
 
 import os
+import sys
 import glob
+import multiprocessing
 import pandas as pd
 import xml.etree.ElementTree as ET
-import cv2
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..')))
+from utils.image_size import read_image_sizes
+
+'''
+Converts a folder of PASCAL VOC .xml files into a single csv file.
+
+The xml files are parsed by a process pool. The image width and height are
+taken from the <size> tag of each xml file. When it is missing (or zero), they
+are read from the image header, once per image.
+'''
+
+# label names fixed in the csv file
+LABEL_NAMES = {'bar clamp': 'bar_clamp', 'gear box': 'gear_box'}
+
+def parse_xml(xml_file):
+    """
+    Parses a PASCAL VOC .xml file.
+
+    Returns:
+        tuple: the image filename, its (width, height) or None if the <size> tag is missing
+            and the list of (xmin, ymin, xmax, ymax, label) objects
+    """
+    root = ET.parse(xml_file).getroot()
+    filename = root.find('filename').text
+
+    size = None
+    size_tag = root.find('size')
+    if size_tag is not None and size_tag.find('width') is not None and size_tag.find('height') is not None:
+        width, height = int(size_tag.find('width').text), int(size_tag.find('height').text)
+        if width > 0 and height > 0:
+            size = (width, height)
+
+    objects = []
+    for member in root.findall('object'):
+        bbx = member.find('bndbox')
+        label = member.find('name').text
+        objects.append((int(bbx.find('xmin').text),
+                        int(bbx.find('ymin').text),
+                        int(bbx.find('xmax').text),
+                        int(bbx.find('ymax').text),
+                        LABEL_NAMES.get(label, label)))
+    return filename, size, objects
+
+def xml_to_csv(xml_path, images_folder=None, num_workers=None):
+    """
+    Arguments:
+        xml_path (str): folder of the .xml files
+        images_folder (str, default: None): folder of the images, only used for the xml files
+            without the <size> tag. Defaults to the images folder of the project root
+        num_workers (int, default: None): number of processes parsing the xml files.
+            Defaults to the number of CPU cores
+
+    Returns:
+        DataFrame: one row per object
+    """
+    if images_folder is None:
+        images_folder = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'images'))
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    xml_files = glob.glob(xml_path + '/*.xml')
+
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        parsed = pool.map(parse_xml, xml_files, chunksize=max(1, len(xml_files) // (4 * num_workers)))
+    finally:
+        pool.close()
+        pool.join()
+    # the images without objects are not in the csv file
+    parsed = [(filename, size, objects) for filename, size, objects in parsed if objects]
+
+    # read the missing sizes from the image headers
+    missing = [i for i, (_, size, _) in enumerate(parsed) if size is None]
+    sizes = read_image_sizes([os.path.join(images_folder, parsed[i][0]) for i in missing])
+    for i, size in zip(missing, sizes):
+        parsed[i] = (parsed[i][0], tuple(size), parsed[i][2])
 
-def xml_to_csv(xml_path):
     xml_list = []
-    i = 0
-    for xml_file in glob.glob(xml_path + '/*.xml'):
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-
-        for member in root.findall('object'):
-            bbx = member.find('bndbox')
-            xmin = int(bbx.find('xmin').text)
-            ymin = int(bbx.find('ymin').text)
-            xmax = int(bbx.find('xmax').text)
-            ymax = int(bbx.find('ymax').text)
-            label = member.find('name').text
-            
-            if label == 'bar clamp':
-                label = 'bar_clamp'
-            if label == 'gear box':
-                label = 'gear_box'
-
-            filename = root.find('filename').text
-            images_path = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'images', filename))
-            print(images_path)
-            img = cv2.imread(images_path)
-
-            height, width, channels = img.shape # (4032, 3024, 3)
-            print('antes: ', height, width, channels)
-
-            value = (filename,
-                     xmin,
-                     ymin,
-                     xmax,
-                     ymax,
-                     label,
-                     str(height),
-                     str(width)
-                     )   
-            xml_list.append(value)
+    for filename, (width, height), objects in parsed:
+        xml_list.extend((filename, xmin, ymin, xmax, ymax, label, str(height), str(width))
+                        for xmin, ymin, xmax, ymax, label in objects)
 
     column_name = ['image', 'xmin', 'ymin', 'xmax', 'ymax', 'label', 'height', 'width']
     xml_df = pd.DataFrame(xml_list, columns=column_name)
@@ -58,4 +100,4 @@ def main():
     print('Successfully converted xml to csv.')
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
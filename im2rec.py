@@ -28,12 +28,22 @@ import random
 import argparse
 import cv2
 import time
+import json
+import hashlib
+import functools
+import ctypes
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import multiprocessing
 except ImportError:
     multiprocessing = None
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 def list_image(root, recursive, exts):
     """Traverses the root of directory that contains images and
@@ -147,14 +157,15 @@ def read_list(path_in):
                 continue
             yield item
 
-def image_encode(args, i, item, q_out):
-    """Reads, preprocesses, packs the image and put it back in output queue.
+def encode_item(args, item):
+    """Reads, preprocesses and packs the image.
     Parameters
     ----------
     args: object
-    i: int
     item: list
-    q_out: queue
+    Returns
+    -------
+    the packed record or None if the image could not be packed
     """
     fullpath = os.path.join(args.root, item[1])
 
@@ -167,25 +178,21 @@ def image_encode(args, i, item, q_out):
         try:
             with open(fullpath, 'rb') as fin:
                 img = fin.read()
-            s = mx.recordio.pack(header, img)
-            q_out.put((i, s, item))
+            return mx.recordio.pack(header, img)
         except Exception as e:
             traceback.print_exc()
             print('pack_img error:', item[1], e)
-            q_out.put((i, None, item))
-        return
+            return None
 
     try:
         img = cv2.imread(fullpath, args.color)
     except:
         traceback.print_exc()
         print('imread error trying to load file: %s ' % fullpath)
-        q_out.put((i, None, item))
-        return
+        return None
     if img is None:
         print('imread read blank (None) image for file: %s' % fullpath)
-        q_out.put((i, None, item))
-        return
+        return None
     if args.center_crop:
         if img.shape[0] > img.shape[1]:
             margin = (img.shape[0] - img.shape[1]) // 2
@@ -201,13 +208,22 @@ def image_encode(args, i, item, q_out):
         img = cv2.resize(img, newsize)
 
     try:
-        s = mx.recordio.pack_img(header, img, quality=args.quality, img_fmt=args.encoding)
-        q_out.put((i, s, item))
+        return mx.recordio.pack_img(header, img, quality=args.quality, img_fmt=args.encoding)
     except Exception as e:
         traceback.print_exc()
         print('pack_img error on file: %s' % fullpath, e)
-        q_out.put((i, None, item))
-        return
+        return None
+
+def image_encode(args, i, item, q_out):
+    """Reads, preprocesses, packs the image and put it back in output queue.
+    Parameters
+    ----------
+    args: object
+    i: int
+    item: list
+    q_out: queue
+    """
+    q_out.put((i, encode_item(args, item), item))
 
 def read_worker(args, q_in, q_out):
     """Function that will be spawned to fetch the image
@@ -225,26 +241,149 @@ def read_worker(args, q_in, q_out):
         i, item = deq
         image_encode(args, i, item, q_out)
 
-def write_worker(q_out, fname, working_dir):
-    """Function that will be spawned to fetch processed image
-    from the output queue and write to the .rec file.
+class SharedRingBuffer(object):
+    """Shared-memory transport between the read workers and the writer.
+
+    The encoded records are copied into one of num_slots fixed size slots of a
+    shared memory block and only the small (index, length, item) header goes
+    through a queue, so the records are not pickled. The record i always uses
+    the slot i % num_slots and a worker waits until the record i - num_slots
+    was written before filling it (the turn of the slot). So the record the
+    writer needs next can always be stored and the writer never keeps more than
+    num_slots records to restore the order (the reorder window is bounded) and
+    the memory stays flat. Records larger than a slot go through the queue.
+
+    It replaces the output queue: read_worker puts (i, s, item) tuples into it
+    and the writer gets them and calls release(i) after writing the record i.
     Parameters
     ----------
-    q_out: queue
-    fname: string
-    working_dir: string
+    num_slots: int
+        size of the reorder window
+    slot_size: int
+        size of each slot in bytes
+    """
+    def __init__(self, num_slots, slot_size):
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        self._data = multiprocessing.RawArray('B', num_slots * slot_size)
+        # index of the next record allowed in each slot
+        self._turn = multiprocessing.RawArray('q', range(num_slots))
+        self._cond = multiprocessing.Condition()
+        self._ready = multiprocessing.Queue()
+
+    def reset(self):
+        """Restarts the record indices at 0. Only call it when no record is in flight."""
+        with self._cond:
+            for slot in range(self.num_slots):
+                self._turn[slot] = slot
+
+    def _address(self, i):
+        return ctypes.addressof(self._data) + (i % self.num_slots) * self.slot_size
+
+    def put(self, deq):
+        if deq is None:
+            self._ready.put(None)
+            return
+        i, s, item = deq
+        slot = i % self.num_slots
+        with self._cond:
+            while self._turn[slot] != i:
+                self._cond.wait()
+        if s is None:
+            self._ready.put((i, 0, None, item))
+        elif len(s) <= self.slot_size:
+            ctypes.memmove(self._address(i), s, len(s))
+            self._ready.put((i, len(s), None, item))
+        else:
+            self._ready.put((i, len(s), s, item))
+
+    def get(self, timeout=None):
+        deq = self._ready.get(timeout=timeout)
+        if deq is None:
+            return None
+        i, length, s, item = deq
+        if length and s is None:
+            s = ctypes.string_at(self._address(i), length)
+        return i, s, item
+
+    def release(self, i):
+        with self._cond:
+            self._turn[i % self.num_slots] = i + self.num_slots
+            self._cond.notify_all()
+
+def check_workers(workers):
+    """Raises an error if one of the worker processes died (e.g. an exception
+    raised outside of the try blocks of encode_item).
+    Parameters
+    ----------
+    workers: list
+        multiprocessing.Process objects
+    """
+    for p in workers:
+        if p.exitcode is not None and p.exitcode != 0:
+            raise RuntimeError('The worker process %s exited with code %d' % (p.name, p.exitcode))
+
+def terminate_workers(workers):
+    for p in workers:
+        if p.is_alive():
+            p.terminate()
+    for p in workers:
+        p.join()
+
+def join_workers(workers, others=(), timeout=1.0):
+    """Waits for the worker processes to exit and raises an error if one of
+    them, or of the other processes they depend on, died."""
+    watched = list(workers) + list(others)
+    for p in workers:
+        while p.is_alive():
+            p.join(timeout)
+            check_workers(watched)
+    check_workers(watched)
+
+def get_checked(q, workers, timeout=1.0):
+    """Gets the next element of a queue, checking every timeout seconds that
+    the worker processes filling it are still running."""
+    if not workers:
+        return q.get()
+    while True:
+        try:
+            return q.get(timeout=timeout)
+        except queue.Empty:
+            check_workers(workers)
+
+def put_checked(q, obj, workers, timeout=1.0):
+    """Puts an element into a bounded queue, checking every timeout seconds
+    that the worker processes consuming it are still running."""
+    while True:
+        try:
+            return q.put(obj, timeout=timeout)
+        except queue.Full:
+            check_workers(workers)
+
+def write_ordered(q_out, record, total=None, workers=None):
+    """Gets the records from the output queue and writes them into the record
+    file in the order of their indices.
+    Parameters
+    ----------
+    q_out: queue or SharedRingBuffer
+    record: MXIndexedRecordIO
+    total: int
+        number of records to write. None stops at the None sentinel
+    workers: list
+        the processes filling q_out. An error is raised if one of them dies
+        instead of waiting forever for its records
+    Returns
+    -------
+    list of the items that could not be packed
     """
     pre_time = time.time()
     count = 0
-    fname = os.path.basename(fname)
-    fname_rec = os.path.splitext(fname)[0] + '.rec'
-    fname_idx = os.path.splitext(fname)[0] + '.idx'
-    record = mx.recordio.MXIndexedRecordIO(os.path.join(working_dir, fname_idx),
-                                           os.path.join(working_dir, fname_rec), 'w')
     buf = {}
-    more = True
+    failed = []
+    release = getattr(q_out, 'release', None)
+    more = total is None or total > 0
     while more:
-        deq = q_out.get()
+        deq = get_checked(q_out, workers)
         if deq is not None:
             i, s, item = deq
             buf[i] = (s, item)
@@ -255,19 +394,415 @@ def write_worker(q_out, fname, working_dir):
             del buf[count]
             if s is not None:
                 record.write_idx(item[0], s)
+            else:
+                failed.append(item)
+            if release is not None:
+                release(count)
 
             if count % 1000 == 0:
                 cur_time = time.time()
                 print('time:', cur_time - pre_time, ' count:', count)
                 pre_time = cur_time
             count += 1
+        if total is not None and count == total:
+            more = False
+    return failed
 
-def parse_args():
-    """Defines all arguments.
+def write_worker(q_out, fname, working_dir):
+    """Function that will be spawned to fetch processed image
+    from the output queue and write to the .rec file.
+    Parameters
+    ----------
+    q_out: queue or SharedRingBuffer
+    fname: string
+    working_dir: string
+    """
+    fname = os.path.basename(fname)
+    fname_rec = os.path.splitext(fname)[0] + '.rec'
+    fname_idx = os.path.splitext(fname)[0] + '.idx'
+    record = mx.recordio.MXIndexedRecordIO(os.path.join(working_dir, fname_idx),
+                                           os.path.join(working_dir, fname_rec), 'w')
+    write_ordered(q_out, record)
+    record.close()
+
+def shard_worker(args, q_in, path_rec, path_idx, q_result):
+    """Function that will be spawned to fetch the images from the input
+    queue, encode them and write them into its own .rec/.idx shard.
+    Parameters
+    ----------
+    args: object
+    q_in: queue
+    path_rec: string
+    path_idx: string
+    q_result: queue
+        receives (path_rec, number of records written, items that could not be packed)
+    """
+    record = mx.recordio.MXIndexedRecordIO(path_idx, path_rec, 'w')
+    count = 0
+    failed = []
+    while True:
+        deq = q_in.get()
+        if deq is None:
+            break
+        i, item = deq
+        s = encode_item(args, item)
+        if s is None:
+            failed.append(item)
+            continue
+        record.write_idx(item[0], s)
+        count += 1
+        if count % 1000 == 0:
+            print('shard:', os.path.basename(path_rec), ' count:', count)
+    record.close()
+    q_result.put((path_rec, count, failed))
+
+def write_shards(args, image_list, prefix, num_shards):
+    """Encodes the images with num_shards processes. Each process writes its
+    own <prefix>-XXXXX-of-YYYYY.rec/.idx shard and <prefix>.shards.json
+    describes the logical dataset (the shards in order). The records of a
+    shard are in the order they were encoded.
+    Parameters
+    ----------
+    args: object
+    image_list: iterable
+        items in the format returned by read_list
+    prefix: string
+        path of the output files without extension
+    num_shards: int
+    Returns
+    -------
+    the manifest path, the number of records written and the list of the
+    items that could not be packed
+    """
+    shards = ['%s-%05d-of-%05d' % (prefix, k, num_shards) for k in range(num_shards)]
+    q_in = multiprocessing.Queue(1024)
+    q_result = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=shard_worker,
+                                         args=(args, q_in, shard + '.rec', shard + '.idx', q_result))
+                 for shard in shards]
+    for p in processes:
+        p.start()
+    try:
+        for i, item in enumerate(image_list):
+            put_checked(q_in, (i, item), processes)
+        for p in processes:
+            put_checked(q_in, None, processes)
+        # get the results before joining, the workers only exit after their result is consumed
+        results = dict((path_rec, (count, failed)) for path_rec, count, failed in
+                       (get_checked(q_result, processes) for p in processes))
+        join_workers(processes)
+    except Exception:
+        terminate_workers(processes)
+        raise
+
+    failed = []
+    for shard in shards:
+        failed.extend(results[shard + '.rec'][1])
+    path_manifest = write_manifest(prefix, [(shard, results[shard + '.rec'][0]) for shard in shards])
+    return path_manifest, sum(count for count, _ in results.values()), failed
+
+def write_manifest(prefix, shards):
+    """Writes the <prefix>.shards.json manifest of a shard set.
+    Parameters
+    ----------
+    prefix: string
+    shards: list
+        (shard path without extension, number of records) tuples, in the dataset order
+    Returns
+    -------
+    the manifest path
+    """
+    manifest = {'shards': [], 'num_records': 0}
+    for shard, count in shards:
+        manifest['shards'].append({'rec': os.path.basename(shard) + '.rec',
+                                   'idx': os.path.basename(shard) + '.idx',
+                                   'num_records': count})
+        manifest['num_records'] += count
+    path_manifest = prefix + '.shards.json'
+    write_json(path_manifest, manifest)
+    return path_manifest
+
+def write_json(path, content):
+    """Writes a json file atomically."""
+    with open(path + '.tmp', 'w') as fout:
+        json.dump(content, fout, indent=2)
+    os.replace(path + '.tmp', path)
+
+def item_digest(args, item):
+    """Content hash of an item: image bytes, label and the encoding options.
+    Returns None if the image can not be read.
+    """
+    sha1 = hashlib.sha1()
+    try:
+        with open(os.path.join(args.root, item[1]), 'rb') as fin:
+            for chunk in iter(lambda: fin.read(1 << 20), b''):
+                sha1.update(chunk)
+    except (IOError, OSError):
+        return None
+    options = [args.pass_through, args.resize, args.center_crop, args.quality,
+               args.color, args.encoding, args.pack_label]
+    sha1.update(repr([float(x) for x in item[2:]] + options).encode('utf-8'))
+    return sha1.hexdigest()
+
+def rewrite_index(path_idx, keys):
+    """Rewrites a .idx file keeping only the given record keys (the .rec file is untouched)."""
+    keys = set(keys)
+    with open(path_idx) as fin:
+        lines = [line for line in fin if line.strip() and int(line.split('\t')[0]) in keys]
+    with open(path_idx + '.tmp', 'w') as fout:
+        fout.writelines(lines)
+    os.replace(path_idx + '.tmp', path_idx)
+    return len(lines)
+
+
+def make_args(root='.', **kwargs):
+    """Builds the args object used by the record functions, with the same
+    defaults as the command line.
+    Parameters
+    ----------
+    root: string
+        path to folder containing images (absolute image paths are used as is)
+    kwargs: record options, e.g. pass_through=True, resize=300, pack_label=True
     Returns
     -------
     args object that contains all the params
     """
+    args = build_parser().parse_args(['', root])
+    for key, value in kwargs.items():
+        if not hasattr(args, key):
+            raise ValueError('Unknown im2rec option: %s' % key)
+        setattr(args, key, value)
+    args.root = os.path.abspath(args.root)
+    return args
+
+class RecordBuilder(object):
+    """In-process .rec/.idx builder.
+
+    The images are encoded by read worker processes that are started once and
+    shared by all the record files written with the same builder (e.g. train
+    and val). The encoded records reach the writer through a SharedRingBuffer
+    and are written in the order of the items.
+
+    Parameters
+    ----------
+    args: object
+        the args object returned by make_args
+    num_workers: int
+        number of encoding processes. 0 or 1 encodes in the calling process
+    reorder_window: int
+        number of shared memory slots (defaults to 4 slots per worker, at least 16)
+    slot_size_mb: float
+        size of each slot in MB
+    """
+    def __init__(self, args, num_workers=None, reorder_window=None, slot_size_mb=4):
+        self.args = args
+        if multiprocessing is None:
+            num_workers = 1
+        elif num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        self.num_workers = num_workers
+        self.reorder_window = reorder_window or max(16, 4 * num_workers)
+        self.slot_size = int(slot_size_mb * (1 << 20))
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _start_workers(self):
+        self._ring = SharedRingBuffer(self.reorder_window, self.slot_size)
+        self._q_in = [multiprocessing.Queue(1024) for i in range(self.num_workers)]
+        self._workers = [multiprocessing.Process(target=read_worker, args=(self.args, q, self._ring))
+                         for q in self._q_in]
+        for p in self._workers:
+            p.daemon = True
+            p.start()
+
+    def close(self):
+        if self._workers:
+            for q in self._q_in:
+                put_checked(q, None, self._workers)
+            join_workers(self._workers)
+            self._workers = []
+
+    def _feed(self, items):
+        for i, item in enumerate(items):
+            put_checked(self._q_in[i % len(self._q_in)], (i, item), self._workers)
+
+    def write(self, items, path_rec, path_idx=None, strict=False):
+        """Encodes the items and writes them into a .rec/.idx pair.
+        Parameters
+        ----------
+        items: list
+            items in the format returned by read_list: [index, image path, label...]
+        path_rec: string
+        path_idx: string
+            defaults to path_rec with the .idx extension
+        strict: bool
+            raise an error if any image could not be packed
+        Returns
+        -------
+        the number of records written and the list of the items that could not be packed
+        """
+        items = list(items)
+        if path_idx is None:
+            path_idx = os.path.splitext(path_rec)[0] + '.idx'
+
+        record = mx.recordio.MXIndexedRecordIO(path_idx, path_rec, 'w')
+        try:
+            if self.num_workers <= 1:
+                q_out = queue.Queue()
+                for i, item in enumerate(items):
+                    image_encode(self.args, i, item, q_out)
+                failed = write_ordered(q_out, record, len(items))
+            else:
+                if not self._workers:
+                    self._start_workers()
+                else:
+                    self._ring.reset()
+                # feed the workers from another thread, since they wait for the writer
+                feeder = threading.Thread(target=self._feed, args=(items,))
+                feeder.daemon = True
+                feeder.start()
+                try:
+                    failed = write_ordered(self._ring, record, len(items), self._workers)
+                except Exception:
+                    # the other workers may wait for the records of the dead one
+                    terminate_workers(self._workers)
+                    self._workers = []
+                    raise
+                feeder.join()
+        finally:
+            record.close()
+
+        if failed and strict:
+            raise RuntimeError('%d images could not be packed into %s, e.g. %s'
+                               % (len(failed), path_rec, failed[0][1]))
+        return len(items) - len(failed), failed
+
+    def write_sharded(self, items, prefix, num_shards=None, strict=False):
+        """Encodes the items and writes them into num_shards .rec/.idx shards
+        (see write_shards), one per encoding process.
+        Parameters
+        ----------
+        items: list
+            items in the format returned by read_list: [index, image path, label...]
+        prefix: string
+            path of the output files without extension
+        num_shards: int
+            defaults to the number of workers
+        strict: bool
+            raise an error if any image could not be packed
+        Returns
+        -------
+        the manifest path, the number of records written and the list of the
+        items that could not be packed
+        """
+        path_manifest, count, failed = write_shards(self.args, items, prefix,
+                                                    num_shards or max(1, self.num_workers))
+        if failed and strict:
+            raise RuntimeError('%d images could not be packed into %s, e.g. %s'
+                               % (len(failed), path_manifest, failed[0][1]))
+        return path_manifest, count, failed
+
+    def write_incremental(self, items, prefix, chunk_size=5000, strict=False, num_threads=8):
+        """Incremental and resumable packing into a shard set.
+
+        <prefix>.pack.json keeps a content hash (image bytes, label and encoding
+        options) of every packed image. Only the new or changed images are
+        encoded, into new <prefix>-inc-XXXXX.rec/.idx shards of chunk_size
+        records. The pack state is saved after each shard, so an interrupted
+        run resumes after the last finished shard when it is run again.
+        At the end, the .idx files are rewritten to drop the outdated records
+        (changed or removed images) and <prefix>.shards.json is rewritten.
+        Parameters
+        ----------
+        items: list
+            items in the format returned by read_list: [index, image path, label...].
+            The images are identified by their path and the index is replaced by
+            a unique record key
+        prefix: string
+            path of the output files without extension
+        chunk_size: int
+            maximum number of records of a new shard
+        strict: bool
+            raise an error if any image could not be packed
+        num_threads: int
+            number of threads hashing the images
+        Returns
+        -------
+        the manifest path, the number of records in the shard set and the list
+        of the items that could not be packed
+        """
+        items = list(items)
+        path_state = prefix + '.pack.json'
+        if os.path.exists(path_state):
+            with open(path_state) as fin:
+                state = json.load(fin)
+        else:
+            state = {'next_shard': 0, 'next_key': 0, 'records': {}}
+        records = state['records']
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            digests = list(executor.map(functools.partial(item_digest, self.args), items))
+        todo = [(item, digest) for item, digest in zip(items, digests)
+                if digest is None or item[1] not in records or records[item[1]]['digest'] != digest]
+        print('Packing', len(todo), 'new or changed images of', len(items))
+
+        failed = []
+        for start in range(0, len(todo), chunk_size):
+            chunk = todo[start:start + chunk_size]
+            shard = '%s-inc-%05d' % (prefix, state['next_shard'])
+            keyed = [[state['next_key'] + j] + list(item[1:]) for j, (item, _) in enumerate(chunk)]
+            _, chunk_failed = self.write(keyed, shard + '.rec')
+            failed_keys = set(item[0] for item in chunk_failed)
+            for item, (_, digest) in zip(keyed, chunk):
+                if item[0] in failed_keys:
+                    records.pop(item[1], None)
+                else:
+                    records[item[1]] = {'digest': digest, 'shard': os.path.basename(shard), 'key': item[0]}
+            failed.extend(chunk_failed)
+            state['next_shard'] += 1
+            state['next_key'] += len(chunk)
+            # an interrupted run restarts after the last saved shard
+            write_json(path_state, state)
+
+        # drop the images that are no longer in the list
+        current = set(item[1] for item in items)
+        for path in list(records):
+            if path not in current:
+                del records[path]
+        write_json(path_state, state)
+
+        keys_by_shard = {}
+        for record in records.values():
+            keys_by_shard.setdefault(record['shard'], []).append(record['key'])
+        folder = os.path.dirname(prefix)
+        shards = []
+        for k in range(state['next_shard']):
+            shard = os.path.join(folder, '%s-inc-%05d' % (os.path.basename(prefix), k))
+            if os.path.basename(shard) in keys_by_shard:
+                shards.append((shard, rewrite_index(shard + '.idx', keys_by_shard[os.path.basename(shard)])))
+            else:
+                # no record of this shard is used anymore
+                for ext in ['.rec', '.idx']:
+                    if os.path.exists(shard + ext):
+                        os.remove(shard + ext)
+        path_manifest = write_manifest(prefix, shards)
+
+        if failed and strict:
+            raise RuntimeError('%d images could not be packed into %s, e.g. %s'
+                               % (len(failed), path_manifest, failed[0][1]))
+        return path_manifest, len(records), failed
+
+def build_parser():
+    """Defines all arguments.
+    Returns
+    -------
+    the argument parser
+    """
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description='Create an image list or \
@@ -308,6 +843,18 @@ def parse_args():
                         help='number of thread to use for encoding. order of images will be different\
         from the input list if >1. the input list will be modified to match the\
         resulting order.')
+    rgroup.add_argument('--reorder-window', type=int, default=0,
+                        help='number of shared memory slots between the encoding processes and the writer.\
+        0 uses 4 slots per thread (at least 16)')
+    rgroup.add_argument('--slot-size-mb', type=float, default=4,
+                        help='size of each shared memory slot in MB. Larger records are sent through a queue.')
+    rgroup.add_argument('--num-shards', type=int, default=0,
+                        help='if > 0, write the records into this number of .rec/.idx shards in parallel,\
+        one per process, described by <prefix>.shards.json')
+    rgroup.add_argument('--incremental', action='store_true',
+                        help='only pack the new or changed images into new shards of <prefix>.shards.json,\
+        keeping the content hashes of the packed images in <prefix>.pack.json. An interrupted\
+        run resumes where it stopped.')
     rgroup.add_argument('--color', type=int, default=1, choices=[-1, 0, 1],
                         help='specify the color mode of the loaded image.\
         1: Loads a color image. Any transparency of image will be neglected. It is the default flag.\
@@ -317,7 +864,15 @@ def parse_args():
                         help='specify the encoding of the images.')
     rgroup.add_argument('--pack-label', action='store_true',
         help='Whether to also pack multi dimensional label in the record file')
-    args = parser.parse_args()
+    return parser
+
+def parse_args():
+    """Defines all arguments.
+    Returns
+    -------
+    args object that contains all the params
+    """
+    args = build_parser().parse_args()
     args.prefix = os.path.abspath(args.prefix)
     args.root = os.path.abspath(args.root)
     return args
@@ -342,9 +897,19 @@ if __name__ == '__main__':
                 count += 1
                 image_list = read_list(fname)
                 # -- write_record -- #
-                if args.num_thread > 1 and multiprocessing is not None:
+                if args.incremental:
+                    prefix = os.path.join(working_dir, os.path.splitext(os.path.basename(fname))[0])
+                    with RecordBuilder(args, args.num_thread, args.reorder_window, args.slot_size_mb) as builder:
+                        path_manifest, num_records, failed = builder.write_incremental(image_list, prefix)
+                    print('The shard set', path_manifest, 'has', num_records, 'records')
+                elif args.num_shards > 0 and multiprocessing is not None:
+                    prefix = os.path.join(working_dir, os.path.splitext(os.path.basename(fname))[0])
+                    path_manifest, num_records, failed = write_shards(args, image_list, prefix, args.num_shards)
+                    print('Wrote', num_records, 'records into', path_manifest)
+                elif args.num_thread > 1 and multiprocessing is not None:
                     q_in = [multiprocessing.Queue(1024) for i in range(args.num_thread)]
-                    q_out = multiprocessing.Queue(1024)
+                    q_out = SharedRingBuffer(args.reorder_window or max(16, 4 * args.num_thread),
+                                             int(args.slot_size_mb * (1 << 20)))
                     # define the process
                     read_process = [multiprocessing.Process(target=read_worker, args=(args, q_in[i], q_out)) \
                                     for i in range(args.num_thread)]
@@ -355,21 +920,21 @@ if __name__ == '__main__':
                     write_process = multiprocessing.Process(target=write_worker, args=(q_out, fname, working_dir))
                     write_process.start()
                     # put the image list into input queue
-                    for i, item in enumerate(image_list):
-                        q_in[i % len(q_in)].put((i, item))
-                    for q in q_in:
-                        q.put(None)
-                    for p in read_process:
-                        p.join()
+                    workers = read_process + [write_process]
+                    try:
+                        for i, item in enumerate(image_list):
+                            put_checked(q_in[i % len(q_in)], (i, item), workers)
+                        for q in q_in:
+                            put_checked(q, None, workers)
+                        join_workers(read_process, [write_process])
 
-                    q_out.put(None)
-                    write_process.join()
+                        q_out.put(None)
+                        join_workers([write_process])
+                    except Exception:
+                        terminate_workers(workers)
+                        raise
                 else:
                     print('multiprocessing not available, fall back to single threaded encoding')
-                    try:
-                        import Queue as queue
-                    except ImportError:
-                        import queue
                     q_out = queue.Queue()
                     fname = os.path.basename(fname)
                     fname_rec = os.path.splitext(fname)[0] + '.rec'
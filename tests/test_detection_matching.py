@@ -0,0 +1,118 @@
+import os
+import sys
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('mxnet')
+bbox_iou = pytest.importorskip('gluoncv.utils.bbox').bbox_iou
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..')))
+from utils.detection_matching import DetectionMatcher
+
+NUM_CLASSES = 3
+IOU_THRESHOLD = 0.5
+
+def padded(rows, size):
+    """(size, 5) array of [xmin, ymin, xmax, ymax, class] rows padded with -1."""
+    array = np.full((size, 5), -1.0)
+    array[:len(rows)] = rows
+    return array
+
+def build_batch():
+    # image 0: two gts of class 0, one of class 1 overlapping a class 0 prediction
+    # image 1: two gts of class 2; a class 1 prediction without any gt of its class
+    gts = np.stack([
+        padded([[0, 0, 10, 10, 0], [20, 20, 30, 30, 0], [1, 1, 11, 11, 1]], 4),
+        padded([[50, 50, 60, 60, 2], [0, 0, 10, 10, 2]], 4),
+    ])
+    preds = np.stack([
+        padded([[20, 20, 30, 31, 0], [0, 0, 10, 10, 0], [1, 1, 11, 11, 1], [70, 70, 80, 80, 2]], 6),
+        padded([[0, 0, 10, 10, 2], [50, 50, 61, 60, 2], [40, 40, 45, 45, 1]], 6),
+    ])
+    return preds, gts
+
+def valid(rows):
+    return rows[rows[:, 4] >= 0]
+
+def nested_loop_counts(preds, gts):
+    """Counting loop of the old validate() of evaluate.py / evaluate_coco.py / train_custom_val_loss.py."""
+    tp = [0] * NUM_CLASSES
+    fp = [0] * NUM_CLASSES
+    gt_by_class = [0] * NUM_CLASSES
+    confusion_matrix = np.zeros((NUM_CLASSES, NUM_CLASSES))
+    for img_preds, img_gts in zip(preds, gts):
+        # the padding (-1) is skipped by the matcher
+        img_preds, img_gts = valid(img_preds), valid(img_gts)
+        for gt in img_gts:
+            gt_by_class[int(gt[4])] += 1
+        for pred in img_preds:
+            pred_label = int(pred[4])
+            match = 0
+            for gt in img_gts:
+                gt_label = int(gt[4])
+                iou = bbox_iou(pred[None, :4], gt[None, :4])
+                if iou > IOU_THRESHOLD and pred_label == gt_label:
+                    confusion_matrix[gt_label][pred_label] += 1
+                    tp[gt_label] += 1
+                    match = 1
+                elif iou > IOU_THRESHOLD:
+                    confusion_matrix[gt_label][pred_label] += 1
+                    fp[pred_label] += 1
+                    match = 1
+            if not match:
+                fp[pred_label] += 1
+    return tp, fp, gt_by_class, confusion_matrix
+
+def first_gt_loop_counts(preds, gts):
+    """Counting loop of the old validate() of predict.py."""
+    tp = [0] * NUM_CLASSES
+    fp = [0] * NUM_CLASSES
+    for img_preds, img_gts in zip(preds, gts):
+        img_preds, img_gts = valid(img_preds), valid(img_gts)
+        gt_ids = list(img_gts[:, 4])
+        for pred in img_preds:
+            pred_label = int(pred[4])
+            if pred_label in gt_ids:
+                gt = img_gts[gt_ids.index(pred_label)]
+                iou = bbox_iou(pred[None, :4], gt[None, :4])
+                if iou > IOU_THRESHOLD:
+                    tp[pred_label] += 1
+                    continue
+            fp[pred_label] += 1
+    return tp, fp
+
+def update(matcher, preds, gts):
+    matcher.update(preds[:, :, :4], preds[:, :, 4:], gts[:, :, :4], gts[:, :, 4:])
+
+def test_matcher_reproduces_nested_loop_counts():
+    preds, gts = build_batch()
+    tp, fp, gt_by_class, confusion_matrix = nested_loop_counts(preds, gts)
+
+    matcher = DetectionMatcher(NUM_CLASSES, IOU_THRESHOLD)
+    update(matcher, preds, gts)
+    assert matcher.tp.tolist() == tp
+    assert matcher.fp.tolist() == fp
+    assert matcher.gt_by_class.tolist() == gt_by_class
+    np.testing.assert_array_equal(matcher.confusion_matrix, confusion_matrix)
+    # the cross-class overlap is counted on both sides of the confusion matrix
+    assert confusion_matrix[1][0] == confusion_matrix[0][1] == 1
+
+def test_matcher_first_gt_reproduces_predict_counts():
+    preds, gts = build_batch()
+    tp, fp = first_gt_loop_counts(preds, gts)
+
+    matcher = DetectionMatcher(NUM_CLASSES, IOU_THRESHOLD, first_gt=True)
+    update(matcher, preds, gts)
+    assert matcher.tp.tolist() == tp
+    assert matcher.fp.tolist() == fp
+    # the rules differ on the second gt of a class
+    assert tp != nested_loop_counts(preds, gts)[0]
+
+def test_matcher_accumulates_batches():
+    preds, gts = build_batch()
+    matcher = DetectionMatcher(NUM_CLASSES, IOU_THRESHOLD)
+    update(matcher, preds[:1], gts[:1])
+    update(matcher, preds[1:], gts[1:])
+    tp, fp, gt_by_class, _ = nested_loop_counts(preds, gts)
+    assert matcher.tp.tolist() == tp
+    assert matcher.fp.tolist() == fp
+    assert matcher.gt_by_class.tolist() == gt_by_class
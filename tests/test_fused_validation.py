@@ -0,0 +1,42 @@
+import os
+import sys
+import pytest
+
+mx = pytest.importorskip('mxnet')
+gcv = pytest.importorskip('gluoncv')
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..')))
+from utils.fused_validation import SSDValidationOutputs
+
+def random_ssd():
+    mx.random.seed(0)
+    net = gcv.model_zoo.get_model('ssd_300_vgg16_atrous_custom', classes=['a', 'b', 'c'],
+                                  pretrained_base=False)
+    net.initialize()
+    net.set_nms(nms_thresh=0.45, nms_topk=200, post_nms=3)
+    return net
+
+@pytest.mark.parametrize('hybridize', [False, True])
+def test_detections_equal_net_output(hybridize):
+    net = random_ssd()
+    if hybridize:
+        net.hybridize(static_alloc=True, static_shape=True)
+    x = mx.nd.random.uniform(-1, 1, shape=(2, 3, 300, 300))
+    fused = SSDValidationOutputs(net)(x)[2:]
+    for fused_output, net_output in zip(fused, net(x)):
+        mx.test_utils.assert_almost_equal(fused_output.asnumpy(), net_output.asnumpy(), rtol=1e-5, atol=1e-5)
+
+def test_predictions_equal_training_outputs():
+    net = random_ssd()
+    x = mx.nd.random.uniform(-1, 1, shape=(1, 3, 300, 300))
+    # the vgg16 atrous SSD has no batch norm or dropout, so the training mode outputs are the same
+    with mx.autograd.train_mode():
+        expected = net(x)
+    # up to the float rounding of the two execution paths
+    for output, expected_output in zip(SSDValidationOutputs(net).predictions(x), expected):
+        mx.test_utils.assert_almost_equal(output.asnumpy(), expected_output.asnumpy(), rtol=1e-3, atol=1e-4)
+
+def test_other_networks_are_not_supported():
+    net = gcv.model_zoo.get_model('yolo3_darknet53_custom', classes=['a'], pretrained_base=False)
+    assert not SSDValidationOutputs.supports(net)
+    with pytest.raises(TypeError):
+        SSDValidationOutputs(net)
@@ -0,0 +1,59 @@
+import os
+import sys
+import pytest
+
+mx = pytest.importorskip('mxnet')
+np = pytest.importorskip('numpy')
+cv2 = pytest.importorskip('cv2')
+pytest.importorskip('gluoncv')
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..')))
+from train_evaluate.predict import Detector
+
+class ConstantNet(object):
+    """Returns one detection (class 0, score 0.9) per image, at the letterboxed box (10, 10, 20, 20)."""
+    def __call__(self, x):
+        batch_size = x.shape[0]
+        class_IDs = mx.nd.zeros((batch_size, 1, 1))
+        scores = mx.nd.full((batch_size, 1, 1), 0.9)
+        bounding_boxes = mx.nd.array(np.tile([10, 10, 20, 20], (batch_size, 1, 1)))
+        return class_IDs, scores, bounding_boxes
+
+def folder_detector():
+    det = Detector.__new__(Detector)
+    det.width, det.height = 32, 32
+    det.threshold = 0.5
+    det.ctx = [mx.cpu()]
+    det.net = ConstantNet()
+    return det
+
+def write_images(tmpdir, count):
+    paths = []
+    for i in range(count):
+        path = str(tmpdir.join('image_{}.jpg'.format(i)))
+        cv2.imwrite(path, np.full((32, 32, 3), 127, dtype=np.uint8))
+        paths.append(path)
+    return paths
+
+def test_detect_folder_skips_missing_image(tmpdir):
+    paths = write_images(tmpdir, 3)
+    missing = str(tmpdir.join('missing.jpg'))
+    results = list(folder_detector().detect_folder(paths[:1] + [missing] + paths[1:], batch_size=2))
+    assert [path for path, _, _, _ in results] == paths
+    for _, class_IDs, scores, bounding_boxes in results:
+        assert len(class_IDs) == len(scores) == len(bounding_boxes) == 1
+
+def test_detect_folder_only_missing_images(tmpdir):
+    missing = [str(tmpdir.join('missing_{}.jpg'.format(i))) for i in range(3)]
+    assert list(folder_detector().detect_folder(missing, batch_size=2)) == []
+
+def test_detect_folder_raises_on_missing_image(tmpdir):
+    paths = write_images(tmpdir, 2)
+    missing = str(tmpdir.join('missing.jpg'))
+    with pytest.raises(IOError):
+        list(folder_detector().detect_folder(paths + [missing], batch_size=2, skip_unreadable=False))
+
+def test_detect_video_offline_raises_on_missing_video(tmpdir):
+    video_path = str(tmpdir.join('missing.mp4'))
+    with pytest.raises(IOError):
+        folder_detector().detect_video_offline(video_path)
+    assert not os.path.exists(str(tmpdir.join('missing.npz')))
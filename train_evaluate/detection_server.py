@@ -0,0 +1,120 @@
+import os
+import sys
+import json
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import cv2
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..')))
+from train_evaluate.predict import Detector
+
+'''
+Local detection server that keeps a warmed, hybridized network in memory.
+
+The network is built and loaded only once, so the grasping pipeline does not pay
+for the mxnet/gluoncv imports and the model loading at every detection.
+Concurrent requests arriving within a short time window are grouped into a single
+batch by the micro-batcher of the Detector (see Detector.start_micro_batcher).
+
+Usage:
+    python train_evaluate/detection_server.py ssd_300_vgg16_atrous_voc_best_epoch_0025_map_0.8749.params \
+        --model ssd_300_vgg16_atrous_voc --port 8080
+
+Endpoints (localhost only):
+    POST /detect  body: encoded image bytes (jpg, png, ...)
+                  returns: {"class_ids": [...], "class_names": [...], "scores": [...], "bboxes": [[xmin, ymin, xmax, ymax], ...]}
+    GET  /health  returns: {"status": "ok"}
+    GET  /stats   returns the queue depth and batch fill ratio counters of the micro-batcher
+
+Example:
+    curl --data-binary @image.jpg http://127.0.0.1:8080/detect
+'''
+
+class DetectionRequestHandler(BaseHTTPRequestHandler):
+    def _send_json(self, code, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        elif self.path == '/stats':
+            self._send_json(200, self.server.detector.micro_batcher.stats.as_dict())
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/detect':
+            self._send_json(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = 0
+        if length <= 0:
+            self._send_json(400, {'error': 'the body is empty or its Content-Length is invalid'})
+            return
+        try:
+            image = cv2.imdecode(np.frombuffer(self.rfile.read(length), np.uint8), cv2.IMREAD_COLOR)
+        except cv2.error:
+            image = None
+        if image is None:
+            self._send_json(400, {'error': 'the body is not a valid image'})
+            return
+
+        detector = self.server.detector
+        try:
+            class_IDs, scores, bounding_boxes = detector.detect_async(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)).result()
+        except Exception as e:
+            self._send_json(500, {'error': 'detection failed: {}'.format(e)})
+            return
+        classes = detector.classes
+        self._send_json(200, {'class_ids': [int(x) for x in class_IDs],
+                              'class_names': [classes[int(x)] for x in class_IDs],
+                              'scores': scores.tolist(),
+                              'bboxes': bounding_boxes.tolist()})
+
+    def log_message(self, format, *args):
+        pass
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Local detection server',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('params', help='params file name inside the checkpoints folder configured in config.json')
+    parser.add_argument('--model', default='ssd_300_vgg16_atrous_voc', help='network name')
+    parser.add_argument('--ctx', default='gpu', choices=['cpu', 'gpu'])
+    parser.add_argument('--threshold', type=float, default=0.5, help='minimum score of the returned detections')
+    parser.add_argument('--nms-threshold', type=float, default=0.5)
+    parser.add_argument('--host', default='127.0.0.1', help='only local connections are accepted by default')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--max-wait-ms', type=float, default=5,
+                        help='time window to group concurrent requests into a batch')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    det = Detector(args.params, model=args.model, ctx=args.ctx, threshold=args.threshold,
+                   nms_threshold=args.nms_threshold, load_val_set=False)
+    # post_nms = maximum number of objects per image
+    det.net.set_nms(nms_thresh=args.nms_threshold, nms_topk=200, post_nms=len(det.classes))
+    det.net.hybridize(static_alloc=True, static_shape=True)
+
+    server = ThreadingHTTPServer((args.host, args.port), DetectionRequestHandler)
+    det.start_micro_batcher(args.max_batch_size, args.max_wait_ms)
+    server.detector = det
+    print('Detection server listening on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        det.stop_micro_batcher()
+
+if __name__ == "__main__":
+    main()
@@ -10,13 +10,17 @@ import cv2
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..')))
 import utils.common as dataset_commons
+from utils.detection_cache import get_detections, evaluate_detections
+from utils.sharded_record import open_record_dataset
+from utils.validation_cache import MappedValidationSet
+from utils.parallel_evaluation import run_parallel
 import glob
 from matplotlib import pyplot as plt
 from gluoncv.utils.metrics.voc_detection import VOC07MApMetric
 from gluoncv.data.batchify import Tuple, Stack, Pad
-from gluoncv.utils.bbox import bbox_iou 
 from gluoncv.data.transforms.presets.ssd import SSDDefaultValTransform
 import itertools
+from functools import partial
 
 data_common = dataset_commons.get_dataset_files()
 
@@ -40,13 +44,14 @@ Example:
 
 class Detector:
     def __init__(self, model_path, model='ssd300_vgg16_voc', ctx='gpu', threshold=0.5, validation_threshold=0.5, 
-                 batch_size=4, num_workers=2, nms_threshold=0.5):
+                 batch_size=4, num_workers=2, nms_threshold=0.5, use_detection_cache=True, val_loader=None):
         self.model_path = model_path
         self.threshold = threshold
         self.validation_threshold = validation_threshold
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.nms_threshold = nms_threshold
+        self.detection_cache_folder = data_common['detection_cache_folder'] if use_detection_cache else None
         
         classes_keys = [key for key in data_common['classes']]
         self.classes = classes_keys
@@ -58,7 +63,7 @@ class Detector:
         else:
             raise ValueError('Invalid context.')
 
-        self.width, self.height = dataset_commons.get_model_prop(model)
+        self.width, self.height, _ = dataset_commons.get_model_prop(model)
         self.model_name = model
 
         self.val_file = data_common['record_val_path']
@@ -71,15 +76,20 @@ class Detector:
         net.load_parameters(self.model_path, ctx=self.ctx)
         self.net = net
 
-        self.val_dataset = gdata.RecordFileDetection(self.val_file)
         self.val_metric = VOC07MApMetric(iou_thresh=validation_threshold, class_names=self.net.classes)
 
-        # Val verdadeiro
-        val_batchify_fn = Tuple(Stack(), Pad(pad_val=-1))
-        val_loader = gluon.data.DataLoader(
-            self.val_dataset.transform(SSDDefaultValTransform(self.width, self.height)),
-            batch_size, False, batchify_fn=val_batchify_fn, last_batch='keep', num_workers=self.num_workers)
+        # An already cached validation set (same input shape) can be shared between detectors
+        if val_loader is None:
+            val_dataset = open_record_dataset(self.val_file)
+            # Val verdadeiro: decoded and transformed once into the validation cache folder
+            val_loader = MappedValidationSet(val_dataset, self.val_file, self.width, self.height, batch_size,
+                                             data_common['validation_cache_folder'], num_workers=self.num_workers)
         self.val_loader = val_loader
+
+    def load_checkpoint(self, model_path):
+        """Swaps the network parameters without building the network graph again."""
+        self.net.load_parameters(model_path, ctx=self.ctx)
+        self.model_path = model_path
     
     def filter_predictions(self, bounding_boxes, scores, class_IDs):
         threshold = self.threshold
@@ -130,110 +140,16 @@ class Detector:
 
     def validate(self):
         """Test on validation dataset."""
-        val_data = self.val_loader
-        ctx = self.ctx
-        val_metric = self.val_metric
-        nms_threshold = self.nms_threshold
-        validation_threshold = self.validation_threshold
-
-        val_metric.reset()
-        # set nms threshold and topk constraint
         # post_nms = maximum number of objects per image
-        self.net.set_nms(nms_thresh=nms_threshold, nms_topk=200, post_nms=len(self.classes)) # default: iou=0.45 e topk=400
-
-        # allow the MXNet engine to perform graph optimization for best performance.
-        self.net.hybridize(static_alloc=True, static_shape=True)
-
-        num_of_classes = len(self.classes)
-        # total number of correct prediction by class
-        tp = [0] * num_of_classes
-        # false positives by class
-        fp = [0] * num_of_classes
-        # count the number of gt by class
-        gt_by_class = [0] * num_of_classes
-        # rec and prec by class
-        rec_by_class = [0] * num_of_classes
-        prec_by_class = [0] * num_of_classes
-        confusion_matrix = np.zeros((num_of_classes, num_of_classes))
-
-        for batch in val_data:
-            batch_size = batch[0].shape[0]
-            data = gluon.utils.split_and_load(batch[0], ctx_list=ctx, batch_axis=0, even_split=False)
-            label = gluon.utils.split_and_load(batch[1], ctx_list=ctx, batch_axis=0, even_split=False)
-
-            pred_bboxes_list = []
-            pred_label_list = []
-            pred_scores_list = []
-            gt_bboxes_list = []
-            gt_label_list = []
-            
-            for x, y in zip(data, label):
-                # get prediction results
-                ids, scores, bboxes = self.net(x)
-                pred_label_list.append(ids)
-                pred_scores_list.append(scores)
-                # clip to image size
-                pred_bboxes_list.append(bboxes.clip(0, batch[0].shape[2]))
-                # split ground truths
-                gt_label_list.append(y.slice_axis(axis=-1, begin=4, end=5))
-                gt_bboxes_list.append(y.slice_axis(axis=-1, begin=0, end=4))
-
-            # Uncomment the following line if you want to plot the images in each inference to visually  check the tp, fp and fn 
-            # self.show_images(x, pred_label_list, pred_bboxes_list, gt_label_list, gt_bboxes_list)
-            
-            # update metric
-            val_metric.update(pred_bboxes_list, pred_label_list, pred_scores_list, gt_bboxes_list, gt_label_list) #, gt_difficults)
-            
-            # Get Micro Averaging (precision and recall by each class) in each batch
-            for img in range(batch_size):
-                # count +1 for this class id. It will get the total number of gt by class
-                # It is useful when considering unbalanced datasets
-                for gt_idx in gt_label_list[0][img]:
-                    index = int(gt_idx.asnumpy()[0])
-                    gt_by_class[index] += 1
-            
-                for (pred_label, pred_bbox) in zip(pred_label_list[0][img], list(pred_bboxes_list[0][img])):
-                    pred_label = int(pred_label.asnumpy()[0])
-                    pred_bbox = pred_bbox.asnumpy()
-                    pred_bbox = np.expand_dims(pred_bbox, axis=0)
-                    match = 0
-                    for (gt_bbox_label, gt_bbox_coordinates) in zip(gt_label_list[0][img], list(gt_bboxes_list[0][img])):
-                        gt_bbox_coord = gt_bbox_coordinates.asnumpy()
-                        gt_bbox_coord = np.expand_dims(gt_bbox_coord, axis=0)
-                        gt_bbox_label = int(gt_bbox_label.asnumpy()[0])
-                        iou = bbox_iou(pred_bbox, gt_bbox_coord)
-                        
-                        # Correct inference
-                        if iou > validation_threshold and pred_label == gt_bbox_label:
-                            confusion_matrix[gt_bbox_label][pred_label] += 1
-                            tp[gt_bbox_label] += 1 # Correct classification
-                            match = 1
-                        # Incorrect inference - missed the correct class but put the bounding box in other class
-                        elif iou > validation_threshold:
-                            confusion_matrix[gt_bbox_label][pred_label] += 1
-                            fp[pred_label] += 1
-                            match = 1
-                        
-                    if not match:
-                        fp[pred_label] += 1
-                                
-        # calculate the Recall and Precision by class
-        tp = np.array(tp) # we can also sum the matrix diagonal
-        fp = np.array(fp)
-        
-        fp_sum = sum(fp)
-        tp_sum = sum(tp)
-
-        # rec and prec according to the micro averaging
-        for i, (gt_value, tp_value) in enumerate(zip(gt_by_class, tp)):
-            rec_by_class[i] += tp_value/gt_value
+        # The detections are cached on disk by params file, val record file and nms settings
+        detections = get_detections(self.net, self.val_loader, self.ctx, self.model_path, self.val_file,
+                                    self.nms_threshold, post_nms=len(self.classes),
+                                    cache_folder=self.detection_cache_folder)
 
-            # If an element of fp + tp is 0,
-            # the corresponding element of prec[l] is nan.
-            with np.errstate(divide='ignore', invalid='ignore'):
-                prec_by_class[i] += tp_value/(tp_value+fp[i])
-        # rec, prec = val_metric._recall_prec()      
-        return val_metric.get(), rec_by_class, prec_by_class, gt_by_class_sum, fp_sum, tp_sum, confusion_matrix
+        (val_result, rec_by_class, prec_by_class, fp_sum, tp_sum, confusion_matrix), = evaluate_detections(
+            detections, self.net.classes, [self.validation_threshold])
+        gt_by_class_sum = int((detections['gt_ids'] >= 0).sum())
+        return val_result, rec_by_class, prec_by_class, gt_by_class_sum, fp_sum, tp_sum, confusion_matrix
 
 def evaluation_analysis(model_names_list, experiments_ids_list, fp_sum_list, tp_sum_list, prec_by_class_list):
     fig, ax1 = plt.subplots()
@@ -308,9 +224,72 @@ def confusion_matrix_plot(cm, model_name, target_names, experiment_id_name):
     plt.xlabel('Predicted label')
     # plt.show()
 
-def evaluate_main():
-    model_networks_path = glob.glob(data_common['checkpoint_folder'] + '/*/')
-    
+def sweep_checkpoints(checkpoints, **detector_kwargs):
+    """
+    Yields a Detector loaded with each checkpoint. Only one network graph is built
+    per architecture (the parameters are swapped with load_parameters) and the
+    validation set is decoded and transformed only once per input shape.
+
+    Arguments:
+        checkpoints (list): (model_name, experiment_id, param_path) tuples returned by list_checkpoints
+        detector_kwargs: Detector arguments
+
+    Yields:
+        tuple: (model_name, experiment_id, param_path, detector)
+    """
+    det = None
+    val_loaders = {}
+    for model_name, experiment_id_name, param_path in checkpoints:
+        if det is None or det.model_name != model_name:
+            # the checkpoints are grouped by model, so only one network is kept in memory
+            shape = dataset_commons.get_model_prop(model_name)[:2]
+            det = Detector(param_path, model=model_name, val_loader=val_loaders.get(shape), **detector_kwargs)
+            val_loaders[shape] = det.val_loader
+        else:
+            det.load_checkpoint(param_path)
+        yield model_name, experiment_id_name, param_path, det
+
+def evaluate_checkpoints(checkpoints, ctx='gpu', num_workers=2):
+    """
+    Validates each checkpoint. It is also the worker function of the parallel sweep.
+
+    Arguments:
+        checkpoints (list): (model_name, experiment_id, param_path) tuples returned by list_checkpoints
+        ctx (str, default: 'gpu'): 'cpu' or 'gpu'
+        num_workers (int, default: 2): number of data loading workers
+
+    Returns:
+        list: one dict with the validation results of each checkpoint
+    """
+    results = []
+    for model_name, experiment_id_name, param_path, det in sweep_checkpoints(checkpoints,
+            ctx=ctx, 
+            threshold=0.8, # Used to filter the bounding boxes after detection - it will not affect validation 
+            batch_size=4, 
+            num_workers=num_workers, 
+            nms_threshold=0.5 # It will affect validation
+            ):
+        (map_name, mean_ap), rec_by_class, prec_by_class, gt_by_class_sum, fp_sum, tp_sum, confusion_matrix = det.validate()
+        results.append({'model_name': model_name,
+                        'experiment_id': experiment_id_name,
+                        'param_path': param_path,
+                        'map_name': map_name,
+                        'mean_ap': mean_ap,
+                        'prec_by_class': prec_by_class,
+                        'gt_by_class_sum': gt_by_class_sum,
+                        'fp_sum': fp_sum,
+                        'tp_sum': tp_sum,
+                        'confusion_matrix': confusion_matrix})
+    return results
+
+def evaluate_main(num_processes=1, threads_per_process=None):
+    """
+    Arguments:
+        num_processes (int, default: 1): number of CPU worker processes. 1 runs all the
+            checkpoints sequentially in this process using the GPU
+        threads_per_process (int, default: None): thread budget of each worker process.
+            None splits the CPU cores evenly between the workers
+    """
     classes_keys = [key for key in data_common['classes']]
 
     experiments_ids_list = []
@@ -319,42 +298,32 @@ def evaluate_main():
     gt_by_class_sum_list = []
     fp_sum_list = []
     tp_sum_list = []
-    for model_path in model_networks_path:
-        experiment_paths = glob.glob(model_path + '/*/')
-        start = model_path.find('ints')
-        model_name = model_path[start+5:-1]
-        for experiment_path in experiment_paths:
-            param_paths = glob.glob(experiment_path + '/*.params')
-            start = experiment_path.find('SAN')
-            experiment_id_name = experiment_path[start:-1]
-            for param_path in param_paths:
-                start = param_path.find(experiment_id_name)
-                param_name = param_path[start+len(experiment_id_name)+2:-1]
-                det = Detector(param_path, 
-                   model=model_name, 
-                   ctx='gpu', 
-                   threshold=0.8, # Used to filter the bounding boxes after detection - it will not affect validation 
-                   batch_size=4, 
-                   num_workers=2, 
-                   nms_threshold=0.5 # It will affect validation
-                   )
-                (map_name, mean_ap), rec_by_class, prec_by_class, gt_by_class_sum, fp_sum, tp_sum, confusion_matrix = det.validate()
-                map_geral = float(mean_ap[-1])
-                map_gera_name = map_name[-1]
-                
-                confusion_matrix_plot(confusion_matrix, model_name, classes_keys, experiment_id_name)
-
-                prec_by_class_list.append(prec_by_class)
-                model_names_list.append(model_name)
-                experiments_ids_list.append(experiment_id_name)
-                gt_by_class_sum_list.append(gt_by_class_sum)
-                fp_sum_list.append(fp_sum)
-                tp_sum_list.append(tp_sum)
-
-                print('Model_Name: ', model_name)
-                print('Experiment_id: ', experiment_id_name)
-                print('params: ', param_name)
-                print('pec: ', prec_by_class)
+    checkpoints = dataset_commons.list_checkpoints(data_common['checkpoint_folder'])
+    if num_processes > 1:
+        # the data is loaded inside each worker, so no DataLoader workers are spawned
+        results = run_parallel(partial(evaluate_checkpoints, ctx='cpu', num_workers=0), checkpoints,
+                               num_processes, threads_per_process)
+    else:
+        results = evaluate_checkpoints(checkpoints)
+
+    for result in results:
+        model_name = result['model_name']
+        experiment_id_name = result['experiment_id']
+        prec_by_class = result['prec_by_class']
+        
+        confusion_matrix_plot(result['confusion_matrix'], model_name, classes_keys, experiment_id_name)
+
+        prec_by_class_list.append(prec_by_class)
+        model_names_list.append(model_name)
+        experiments_ids_list.append(experiment_id_name)
+        gt_by_class_sum_list.append(result['gt_by_class_sum'])
+        fp_sum_list.append(result['fp_sum'])
+        tp_sum_list.append(result['tp_sum'])
+
+        print('Model_Name: ', model_name)
+        print('Experiment_id: ', experiment_id_name)
+        print('params: ', os.path.basename(result['param_path']))
+        print('pec: ', prec_by_class)
 
     evaluation_analysis(model_names_list, experiments_ids_list, fp_sum_list, tp_sum_list, prec_by_class_list)
     for (exp_id, network) in zip(experiments_ids_list, model_names_list):
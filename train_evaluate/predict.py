@@ -13,18 +13,77 @@ import cv2
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..')))
 import utils.common as dataset_commons
+from utils.detection_cache import get_detections, evaluate_detections
+from utils.sharded_record import open_record_dataset
+from utils.validation_cache import MappedValidationSet
+from utils.video_pipeline import StreamingPipeline, StageStats
+from utils.micro_batcher import MicroBatcher
 import time
 import glob
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib import pyplot as plt
 from gluoncv.utils.metrics.voc_detection import VOC07MApMetric
 from gluoncv.data.batchify import Tuple, Stack, Pad
-from gluoncv.utils.bbox import bbox_iou 
 from gluoncv.data.transforms.presets.ssd import SSDDefaultValTransform
 
 data_common = dataset_commons.get_dataset_files()
 
+# mean and std used by the SSD and YOLO presets of gluoncv
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+def images_to_batch(images):
+    """
+    Normalizes a list of RGB uint8 images with the same shape (H, W, 3) and
+    stacks them into a (N, 3, H, W) float32 array, like the gluoncv presets.
+    """
+    batch = np.stack(images).astype(np.float32) / 255.0
+    batch = (batch - MEAN) / STD
+    return batch.transpose((0, 3, 1, 2))
+
+def detections_to_columns(frame_indices, class_IDs, scores, bounding_boxes, threshold, scale):
+    """
+    Converts a batch of network outputs into flat detection columns.
+
+    Arguments:
+        frame_indices (np.ndarray): (B,) frame (or image) index of each batch element
+        class_IDs, scores (np.ndarray): (B, K, 1) network outputs
+        bounding_boxes (np.ndarray): (B, K, 4) network outputs
+        threshold (float): minimum score to keep a detection
+        scale (np.ndarray): (B, 4) or (4,) factors mapping the boxes to the original image size
+
+    Returns:
+        dict: 'frame', 'class_id', 'score' and 'bbox' columns
+    """
+    class_IDs, scores = class_IDs[..., 0], scores[..., 0]
+    keep = (class_IDs >= 0) & (scores > threshold)
+    scale = np.broadcast_to(np.asarray(scale, dtype=np.float32).reshape(-1, 1, 4), bounding_boxes.shape)
+    return {'frame': np.broadcast_to(np.asarray(frame_indices)[:, None], keep.shape)[keep].astype(np.int32),
+            'class_id': class_IDs[keep].astype(np.int16),
+            'score': scores[keep].astype(np.float32),
+            'bbox': (bounding_boxes * scale)[keep].astype(np.float32)}
+
+def letterbox_image(image, width, height):
+    """
+    Resizes an image keeping its aspect ratio and pads it to (height, width) with the mean color.
+
+    Returns:
+        tuple: the padded image, the resize scale and the (x, y) padding offsets
+    """
+    h, w = image.shape[:2]
+    scale = min(width / w, height / h)
+    new_w, new_h = int(round(w * scale)), int(round(h * scale))
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    resized = cv2.resize(image, (new_w, new_h), interpolation=interpolation)
+    pad_x, pad_y = (width - new_w) // 2, (height - new_h) // 2
+    padded = np.empty((height, width, 3), dtype=np.uint8)
+    padded[:] = (MEAN * 255).astype(np.uint8)
+    padded[pad_y:pad_y + new_h, pad_x:pad_x + new_w] = resized
+    return padded, scale, (pad_x, pad_y)
+
 class Detector:
-    def __init__(self, model_path, model='ssd300', ctx='gpu', threshold=0.5, device_id=1, validation_threshold=0.5, batch_size=4, num_workers=2, nms_threshold=0.5):
+    def __init__(self, model_path, model='ssd_300_vgg16_atrous_voc', ctx='gpu', threshold=0.5, device_id=1, validation_threshold=0.5, batch_size=4, num_workers=2, nms_threshold=0.5,
+                 use_detection_cache=True, load_val_set=True):
         self.model_path = os.path.join(data_common['checkpoint_folder'], model_path)
         self.threshold = threshold
         self.device_id = device_id
@@ -32,6 +91,8 @@ class Detector:
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.nms_threshold = nms_threshold
+        self.detection_cache_folder = data_common['detection_cache_folder'] if use_detection_cache else None
+        self.micro_batcher = None
         
         classes_keys = [key for key in data_common['classes']]
         self.classes = classes_keys
@@ -43,10 +104,10 @@ class Detector:
         else:
             raise ValueError('Invalid context.')
         
-        self.width, self.height = dataset_commons.get_model_prop(model)
+        self.width, self.height, _ = dataset_commons.get_model_prop(model)
         self.model_name = model
 
-        net = get_model(model_name, pretrained=False, ctx=self.ctx)
+        net = get_model(self.model_name, pretrained=False, ctx=self.ctx)
         # net.set_nms(nms_thresh=0.5, nms_topk=2)
         net.hybridize(static_alloc=True, static_shape=True)
         net.initialize(force_reinit=True, ctx=self.ctx)
@@ -59,15 +120,16 @@ class Detector:
         # TODO: load the train and val rec file
         self.val_file = data_common['record_val_path']
 
-        self.val_dataset = gdata.RecordFileDetection(self.val_file)
         self.val_metric = VOC07MApMetric(iou_thresh=validation_threshold, class_names=self.net.classes)
-        
-        # Val verdadeiro
-        val_batchify_fn = Tuple(Stack(), Pad(pad_val=-1))
-        val_loader = gluon.data.DataLoader(
-            self.val_dataset.transform(SSDDefaultValTransform(self.width, self.height)),
-            batch_size, False, batchify_fn=val_batchify_fn, last_batch='keep', num_workers=self.num_workers)
-        self.val_loader = val_loader
+
+        # the val record file is only required by validate()
+        if load_val_set:
+            self.val_dataset = open_record_dataset(self.val_file)
+            
+            # Val verdadeiro: decoded and transformed once into the validation cache folder
+            val_loader = MappedValidationSet(self.val_dataset, self.val_file, self.width, self.height, batch_size,
+                                             data_common['validation_cache_folder'], num_workers=self.num_workers)
+            self.val_loader = val_loader
     
     def filter_predictions(self, bounding_boxes, scores, class_IDs):
         threshold = self.threshold
@@ -97,115 +159,16 @@ class Detector:
 
     def validate(self):
         """Test on validation dataset."""
-        val_data = self.val_loader
-        ctx = self.ctx
-        val_metric = self.val_metric
-        nms_threshold = self.nms_threshold
-        validation_threshold = self.validation_threshold
-
-        val_metric.reset()
-        # set nms threshold and topk constraint
         # post_nms = maximum number of objects per image
-        self.net.set_nms(nms_thresh=nms_threshold, nms_topk=200, post_nms=len(self.classes)) # default: iou=0.45 e topk=400
-
-        # allow the MXNet engine to perform graph optimization for best performance.
-        self.net.hybridize(static_alloc=True, static_shape=True)
-
-        # total number of correct prediction by class
-        tp = [0] * len(self.classes)
-        # count the number of gt by class
-        gt_by_class = [0] * len(self.classes)
-        # false positives by class
-        fp = [0] * len(self.classes)
-        # rec and prec by class
-        rec_by_class = [0] * len(self.classes)
-        prec_by_class = [0] * len(self.classes)
-
-        for batch in val_data:
-            batch_size = batch[0].shape[0]
-            data = gluon.utils.split_and_load(batch[0], ctx_list=ctx, batch_axis=0, even_split=False)
-            label = gluon.utils.split_and_load(batch[1], ctx_list=ctx, batch_axis=0, even_split=False)
-
-            det_bboxes = []
-            det_ids = []
-            det_scores = []
-            gt_bboxes = []
-            gt_ids = []
-            gt_difficults = []
-            
-            for x, y in zip(data, label):
-                # get prediction results
-                ids, scores, bboxes = self.net(x)
-                det_ids.append(ids)
-                det_scores.append(scores)
-                # clip to image size
-                det_bboxes.append(bboxes.clip(0, batch[0].shape[2]))
-                # split ground truths
-                gt_ids.append(y.slice_axis(axis=-1, begin=4, end=5))
-                gt_bboxes.append(y.slice_axis(axis=-1, begin=0, end=4))
-                # gt_difficults.append(y.slice_axis(axis=-1, begin=5, end=6) if y.shape[-1] > 5 else None)
-            
-            # update metric
-            val_metric.update(det_bboxes, det_ids, det_scores, gt_bboxes, gt_ids) #, gt_difficults)
-
-            # Get Micro Averaging (precision and recall by each class) in each batch
-            for img in range(batch_size):
-                gt_ids_teste, gt_bboxes_teste = [], []
-                for ids in det_ids[0][img]:
-                    det_ids_number = (int(ids.asnumpy()[0]))
-                    # It is required to check if the predicted class is in the image
-                    # otherwise, count it as a false positive and do not include in the list
-                    if det_ids_number in list(gt_ids[0][img]):
-                        gt_index = list(gt_ids[0][img]).index(det_ids_number)
-                        gt_ids_teste.extend(gt_ids[0][img][gt_index])
-                        gt_bboxes_teste.append(gt_bboxes[0][img][gt_index])
-                    else:
-                        fp[det_ids_number] += 1  # Wrong classification
-
-                xww = 1
-                
-                # count +1 for this class id. It will get the total number of gt by class
-                # It is useful when considering unbalanced datasets
-                for gt_idx in gt_ids[0][img]:
-                    index = int(gt_idx.asnumpy()[0])
-                    gt_by_class[index] += 1
-                
-                for ids in range(len(gt_bboxes_teste)):
-                    det_bbox_ids = det_bboxes[0][img][ids]
-                    det_bbox_ids = det_bbox_ids.asnumpy()
-                    det_bbox_ids = np.expand_dims(det_bbox_ids, axis=0)
-                    predict_ind = int(det_ids[0][img][ids].asnumpy()[0])
-                    
-                    gt_bbox_ids = gt_bboxes_teste[ids]
-                    gt_bbox_ids = gt_bbox_ids.asnumpy()
-                    gt_bbox_ids = np.expand_dims(gt_bbox_ids, axis=0)
-                    gt_ind = int(gt_ids_teste[ids].asnumpy()[0])
-                    
-                    iou = bbox_iou(det_bbox_ids, gt_bbox_ids)
-
-                    # Uncomment the following line if you want to plot the images in each inference to visually  check the tp, fp and fn 
-                    # self.show_images(x, gt_bbox_ids, det_bbox_ids, img)
-                    
-                    # Check if IoU is above the threshold and the class id corresponds to the ground truth
-                    if (iou > validation_threshold) and (predict_ind == gt_ind):
-                        tp[gt_ind] += 1 # Correct classification
-                    else:
-                        fp[predict_ind] += 1  # Wrong classification
-        
-        # calculate the Recall and Precision by class
-        tp = np.array(tp)
-        fp = np.array(fp)
-        # rec and prec according to the micro averaging
-        for i, (gt_value, tp_value) in enumerate(zip(gt_by_class, tp)):
-            rec_by_class[i] += tp_value/gt_value
-
-            # If an element of fp + tp is 0,
-            # the corresponding element of prec[l] is nan.
-            with np.errstate(divide='ignore', invalid='ignore'):
-                prec_by_class[i] += tp_value/(tp_value+fp[i])
-
-        rec, prec = val_metric._recall_prec()
-        return val_metric.get(), rec_by_class, prec_by_class
+        # The detections are cached on disk by params file, val record file and nms settings
+        detections = get_detections(self.net, self.val_loader, self.ctx, self.model_path, self.val_file,
+                                    self.nms_threshold, post_nms=len(self.classes),
+                                    cache_folder=self.detection_cache_folder)
+
+        # each prediction is compared with the first gt of its class only
+        (val_result, rec_by_class, prec_by_class, _, _, _), = evaluate_detections(
+            detections, self.net.classes, [self.validation_threshold], first_gt=True)
+        return val_result, rec_by_class, prec_by_class
     
     def detect(self, image, plot=False):
         image_tensor, image = gcv.data.transforms.presets.ssd.load_test(image, self.width)
@@ -214,46 +177,282 @@ class Detector:
             ax = viz.plot_bbox(image, bboxes[0], scores[0], labels[0], class_names=self.net.classes)
             plt.show()
 
-    def detect_webcam_video(self, video_font):
+    def detect_webcam_video(self, video_font, queue_size=2, drop_frames=True, show_stats=True):
+        """
+        Runs the detector over a webcam or a video file. Capture, pre-processing and inference
+        run in background threads linked by bounded queues, so they overlap with the rendering.
+
+        Arguments:
+            video_font (int or str): webcam device id or video file path
+            queue_size (int, default: 2): size of the queue between two stages
+            drop_frames (bool, default: True): drop the oldest frames when a stage falls behind.
+                Set to False to process every frame of a video file
+            show_stats (bool, default: True): print the FPS and latency of each stage
+        """
         # Load the webcam handler
         cap = cv2.VideoCapture(video_font) # 1 for droid-cam
         time.sleep(1) ### letting the camera autofocus
 
-        axes = None
-        a = cv2.waitKey(0) # close window when ESC is pressed     
-        while a is not 27:
+        def read_frame():
             # Load frame from the camera
             ret, frame = cap.read()
+            return frame if ret else None
 
+        def preprocess(frame):
             # Image pre-processing
             frame = mx.nd.array(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)).astype('uint8')
-            rgb_nd, frame = gcv.data.transforms.presets.ssd.transform_test(frame, short=self.width, max_size=700)
+            return gcv.data.transforms.presets.ssd.transform_test(frame, short=self.width, max_size=700)
 
+        def inference(item):
+            rgb_nd, frame = item
             # Run frame through network
-            class_IDs, scores, bounding_boxes = self.net(rgb_nd.as_in_context(self.ctx))          
-
+            class_IDs, scores, bounding_boxes = self.net(rgb_nd.as_in_context(self.ctx[0]))
+            # the copy to the host also waits for the network output
             fbounding_boxes, fscores, fclass_IDs = self.filter_predictions(bounding_boxes, scores, class_IDs)
-            gcv.utils.viz.cv_plot_image(frame)
+            return frame, fbounding_boxes, fscores, fclass_IDs
+
+        pipeline = StreamingPipeline(read_frame, [('preprocess', preprocess), ('inference', inference)],
+                                     queue_size=queue_size, drop_frames=drop_frames)
+        self.pipeline_stats = pipeline.stats
+        pipeline.start()
+
+        render_stats = StageStats('render')
+        last_print = time.time()
+        for frame, fbounding_boxes, fscores, fclass_IDs in pipeline:
+            tic = time.time()
+            img = frame
             if fclass_IDs.size > 0:
                 # Display the result
                 img = gcv.utils.viz.cv_plot_bbox(frame, fbounding_boxes, fscores, fclass_IDs, class_names=self.net.classes)
-                gcv.utils.viz.cv_plot_image(img)
-            
-            a = cv2.waitKey(1) # close window when ESC is pressed            
-        
+            gcv.utils.viz.cv_plot_image(img)
+            a = cv2.waitKey(1) # close window when ESC is pressed
+            render_stats.update(time.time() - tic)
+
+            if show_stats and time.time() - last_print > 5:
+                print(pipeline.summary() + '\n' + repr(render_stats) + '\n')
+                last_print = time.time()
+            if a == 27:
+                break
+
+        pipeline.stop()
+        pipeline.join()
         cap.release()
         cv2.destroyAllWindows()
 
+    def detect_video_offline(self, video_path, output_path=None, batch_size=8, queue_size=4, score_threshold=None):
+        """
+        Batched inference over a recorded video. The frames are decoded and resized to the network
+        input shape in a background thread and stacked into batches of fixed size (the last batch
+        is padded), so the static_shape hybridized graph is never rebuilt.
+
+        The detections of every frame are saved into a compressed .npz file with the columns:
+            frame (int32), class_id (int16), score (float32), bbox (float32, xmin ymin xmax ymax
+            in the original frame coordinates)
+
+        Arguments:
+            video_path (str): the video file path
+            output_path (str, default: None): the .npz file. Defaults to the video path with .npz extension
+            batch_size (int, default: 8): number of frames per batch
+            queue_size (int, default: 4): number of decoded batches waiting for inference
+            score_threshold (float, default: None): minimum score to save a detection. Defaults to
+                the detector threshold
+
+        Returns:
+            dict: the saved columns
+        """
+        if output_path is None:
+            output_path = os.path.splitext(video_path)[0] + '.npz'
+        if score_threshold is None:
+            score_threshold = self.threshold
+
+        cap = cv2.VideoCapture(video_path)
+        if not cap.isOpened():
+            raise IOError('Could not open the video: {}'.format(video_path))
+        frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        interpolation = cv2.INTER_AREA if frame_width * frame_height > self.width * self.height else cv2.INTER_CUBIC
+        scale = np.array([frame_width / self.width, frame_height / self.height] * 2, dtype=np.float32)
+        next_frame = [0]
+
+        def read_batch():
+            frames = []
+            while len(frames) < batch_size:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                frame = cv2.resize(frame, (self.width, self.height), interpolation=interpolation)
+                frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            if not frames:
+                return None
+            frame_indices = np.arange(next_frame[0], next_frame[0] + len(frames))
+            next_frame[0] += len(frames)
+            # pad the last batch to keep the batch shape of the hybridized graph
+            frames += [frames[-1]] * (batch_size - len(frames))
+            return frame_indices, images_to_batch(frames)
+
+        def inference(item):
+            frame_indices, batch = item
+            class_IDs, scores, bounding_boxes = self.net(mx.nd.array(batch, ctx=self.ctx[0]))
+            num_frames = len(frame_indices)
+            return detections_to_columns(frame_indices, class_IDs.asnumpy()[:num_frames], scores.asnumpy()[:num_frames],
+                                         bounding_boxes.asnumpy()[:num_frames], score_threshold, scale)
+
+        pipeline = StreamingPipeline(read_batch, [('inference', inference)], queue_size=queue_size, drop_frames=False)
+        pipeline.start()
+        tic = time.time()
+        columns = {'frame': [], 'class_id': [], 'score': [], 'bbox': []}
+        for batch_columns in pipeline:
+            for key, value in batch_columns.items():
+                columns[key].append(value)
+        pipeline.join()
+        cap.release()
+
+        columns = {key: np.concatenate(value) if value else np.zeros((0, 4) if key == 'bbox' else 0)
+                   for key, value in columns.items()}
+        np.savez_compressed(output_path, frame_size=np.array([frame_width, frame_height]), fps=fps, **columns)
+        print('Processed {} frames in {:.1f} s ({:.1f} FPS). Detections saved in: {}'.format(
+            next_frame[0], time.time() - tic, next_frame[0] / max(time.time() - tic, 1e-6), output_path))
+        return columns
+
+    def detect_folder(self, image_paths, batch_size=8, num_threads=4, score_threshold=None, skip_unreadable=True):
+        """
+        Batched inference over a list of images, without plotting. The images are decoded by a
+        thread pool and letterboxed to the network input shape while the previous batch runs
+        through the network.
+
+        Arguments:
+            image_paths (list): image file paths
+            batch_size (int, default: 8): number of images per batch (the last batch is padded)
+            num_threads (int, default: 4): number of decoding threads
+            score_threshold (float, default: None): minimum score to keep a detection. Defaults to
+                the detector threshold
+            skip_unreadable (bool, default: True): report and skip the images that can not be read
+                (missing or corrupt files). Otherwise an IOError is raised
+
+        Yields:
+            tuple: (image_path, class_IDs, scores, bounding_boxes) for each image, with the boxes
+                in the original image coordinates
+        """
+        if score_threshold is None:
+            score_threshold = self.threshold
+        image_paths = list(image_paths)
+        next_image = [0]
+
+        def load(path):
+            image = cv2.imread(path)
+            if image is None:
+                if not skip_unreadable:
+                    raise IOError('Could not read the image: {}'.format(path))
+                print('Skipping the image that could not be read: {}'.format(path))
+                return None
+            return letterbox_image(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), self.width, self.height)
+
+        executor = ThreadPoolExecutor(max_workers=num_threads)
+
+        def read_batch():
+            # the errors of load() are raised again by the pipeline iteration
+            while next_image[0] < len(image_paths):
+                paths = image_paths[next_image[0]:next_image[0] + batch_size]
+                next_image[0] += len(paths)
+                loaded = [(path, item) for path, item in zip(paths, executor.map(load, paths)) if item is not None]
+                if not loaded:
+                    continue
+                paths = [path for path, _ in loaded]
+                images, scales, offsets = zip(*[item for _, item in loaded])
+                images = list(images) + [images[-1]] * (batch_size - len(images))
+                return paths, images_to_batch(images), np.array(scales), np.array(offsets)
+            return None
+
+        def inference(item):
+            paths, batch, scales, offsets = item
+            class_IDs, scores, bounding_boxes = self.net(mx.nd.array(batch, ctx=self.ctx[0]))
+            num_images = len(paths)
+            return paths, class_IDs.asnumpy()[:num_images], scores.asnumpy()[:num_images], \
+                bounding_boxes.asnumpy()[:num_images], scales, offsets
+
+        pipeline = StreamingPipeline(read_batch, [('inference', inference)], queue_size=2, drop_frames=False)
+        pipeline.start()
+        try:
+            for paths, class_IDs, scores, bounding_boxes, scales, offsets in pipeline:
+                # undo the letterbox
+                bounding_boxes = (bounding_boxes - np.tile(offsets, 2)[:, None, :]) / scales[:, None, None]
+                for path, ids, score, bboxes in zip(paths, class_IDs[..., 0], scores[..., 0], bounding_boxes):
+                    keep = (ids >= 0) & (score > score_threshold)
+                    yield path, ids[keep], score[keep], bboxes[keep]
+        finally:
+            pipeline.stop()
+            pipeline.join()
+            executor.shutdown()
+
+    def start_micro_batcher(self, max_batch_size=8, max_wait_ms=5, warm_up=True):
+        """
+        Starts a micro-batcher so concurrent detect_async() calls (e.g. from several threads of the
+        grasping controller) run through the network in a single batch.
+
+        Arguments:
+            max_batch_size (int, default: 8): maximum number of images per batch. The batches are
+                padded to this size to keep the static shape of the hybridized graph
+            max_wait_ms (float, default: 5): maximum time to wait for more requests after the first one
+            warm_up (bool, default: True): run a dummy batch so the graph is built before the first request
+
+        Returns:
+            MicroBatcher: the batcher. Its queue depth and batch fill ratio are in micro_batcher.stats
+        """
+        self.stop_micro_batcher()
+        if warm_up:
+            self.net(mx.nd.zeros((max_batch_size, 3, self.height, self.width), ctx=self.ctx[0]))
+            mx.nd.waitall()
+        self.micro_batcher = MicroBatcher(self._detect_micro_batch, max_batch_size, max_wait_ms).start()
+        return self.micro_batcher
+
+    def stop_micro_batcher(self):
+        if self.micro_batcher is not None:
+            self.micro_batcher.stop()
+            self.micro_batcher = None
+
+    def detect_async(self, image):
+        """
+        Queues an image in the micro-batcher started by start_micro_batcher(). The letterbox runs in the
+        calling thread.
+
+        Arguments:
+            image (np.ndarray): RGB uint8 image
+
+        Returns:
+            Future: resolves to (class_IDs, scores, bounding_boxes), with the boxes in the image coordinates
+        """
+        if self.micro_batcher is None:
+            raise RuntimeError('The micro-batcher is not running. Call start_micro_batcher() first.')
+        return self.micro_batcher.submit(letterbox_image(image, self.width, self.height))
+
+    def _detect_micro_batch(self, items):
+        images = [image for image, _, _ in items]
+        # pad the batch to keep the static shape of the hybridized graph
+        images += [images[-1]] * (self.micro_batcher.max_batch_size - len(images))
+        class_IDs, scores, bounding_boxes = self.net(mx.nd.array(images_to_batch(images), ctx=self.ctx[0]))
+        class_IDs, scores, bounding_boxes = class_IDs.asnumpy(), scores.asnumpy(), bounding_boxes.asnumpy()
+
+        results = []
+        for i, (_, scale, (pad_x, pad_y)) in enumerate(items):
+            ids, score = class_IDs[i, :, 0], scores[i, :, 0]
+            keep = (ids >= 0) & (score > self.threshold)
+            # undo the letterbox
+            bboxes = (bounding_boxes[i][keep] - np.array([pad_x, pad_y, pad_x, pad_y])) / scale
+            results.append((ids[keep], score[keep], bboxes))
+        return results
+
 def main():
     # TODO: You just need to pass the param name inside the log folder (checkpoints folder configured in config.json)
     params = 'ssd_300_vgg16_atrous_voc_best_epoch_0025_map_0.8749.params'
 
-    det = Detector(params, model='ssd300_vgg16_voc', ctx='gpu', threshold=0.1, device_id=1, batch_size=4, num_workers=2, nms_threshold=0.5)
+    det = Detector(params, model='ssd_300_vgg16_atrous_voc', ctx='gpu', threshold=0.1, device_id=1, batch_size=4, num_workers=2, nms_threshold=0.5)
 
     print("\nPlease configure the video/images files path in config.json before running the next command.")    
 
     a = int(input("Choose an option: \n[1] - Perform testing in images \n[2] - Perform testing in videos \n[3] - Perform testing using webcam\
-        \n[4] - Perform only validation using a pre-trained network and a .rec val file\nOption: "))
+        \n[4] - Perform only validation using a pre-trained network and a .rec val file\
+        \n[5] - Perform batched testing in images and save the detections (no plot)\nOption: "))
     
     if a == 1:
         images = glob.glob(data_common['image_folder'] + "/" + "*.jpg")
@@ -262,13 +461,32 @@ def main():
     elif a == 2:
         file_name = str(input("Write the video file name with the extension (!!) that is inside the video folder configured in the config.json file: "))
         file_name = glob.glob(data_common['video_folder'] + "/" + file_name)[0]
-        det.detect_webcam_video(file_name)
+        offline = str(input("Run the batched offline mode and save the detections instead of showing them? [y/n]: "))
+        if offline.lower() == 'y':
+            det.detect_video_offline(file_name)
+        else:
+            det.detect_webcam_video(file_name)
     elif a == 3:
         device_id = int(input("Choose the device id to connect (default: 0): "))
         det.detect_webcam_video(device_id)
     elif a == 4:
         input("Please configure the val.rec file path in the config.json. Press enter to continue.")
         det.validate()
+    elif a == 5:
+        images = sorted(glob.glob(data_common['image_folder'] + "/" + "*.jpg"))
+        output_path = os.path.join(data_common['image_folder'], 'detections.npz')
+        columns = {'image': [], 'class_id': [], 'score': [], 'bbox': []}
+        image_index = {image: i for i, image in enumerate(images)}
+        # the unreadable images are skipped, so the index comes from the path
+        for image, class_IDs, scores, bounding_boxes in det.detect_folder(images):
+            columns['image'].append(np.full(len(class_IDs), image_index[image], dtype=np.int32))
+            columns['class_id'].append(class_IDs.astype(np.int16))
+            columns['score'].append(scores.astype(np.float32))
+            columns['bbox'].append(bounding_boxes.astype(np.float32))
+        columns = {key: np.concatenate(value) if value else np.zeros((0, 4) if key == 'bbox' else 0)
+                   for key, value in columns.items()}
+        np.savez_compressed(output_path, image_names=np.array([os.path.basename(x) for x in images]), **columns)
+        print('Detections saved in: ', output_path)
     else:
         print("Please choose the right option")
 
@@ -18,7 +18,6 @@ from gluoncv.data.transforms.presets.ssd import SSDDefaultTrainTransform
 from gluoncv.data.transforms.presets.ssd import SSDDefaultValTransform
 from gluoncv.utils.metrics.voc_detection import VOC07MApMetric
 # from gluoncv.utils.metrics.coco_detection import COCODetectionMetric
-from gluoncv.utils.bbox import bbox_iou 
 from mxnet.contrib import amp
 import cv2
 
@@ -26,6 +25,11 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..')))
 import utils.common as dataset_commons
 from utils.ssd_custom_val_transform import SSDCustomValTransform
+from utils.ssd_target_cache import CachedTargetDataset, cached_target_dataset, target_files
+from utils.validation_cache import MappedValidationSet
+from utils.detection_matching import DetectionMatcher, as_numpy
+from utils.fused_validation import SSDValidationOutputs
+from utils.sharded_record import open_record_dataset
 import utils.environments_setup # must be imported before NEPTUNE
 import neptune
 
@@ -54,7 +58,8 @@ class training_network():
                  lr_decay=0.1, lr_decay_epoch='60, 80', wd=0.0005, momentum=0.9, start_epoch=0,
                  epochs=2, dataset='voc', network='vgg16_atrous', resume='',
                  beta1=0.9, beta2=0.999, epsilon=1e-08, validation_threshold=0.5, nms_threshold=0.5, optimizer='sgd', 
-                 exp=False):
+                 exp=False, cache_targets=True, train_augmentation=True, cache_validation=True,
+                 fused_validation=True):
         """
         Script responsible for training the class
 
@@ -74,6 +79,15 @@ class training_network():
             batch_size (int, default: 4): Training mini-batch size
             data_shape (int, default: 300): Input data shape, use 300, 512.
             network (str, default:'vgg16_atrous'): Base network name which serves as feature extraction base.
+            cache_targets (bool, default: True): SSD only. Computes the targets of the validation loss
+                samples once and reads them from the target cache folder in the following epochs
+            train_augmentation (bool, default: True): SSD only. If False, the training samples are
+                not augmented and their targets are also read from the target cache
+            cache_validation (bool, default: True): decodes and transforms the validation set only once,
+                into memory-mapped arrays of the validation cache folder
+            fused_validation (bool, default: True): SSD only. Computes the validation loss and the
+                detections of the mAP metric from a single forward pass of each validation batch.
+                Networks that are not a gluoncv SSD use the two pass validation
         """
 
         # amp.init()
@@ -98,6 +112,10 @@ class training_network():
         self.beta2=beta2
         self.epsilon=epsilon
         self.best_map = 0
+        self.cache_targets = cache_targets
+        self.train_augmentation = train_augmentation
+        self.cache_validation = cache_validation
+        self.fused_validation = fused_validation
 
         if ctx == 'cpu':
             self.ctx = [mx.cpu()]
@@ -144,14 +162,19 @@ class training_network():
 
     def get_dataset(self):
         validation_threshold = self.validation_threshold
-        self.train_dataset = gdata.RecordFileDetection(self.train_file)
-        self.val_dataset = gdata.RecordFileDetection(self.val_file)
+        # the record paths can point to a .rec file or to a .shards.json manifest
+        self.train_dataset = open_record_dataset(self.train_file)
+        self.val_dataset = open_record_dataset(self.val_file)
         # we are only using VOCMetric for evaluation
         self.val_metric = VOC07MApMetric(iou_thresh=validation_threshold, class_names=self.net.classes)
 
     def show_summary(self):
         self.net.summary(mx.nd.ones((1, 3, self.height, self.width)))
 
+    def mapped_validation_set(self):
+        return MappedValidationSet(self.val_dataset, self.val_file, self.width, self.height, self.batch_size,
+                                   data_common['validation_cache_folder'], num_workers=self.num_workers)
+
     def get_dataloader(self):
         width, height = self.width, self.height
         train_dataset = self.train_dataset
@@ -166,30 +189,63 @@ class training_network():
                 _, _, anchors = self.net(mx.nd.zeros((1, 3, height, width)))
 
             batchify_fn = Tuple(Stack(), Stack(), Stack())  # stack image, cls_targets, box_targets
-            train_loader = gluon.data.DataLoader(train_dataset.transform(SSDDefaultTrainTransform(width, height, anchors)),
+            if self.train_augmentation:
+                train_transformed = train_dataset.transform(SSDDefaultTrainTransform(width, height, anchors))
+            else:
+                # without augmentation the targets are the same every epoch
+                train_transformed = cached_target_dataset(train_dataset, self.train_file, width, height, anchors,
+                                                          data_common['target_cache_folder'], num_workers)
+            train_loader = gluon.data.DataLoader(train_transformed,
                                                  batch_size, True, 
                                                  batchify_fn=batchify_fn, 
                                                  last_batch='rollover', 
                                                  num_workers=num_workers)
 
             # Val verdadeiro
-            val_batchify_fn = Tuple(Stack(), Pad(pad_val=-1))
-            val_loader = gluon.data.DataLoader(val_dataset.transform(SSDDefaultValTransform(width, height)),
-                                               batch_size, False, 
-                                               batchify_fn=val_batchify_fn, 
-                                               last_batch='keep', 
-                                               num_workers=num_workers)
+            if self.cache_validation:
+                val_loader = self.mapped_validation_set()
+            else:
+                val_batchify_fn = Tuple(Stack(), Pad(pad_val=-1))
+                val_loader = gluon.data.DataLoader(val_dataset.transform(SSDDefaultValTransform(width, height)),
+                                                   batch_size, False, 
+                                                   batchify_fn=val_batchify_fn, 
+                                                   last_batch='keep', 
+                                                   num_workers=num_workers)
           
             # use fake data to generate fixed anchors for target generation
             with mx.Context(mx.gpu(0)):
                 anchors2 = anchors
 
-            val_loader_loss = gluon.data.DataLoader(val_dataset.transform(SSDCustomValTransform(width, height, anchors2)),
-                                                    batch_size, True, 
-                                                    batchify_fn=batchify_fn, 
-                                                    last_batch='rollover', 
-                                                    num_workers=num_workers)
+            if self.cache_targets:
+                # the validation samples are not augmented: compute their targets only once
+                cls_path, box_path = target_files(val_dataset, self.val_file, width, height, anchors2,
+                                                  data_common['target_cache_folder'], num_workers)
+            if self.cache_targets and self.cache_validation:
+                # images and targets sliced from the cached arrays
+                val_loader_loss = val_loader.with_targets(cls_path, box_path)
+            else:
+                if self.cache_targets:
+                    val_loss_dataset = CachedTargetDataset(val_dataset, width, height, cls_path, box_path)
+                else:
+                    val_loss_dataset = val_dataset.transform(SSDCustomValTransform(width, height, anchors2))
+                val_loader_loss = gluon.data.DataLoader(val_loss_dataset,
+                                                        batch_size, True, 
+                                                        batchify_fn=batchify_fn, 
+                                                        last_batch='rollover', 
+                                                        num_workers=num_workers)
             self.val_loader_loss = val_loader_loss
+
+            # images, labels and targets of the single pass validation
+            if self.cache_targets and self.cache_validation:
+                val_loader_fused = val_loader.with_targets(cls_path, box_path, with_labels=True)
+            else:
+                val_loader_fused = gluon.data.DataLoader(
+                    val_dataset.transform(SSDCustomValTransform(width, height, anchors2, return_label=True)),
+                    batch_size, False,
+                    batchify_fn=Tuple(Stack(), Pad(pad_val=-1), Stack(), Stack()),
+                    last_batch='keep',
+                    num_workers=num_workers)
+            self.val_loader_fused = val_loader_fused
         elif network == 'yolo':
             print('aqui 1')
             batchify_fn = Tuple(*([Stack() for _ in range(6)] + [Pad(axis=0, pad_val=-1) for _ in range(1)]))  # stack image, all targets generated
@@ -200,12 +256,16 @@ class training_network():
                                                  last_batch='rollover', 
                                                  num_workers=num_workers)
 
-            val_batchify_fn = Tuple(Stack(), Pad(pad_val=-1))
-            val_loader = gluon.data.DataLoader(val_dataset.transform(YOLO3DefaultValTransform(width, height)),
-                                               batch_size, False, 
-                                               batchify_fn=val_batchify_fn, 
-                                               last_batch='keep', 
-                                               num_workers=num_workers)
+            if self.cache_validation:
+                # same images and labels as YOLO3DefaultValTransform
+                val_loader = self.mapped_validation_set()
+            else:
+                val_batchify_fn = Tuple(Stack(), Pad(pad_val=-1))
+                val_loader = gluon.data.DataLoader(val_dataset.transform(YOLO3DefaultValTransform(width, height)),
+                                                   batch_size, False, 
+                                                   batchify_fn=val_batchify_fn, 
+                                                   last_batch='keep', 
+                                                   num_workers=num_workers)
             print('aqui 2')
         else:
             raise ValueError("Network {} not implemented".format(network))
@@ -238,16 +298,25 @@ class training_network():
         ce_metric.reset() # Resets the internal evaluation result to initial state.
         smoothl1_metric.reset() # Resets the internal evaluation result to initial state.
 
+        # class and box predictions of the anchors (net(x) returns the detections out of training mode)
+        outputs = SSDValidationOutputs(self.net) if SSDValidationOutputs.supports(self.net) else None
+
         for i, batch in enumerate(val_data):
             batch_size = batch[0].shape[0]
-            data = gluon.utils.split_and_load(batch[0], ctx_list=ctx, batch_axis=0)
-            cls_targets = gluon.utils.split_and_load(batch[1], ctx_list=ctx, batch_axis=0)
-            box_targets = gluon.utils.split_and_load(batch[2], ctx_list=ctx, batch_axis=0)
+            # the cached validation set keeps the last (smaller) batch
+            data = gluon.utils.split_and_load(batch[0], ctx_list=ctx, batch_axis=0, even_split=False)
+            cls_targets = gluon.utils.split_and_load(batch[1], ctx_list=ctx, batch_axis=0, even_split=False)
+            box_targets = gluon.utils.split_and_load(batch[2], ctx_list=ctx, batch_axis=0, even_split=False)
 
             cls_preds = []
             box_preds = []
             for x in data:
-                cls_pred, box_pred, _ = self.net(x)
+                if outputs is not None:
+                    cls_pred, box_pred, _ = outputs.predictions(x)
+                else:
+                    # other SSD implementations: the training mode outputs
+                    with autograd.train_mode():
+                        cls_pred, box_pred, _ = self.net(x)
                 cls_preds.append(cls_pred)
                 box_preds.append(box_pred)
                 # descobrir o id de cada ifnerência pra usar no iou
@@ -255,14 +324,83 @@ class training_network():
             sum_loss, cls_loss, box_loss = mbox_loss(
                 cls_preds, box_preds, cls_targets, box_targets)
         
-        ce_metric.update(0, [l * batch_size for l in cls_loss])
-        smoothl1_metric.update(0, [l * batch_size for l in box_loss])
+            ce_metric.update(0, [l * batch_size for l in cls_loss])
+            smoothl1_metric.update(0, [l * batch_size for l in box_loss])
 
         name1, loss1 = ce_metric.get()
         name2, loss2 = smoothl1_metric.get()
 
         return name1, loss1, name2, loss2
 
+    def validate_fused(self):
+        """
+        SSD validation loss and mAP from a single forward pass of each validation batch.
+
+        Returns:
+            tuple: the val_loss() and validate() results
+        """
+        val_data = self.val_loader_fused
+        ctx = self.ctx
+        val_metric = self.val_metric
+        nms_threshold = self.nms_threshold
+        validation_threshold = self.validation_threshold
+
+        mbox_loss = gcv.loss.SSDMultiBoxLoss()
+        ce_metric = mx.metric.Loss('CrossEntropy')
+        smoothl1_metric = mx.metric.Loss('SmoothL1')
+        val_metric.reset()
+
+        # same nms settings as validate()
+        self.net.set_nms(nms_thresh=nms_threshold, nms_topk=200, post_nms=len(self.classes))
+        self.net.hybridize(static_alloc=True, static_shape=True)
+        outputs = SSDValidationOutputs(self.net)
+
+        matcher = DetectionMatcher(len(self.classes), validation_threshold)
+
+        for batch in val_data:
+            batch_size = batch[0].shape[0]
+            data = gluon.utils.split_and_load(batch[0], ctx_list=ctx, batch_axis=0, even_split=False)
+            label = gluon.utils.split_and_load(batch[1], ctx_list=ctx, batch_axis=0, even_split=False)
+            cls_targets = gluon.utils.split_and_load(batch[2], ctx_list=ctx, batch_axis=0, even_split=False)
+            box_targets = gluon.utils.split_and_load(batch[3], ctx_list=ctx, batch_axis=0, even_split=False)
+
+            cls_preds = []
+            box_preds = []
+            pred_bboxes_list = []
+            pred_label_list = []
+            pred_scores_list = []
+            gt_bboxes_list = []
+            gt_label_list = []
+
+            for x, y in zip(data, label):
+                cls_pred, box_pred, ids, scores, bboxes = outputs(x)
+                cls_preds.append(cls_pred)
+                box_preds.append(box_pred)
+                pred_label_list.append(ids)
+                pred_scores_list.append(scores)
+                # clip to image size
+                pred_bboxes_list.append(bboxes.clip(0, batch[0].shape[2]))
+                # split ground truths
+                gt_label_list.append(y.slice_axis(axis=-1, begin=4, end=5))
+                gt_bboxes_list.append(y.slice_axis(axis=-1, begin=0, end=4))
+
+            # loss of every batch
+            sum_loss, cls_loss, box_loss = mbox_loss(
+                cls_preds, box_preds, cls_targets, box_targets)
+            ce_metric.update(0, [l * batch_size for l in cls_loss])
+            smoothl1_metric.update(0, [l * batch_size for l in box_loss])
+
+            # copy the batch to the host only once and share it between both metrics
+            pred_bboxes, pred_labels, pred_scores, gt_bboxes, gt_labels = [as_numpy(x) for x in (
+                pred_bboxes_list, pred_label_list, pred_scores_list, gt_bboxes_list, gt_label_list)]
+            val_metric.update(pred_bboxes, pred_labels, pred_scores, gt_bboxes, gt_labels)
+            matcher.update(pred_bboxes, pred_labels, gt_bboxes, gt_labels)
+
+        name1, loss1 = ce_metric.get()
+        name2, loss2 = smoothl1_metric.get()
+        rec_by_class, prec_by_class, fp_sum, tp_sum, confusion_matrix = matcher.get()
+        return (name1, loss1, name2, loss2), (val_metric.get(), rec_by_class, prec_by_class)
+
     def validate(self):
         """Test on validation dataset."""
         val_data = self.val_loader
@@ -282,20 +420,9 @@ class training_network():
         # allow the MXNet engine to perform graph optimization for best performance.
         self.net.hybridize(static_alloc=True, static_shape=True)
 
-        num_of_classes = len(self.classes)
-        # total number of correct prediction by class
-        tp = [0] * num_of_classes
-        # false positives by class
-        fp = [0] * num_of_classes
-        # count the number of gt by class
-        gt_by_class = [0] * num_of_classes
-        # rec and prec by class
-        rec_by_class = [0] * num_of_classes
-        prec_by_class = [0] * num_of_classes
-        confusion_matrix = np.zeros((num_of_classes, num_of_classes))
+        matcher = DetectionMatcher(len(self.classes), validation_threshold)
 
         for batch in val_data:
-            batch_size = batch[0].shape[0]
             data = gluon.utils.split_and_load(batch[0], ctx_list=ctx, batch_axis=0, even_split=False)
             label = gluon.utils.split_and_load(batch[1], ctx_list=ctx, batch_axis=0, even_split=False)
 
@@ -319,57 +446,17 @@ class training_network():
             # Uncomment the following line if you want to plot the images in each inference to visually  check the tp, fp and fn 
             # self.show_images(x, pred_label_list, pred_bboxes_list, gt_label_list, gt_bboxes_list)
             
+            # copy the batch to the host only once and share it between both metrics
+            pred_bboxes, pred_labels, pred_scores, gt_bboxes, gt_labels = [as_numpy(x) for x in (
+                pred_bboxes_list, pred_label_list, pred_scores_list, gt_bboxes_list, gt_label_list)]
+
             # update metric
-            val_metric.update(pred_bboxes_list, pred_label_list, pred_scores_list, gt_bboxes_list, gt_label_list) #, gt_difficults)
+            val_metric.update(pred_bboxes, pred_labels, pred_scores, gt_bboxes, gt_labels) #, gt_difficults)
             
             # Get Micro Averaging (precision and recall by each class) in each batch
-            for img in range(batch_size):
-                # count +1 for this class id. It will get the total number of gt by class
-                # It is useful when considering unbalanced datasets
-                for gt_idx in gt_label_list[0][img]:
-                    index = int(gt_idx.asnumpy()[0])
-                    gt_by_class[index] += 1
-            
-                for (pred_label, pred_bbox) in zip(pred_label_list[0][img], list(pred_bboxes_list[0][img])):
-                    pred_label = int(pred_label.asnumpy()[0])
-                    pred_bbox = pred_bbox.asnumpy()
-                    pred_bbox = np.expand_dims(pred_bbox, axis=0)
-                    match = 0
-                    for (gt_bbox_label, gt_bbox_coordinates) in zip(gt_label_list[0][img], list(gt_bboxes_list[0][img])):
-                        gt_bbox_coord = gt_bbox_coordinates.asnumpy()
-                        gt_bbox_coord = np.expand_dims(gt_bbox_coord, axis=0)
-                        gt_bbox_label = int(gt_bbox_label.asnumpy()[0])
-                        iou = bbox_iou(pred_bbox, gt_bbox_coord)
-                        
-                        # Correct inference
-                        if iou > validation_threshold and pred_label == gt_bbox_label:
-                            confusion_matrix[gt_bbox_label][pred_label] += 1
-                            tp[gt_bbox_label] += 1 # Correct classification
-                            match = 1
-                        # Incorrect inference - missed the correct class but put the bounding box in other class
-                        elif iou > validation_threshold:
-                            confusion_matrix[gt_bbox_label][pred_label] += 1
-                            fp[pred_label] += 1
-                            match = 1
-                        
-                    if not match:
-                        fp[pred_label] += 1
-                                
-        # calculate the Recall and Precision by class
-        tp = np.array(tp) # we can also sum the matrix diagonal
-        fp = np.array(fp)
-        
-        fp_sum = sum(fp)
-        tp_sum = sum(tp)
-
-        # rec and prec according to the micro averaging
-        for i, (gt_value, tp_value) in enumerate(zip(gt_by_class, tp)):
-            rec_by_class[i] += tp_value/gt_value
-            # If an element of fp + tp is 0,
-            # the corresponding element of prec[l] is nan.
-            with np.errstate(divide='ignore', invalid='ignore'):
-                prec_by_class[i] += tp_value/(tp_value+fp[i])
+            matcher.update(pred_bboxes, pred_labels, gt_bboxes, gt_labels)
 
+        rec_by_class, prec_by_class, fp_sum, tp_sum, confusion_matrix = matcher.get()
         return val_metric.get(), rec_by_class, prec_by_class
 
     def create_optimizer(self):
@@ -390,9 +477,12 @@ class training_network():
                                     {'learning_rate': lr, 'beta1': beta1, 'beta2': beta2, 
                                      'epsilon': epsilon})
 
-    def validate_main(self, epoch):
+    def validate_main(self, epoch, results=None):
         # consider reduce the frequency of validation to save time
-        (map_name, mean_ap), rec_by_class, prec_by_class = self.validate()
+        # results: validate() output already computed (e.g. by validate_fused())
+        if results is None:
+            results = self.validate()
+        (map_name, mean_ap), rec_by_class, prec_by_class = results
         val_msg = '\n'.join(['{}={}'.format(k, v) for k, v in zip(map_name, mean_ap)])
         
         for i, class_name in enumerate(self.classes):
@@ -496,13 +586,18 @@ class training_network():
                 epoch, (time.time()-tic)/60, name1, loss1, name2, loss2))
 
             # log SSD LOSS            
-            val_name1, val_loss1, val_name2, val_loss2 = self.val_loss()
+            if self.fused_validation and SSDValidationOutputs.supports(self.net):
+                # loss and mAP from the same forward pass
+                (val_name1, val_loss1, val_name2, val_loss2), results = self.validate_fused()
+            else:
+                val_name1, val_loss1, val_name2, val_loss2 = self.val_loss()
+                results = None
             current_val_loss = val_loss1 + val_loss2
             experiment.log_metric('cross_entropy_validation_loss', epoch, val_loss1)
             experiment.log_metric('smooth_l1_validation_loss', epoch, val_loss2) 
             experiment.log_metric('validation_sum_loss', epoch, current_val_loss) 
 
-            self.validate_main(epoch)
+            self.validate_main(epoch, results)
         
         # Displays the total time of the training
         print('Train time {:.3f}'.format(time.time() - start_train_time))
@@ -0,0 +1,280 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+'''
+Columnar store of the bounding box annotations of a dataset.
+
+The annotations are kept in contiguous numpy arrays, grouped per image:
+    names     (num_images,) image names
+    offsets   (num_images + 1,) int64: the boxes of the image i are boxes[offsets[i]:offsets[i + 1]]
+    boxes     (num_boxes, 4) float64 xmin, ymin, xmax, ymax
+    labels    (num_boxes,) int32 index in label_names
+    sizes     (num_images, 2) int32 height and width of each image, -1 when unknown
+    rows      (num_boxes,) int64 row of each box in the imported csv (optional)
+so the annotations of any image are sliced in O(1) without pandas.
+
+A store is saved as a folder with one .npy file per array and a meta.json file
+with the label names. The box, label, offset and size arrays are opened with
+np.load(mmap_mode='r'), so opening a store of millions of boxes is immediate
+and only the slices read are loaded from disk.
+
+The csv files (image,xmin,ymin,xmax,ymax,label[,height,width]) are the import
+and export format: open_annotations accepts a csv file or a store folder. The
+types of the coordinate and size columns of the imported csv are kept (in
+meta.json for a saved store), so the exported csv has the same values.
+'''
+
+STORE_VERSION = 1
+CSV_COLUMNS = ['image', 'xmin', 'ymin', 'xmax', 'ymax', 'label']
+ARRAY_NAMES = ['offsets', 'boxes', 'labels', 'sizes']
+BOX_COLUMNS = ['xmin', 'ymin', 'xmax', 'ymax']
+SIZE_COLUMNS = ['height', 'width']
+
+class AnnotationStore(object):
+    """
+    Bounding box annotations grouped per image.
+
+    Arguments:
+        names (np.ndarray): (num_images,) image names
+        offsets (np.ndarray): (num_images + 1,) offsets of the boxes of each image
+        boxes (np.ndarray): (num_boxes, 4) xmin, ymin, xmax, ymax
+        labels (np.ndarray): (num_boxes,) index of the label of each box in label_names
+        label_names (list): the label names
+        sizes (np.ndarray, default: None): (num_images, 2) height and width of each image
+        column_types (dict, default: None): numpy type of the box and size columns of the
+            imported csv ({column: type name}), used by to_dataframe
+        rows (np.ndarray, default: None): (num_boxes,) row of each box in the imported csv
+    """
+    def __init__(self, names, offsets, boxes, labels, label_names, sizes=None, column_types=None, rows=None):
+        if sizes is None:
+            sizes = np.full((len(names), 2), -1, dtype=np.int32)
+        self.names = names
+        self.offsets = offsets
+        self.boxes = boxes
+        self.labels = labels
+        self.label_names = list(label_names)
+        self.sizes = sizes
+        self.column_types = dict(column_types or {})
+        self.rows = rows
+        self._index = None
+
+    @classmethod
+    def from_dataframe(cls, data, classes=None, sort=False):
+        """
+        Builds a store from a DataFrame with the csv columns.
+
+        Arguments:
+            data (DataFrame): one row per bounding box. The optional height and width
+                columns give the image sizes
+            classes (dict or list, default: None): the label names, ordered by class id (e.g. the
+                classes of config.json). Defaults to the labels in the order of their first appearance
+            sort (bool, default: False): sort the images by name instead of keeping the
+                order of their first appearance. The boxes of each image keep the row order
+        """
+        image_codes, names = pd.factorize(data['image'].values.astype(str), sort=sort)
+        label_values = data['label'].values.astype(str)
+        if classes is None:
+            label_codes, label_names = pd.factorize(label_values)
+        else:
+            label_names = sorted(classes, key=classes.get) if isinstance(classes, dict) else list(classes)
+            label_codes = pd.Categorical(label_values, categories=label_names).codes
+            if (label_codes < 0).any():
+                raise ValueError('Labels not in the classes: {}'.format(
+                    sorted(set(label_values[label_codes < 0]))))
+
+        order = np.argsort(image_codes, kind='mergesort')
+        counts = np.bincount(image_codes, minlength=len(names))
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        box_columns = data[BOX_COLUMNS].apply(pd.to_numeric)
+        boxes = box_columns.values.astype(np.float64)[order]
+        column_types = {column: box_columns[column].dtype.name for column in BOX_COLUMNS}
+
+        sizes = np.full((len(names), 2), -1, dtype=np.int32)
+        if 'height' in data and 'width' in data:
+            size_columns = data[SIZE_COLUMNS].apply(pd.to_numeric, errors='coerce')
+            sizes[image_codes] = size_columns.fillna(-1).values.astype(np.int32)
+            column_types.update((column, size_columns[column].dtype.name) for column in SIZE_COLUMNS)
+
+        return cls(np.asarray(names, dtype=str), offsets, boxes, np.asarray(label_codes, dtype=np.int32)[order],
+                   label_names, sizes, column_types, order.astype(np.int64))
+
+    @classmethod
+    def from_csv(cls, csv_path, classes=None, sort=False):
+        """Imports a csv file. See from_dataframe."""
+        return cls.from_dataframe(pd.read_csv(csv_path), classes, sort)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Opens a store saved by save().
+
+        Arguments:
+            path (str): the store folder
+            mmap (bool, default: True): memory-map the arrays instead of reading them
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != STORE_VERSION:
+            raise ValueError('Unsupported annotation store version: {}'.format(meta['version']))
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None)
+                  for name in ARRAY_NAMES}
+        names = np.char.decode(np.load(os.path.join(path, 'names.npy')), 'utf-8')
+        rows_path = os.path.join(path, 'rows.npy')
+        rows = np.load(rows_path, mmap_mode='r' if mmap else None) if os.path.exists(rows_path) else None
+        return cls(names, arrays['offsets'], arrays['boxes'], arrays['labels'], meta['label_names'], arrays['sizes'],
+                   meta.get('column_types'), rows)
+
+    def save(self, path):
+        """Saves the store into a folder. An existing store in the same folder is replaced."""
+        tmp_path = path.rstrip('/\\') + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, 'names.npy'), np.char.encode(np.asarray(self.names, dtype=str), 'utf-8'))
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(tmp_path, name + '.npy'), np.ascontiguousarray(getattr(self, name)))
+        if self.rows is not None:
+            np.save(os.path.join(tmp_path, 'rows.npy'), np.ascontiguousarray(self.rows))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'version': STORE_VERSION, 'label_names': self.label_names, 'column_types': self.column_types,
+                       'num_images': len(self), 'num_boxes': self.num_boxes}, f, indent=2)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def num_boxes(self):
+        return int(self.offsets[-1])
+
+    @property
+    def counts(self):
+        """Number of boxes of each image."""
+        return np.diff(self.offsets)
+
+    def image_boxes(self, idx):
+        return self.boxes[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def image_labels(self, idx):
+        return self.labels[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def __getitem__(self, idx):
+        """Returns the name, the (M, 4) boxes and the (M,) label indices of the image idx."""
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.names[idx], self.boxes[start:end], self.labels[start:end]
+
+    def index(self, name):
+        """Index of an image from its name."""
+        if self._index is None:
+            self._index = {name: i for i, name in enumerate(self.names)}
+        return self._index[name]
+
+    def box_images(self):
+        """Index of the image of each box."""
+        return np.repeat(np.arange(len(self)), self.counts)
+
+    def check_labels(self, classes):
+        """Raises a ValueError if some boxes have a label that is not in the classes."""
+        used = np.unique(self.labels) if self.num_boxes else []
+        unknown = sorted(set(self.label_names[i] for i in used) - set(classes))
+        if unknown:
+            raise ValueError('Labels not in the classes: {}'.format(unknown))
+
+    def label_ids(self, classes, missing=-1):
+        """Class id of each box from a {label name: class id} dict (missing for the other labels)."""
+        return np.array([classes.get(name, missing) for name in self.label_names])[self.labels]
+
+    def select(self, image_indices):
+        """Returns a new store with the given images, in the given order."""
+        image_indices = np.asarray(image_indices, dtype=np.int64)
+        counts = self.counts[image_indices]
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        # index of each selected box in the current arrays
+        rows = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - self.offsets[image_indices], counts)
+        return AnnotationStore(self.names[image_indices], offsets, np.asarray(self.boxes[rows]),
+                               np.asarray(self.labels[rows]), self.label_names, np.asarray(self.sizes[image_indices]),
+                               self.column_types, None if self.rows is None else np.asarray(self.rows[rows]))
+
+    def sorted_by_name(self):
+        return self.select(np.argsort(self.names, kind='mergesort'))
+
+    def _column(self, column, values, known=None):
+        if known is not None and not known.all():
+            # the unknown sizes are written as empty values
+            return np.where(known, values, np.nan)
+        # the type of the imported csv column, otherwise integers when all the values are
+        column_type = self.column_types.get(column)
+        if column_type is not None and np.dtype(column_type).kind == 'f':
+            return values
+        return values.astype(np.int64) if np.array_equal(values, np.round(values)) else values
+
+    def to_dataframe(self, row_order=False):
+        """
+        Exports the annotations as a DataFrame with the csv columns, one row per box.
+        The coordinates and sizes keep the type of the imported csv columns (otherwise they are
+        written as integers when they all are). The height and width columns are added when the
+        imported csv had them or when all the image sizes are known.
+
+        Arguments:
+            row_order (bool, default: False): keep the row order of the imported csv instead of
+                grouping the boxes per image (when the store was imported from a csv)
+        """
+        boxes = np.asarray(self.boxes, dtype=np.float64)
+        box_images = self.box_images()
+        data = pd.DataFrame({'image': self.names[box_images],
+                             'label': np.array(self.label_names, dtype=object)[self.labels]},
+                            columns=CSV_COLUMNS)
+        for i, column in enumerate(BOX_COLUMNS):
+            data[column] = self._column(column, boxes[:, i])
+        sizes = np.asarray(self.sizes)[box_images]
+        if all(column in self.column_types for column in SIZE_COLUMNS) or (len(self) and (sizes >= 0).all()):
+            for i, column in enumerate(SIZE_COLUMNS):
+                data[column] = self._column(column, sizes[:, i].astype(np.float64), sizes[:, i] >= 0)
+        if row_order and self.rows is not None:
+            data = data.iloc[np.argsort(self.rows, kind='mergesort')].reset_index(drop=True)
+        return data
+
+    def to_csv(self, csv_path):
+        self.to_dataframe().to_csv(csv_path, index=None)
+
+def is_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+def open_annotations(path, classes=None, sort=False):
+    """
+    Opens the annotations of a csv file or of a store folder.
+
+    Arguments:
+        path (str): the .csv file or the store folder
+        classes (dict or list, default: None): label names of the csv import. See
+            AnnotationStore.from_dataframe. A ValueError is raised if a box has another label
+        sort (bool, default: False): sort the images by name
+    """
+    if is_store(path):
+        store = AnnotationStore.load(path)
+        if classes is not None:
+            store.check_labels(classes)
+        return store.sorted_by_name() if sort else store
+    return AnnotationStore.from_csv(path, classes, sort)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Converts a csv file into an annotation store or a store into a csv file.')
+    parser.add_argument('source', help='the .csv file or the store folder')
+    parser.add_argument('target', help='the store folder or the .csv file')
+    args = parser.parse_args()
+
+    annotations = open_annotations(args.source)
+    if is_store(args.source):
+        annotations.to_csv(args.target)
+    else:
+        annotations.save(args.target)
+    print('{} images and {} boxes converted.'.format(len(annotations), annotations.num_boxes))
+
+if __name__ == "__main__":
+    main()
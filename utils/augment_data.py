@@ -1,22 +1,39 @@
+import mxnet as mx
 from mxnet import nd
 import os
 import sys
+import random
+import multiprocessing
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..')))
 import utils.common as dataset_commons
+from utils.annotation_store import open_annotations
 import cv2
 import numpy as np
-import glob
 import pandas as pd
+from gluoncv.data.transforms import experimental
+from gluoncv.data.transforms import image as timage
+from gluoncv.data.transforms import bbox as tbbox
 from gluoncv.data.transforms.presets.ssd import SSDDefaultTrainTransform
 from matplotlib import pyplot as plt
 
 '''
 This code only gives you a tool to visualize 
 the images pointed in the csv file and the related bounding boxes using openCV
+
+load_images_from_csv_and_augment generates an offline augmented dataset. All the
+bounding boxes of an image are augmented together and every new image is an
+independent augmentation of the original one (the same random operations as
+SSDDefaultTrainTransform, without the normalization). The images are processed
+by a process pool and each image gets its own seed (seed + image index), so the
+dataset is the same whatever the number of processes. The new images are written
+to disk by the workers and/or packed into a record file as they are generated.
 '''
 data_common = dataset_commons.get_dataset_files()
 # classes_keys = [key for key in data_common['classes']]
 
+# expand fill color: the SSDDefaultTrainTransform mean in the BGR order of cv2.imread
+EXPAND_FILL = [m * 255 for m in (0.406, 0.456, 0.485)]
+
 def apply_transformation(img_width, img_height, image, label):
     if not isinstance(image, nd.NDArray):
         image = nd.array(image)
@@ -55,60 +72,150 @@ def print_image(image, bbox, label):
     a = cv2.waitKey(0)
     return a 
 
-def load_images_from_csv_and_augment(images_path, csv_path, images_path_save, img_width, img_height):
+def augment_image(image, label, img_width, img_height):
+    '''
+    Random color distortion, expansion, crop, resize and flip of an image, as done by
+    SSDDefaultTrainTransform, without converting the image to a normalized tensor.
+
+    Arguments:
+        image (NDArray): HWC uint8 image. It is not modified
+        label (array): (N, 5) array of xmin, ymin, xmax, ymax, class index
+
+    Returns:
+        tuple: HWC uint8 image of img_height x img_width and the (M, 5) boxes kept by the crop
+    '''
+    img = experimental.image.random_color_distort(image.astype('float32'))
+    bbox = label
+    if np.random.uniform(0, 1) > 0.5:
+        img, expand = timage.random_expand(img, fill=EXPAND_FILL)
+        bbox = tbbox.translate(bbox, x_offset=expand[0], y_offset=expand[1])
+
+    h, w, _ = img.shape
+    bbox, crop = experimental.bbox.random_crop_with_constraints(bbox, (w, h))
+    x0, y0, w, h = crop
+    img = mx.image.fixed_crop(img, x0, y0, w, h)
+
+    h, w, _ = img.shape
+    interp = np.random.randint(0, 5)
+    img = timage.imresize(img, img_width, img_height, interp=interp)
+    bbox = tbbox.resize(bbox, (w, h), (img_width, img_height))
+
+    h, w, _ = img.shape
+    img, flips = timage.random_flip(img, px=0.5)
+    bbox = tbbox.flip(bbox, (w, h), flip_x=flips[0])
+    return np.clip(img.asnumpy(), 0, 255).astype(np.uint8), bbox
+
+def augment_image_file(task):
+    '''
+    Decodes an image once and generates its augmentations.
+
+    Arguments:
+        task (tuple): source path, (N, 5) boxes with the class index, names of the new
+            images, save folder (None to not save them), whether the first new image is
+            the original one, img_width, img_height, seed and whether to return the
+            encoded images
+
+    Returns:
+        list: (name, (M, 5) int boxes, height, width, encoded image or None) of each new image
+    '''
+    (filename, label, names, images_path_save, keep_original,
+     img_width, img_height, seed, return_encoded) = task
+    random.seed(seed)
+    np.random.seed(seed)
+
+    img = cv2.imread(filename)
+    if img is None:
+        raise IOError('Could not read the image: {}'.format(filename))
+    image = nd.array(img, dtype='uint8')
+
+    results = []
+    for i, name in enumerate(names):
+        if keep_original and i == 0:
+            new_img, bbox = img, label
+        else:
+            new_img, bbox = augment_image(image, label, img_width, img_height)
+        encoded = cv2.imencode('.jpg', new_img)[1].tobytes()
+        if images_path_save is not None:
+            with open(images_path_save + name, 'wb') as f:
+                f.write(encoded)
+        results.append((name, np.round(bbox).astype(int), new_img.shape[0], new_img.shape[1],
+                        encoded if return_encoded else None))
+    return results
+
+def load_images_from_csv_and_augment(images_path, csv_path, images_path_save, img_width, img_height,
+                                     num_new_images=4, keep_original=True, seed=233, num_workers=None,
+                                     record_path=None, classes=None):
+    '''
+    Generates num_new_images augmentations of each image of a csv file.
+
+    The new images are named 0000.jpg, 0001.jpg, etc. in the order of the csv file, the
+    original image first when keep_original is set.
+
+    Arguments:
+        images_path (str): folder of the source images
+        csv_path (str): csv file with the image, xmin, ymin, xmax, ymax and label columns
+            (or annotation store)
+        images_path_save (str): folder of the new images (None to only write the record file)
+        num_new_images (int, default: 4): number of augmentations of each image
+        keep_original (bool, default: True): also save the original image
+        seed (int, default: 233): base seed of the random augmentations
+        num_workers (int, default: None): number of processes. Defaults to the number of CPU cores.
+            0 processes the images in this process
+        record_path (str, default: None): if set, the new images and their labels are also
+            packed into this .rec file (and the .idx file next to it), as prepare_dataset.py does
+        classes (dict, default: None): class ids of the labels for the record file. Defaults
+            to the classes of config.json
+
+    Returns:
+        DataFrame: one row per bounding box of the new images
+    '''
+    annotations = open_annotations(csv_path)
+    # the labels go through the augmentation as a fifth box column
+    label_names = annotations.label_names
+
+    num_images = num_new_images + int(keep_original)
+    tasks = []
+    for i, name in enumerate(annotations.names):
+        label = np.hstack((annotations.image_boxes(i), annotations.image_labels(i).reshape(-1, 1))).astype(float)
+        names = ['{0:04}'.format(i * num_images + j) + '.jpg' for j in range(num_images)]
+        tasks.append((os.path.join(images_path, str(name)), label, names, images_path_save, keep_original,
+                      img_width, img_height, seed + i, record_path is not None))
+
+    record = None
+    if record_path is not None:
+        if classes is None:
+            classes = dataset_commons.get_dataset_files()['classes']
+        class_ids = np.array([classes[label] for label in label_names])
+        record = mx.recordio.MXIndexedRecordIO(os.path.splitext(record_path)[0] + '.idx', record_path, 'w')
+
+    if num_workers == 0:
+        pool = None
+        results = map(augment_image_file, tasks)
+    else:
+        pool = multiprocessing.Pool(num_workers)
+        results = pool.imap(augment_image_file, tasks)
 
-    train_samples = pd.read_csv(csv_path)
     csv_list = []
+    idx = 0
+    try:
+        for new_images in results:
+            for name, bbox, height, width, encoded in new_images:
+                print('Saving image: ', name)
+                csv_list.extend((name, xmin, ymin, xmax, ymax, str(label_names[label]))
+                                for xmin, ymin, xmax, ymax, label in bbox[:, :5])
+
+                if record is not None:
+                    labels = np.hstack((class_ids[bbox[:, 4]].reshape(-1, 1),
+                                        bbox[:, :4] / [width, height, width, height]))
+                    header = mx.recordio.IRHeader(0, [4, 5, width, height] + labels.flatten().tolist(), idx, 0)
+                    record.write_idx(idx, mx.recordio.pack(header, encoded))
+                idx += 1
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if record is not None:
+            record.close()
 
-    # numeração das novas imagens. As novas imagens terão novos nomes 0000.jpg, etc.
-    # para isso, será usado o num_new_images abaixo
-    new_images_name = 0
-
-    # number of new images generated from the original image
-    num_new_images = 4
-
-    csv_list = []
-    for i, row in train_samples.iterrows():
-        # Reading data from the csv file
-        image_name_with_extension = row['image']
-        label = row['label']
-        xmin = int(row['xmin'])
-        ymin = int(row['ymin'])
-        xmax = int(row['xmax'])
-        ymax = int(row['ymax'])
-
-        bbox = [[xmin, ymin, xmax, ymax]]
-
-        filename = glob.glob(images_path + "/" + image_name_with_extension)[0]
-        img = cv2.imread(filename)
-
-        for i in range(0, num_new_images+1): # +1 to account for the original image
-            value = ('{0:04}'.format(new_images_name) + '.jpg',
-                 int(bbox[0][0]),
-                 int(bbox[0][1]),
-                 int(bbox[0][2]),
-                 int(bbox[0][3]),
-                 label
-                 )
-            csv_list.append(value)            
-
-            cv2.startWindowThread()
-            # a = print_image(img, bbox, label)
-            # if a == 27:
-            #     break
-            # cv2.destroyWindow('img')
-
-            print('Saving image: ', '{0:04}'.format(new_images_name), '.jpg')
-
-            save_image(img, images_path_save, new_images_name)
-
-            img, bbox = apply_transformation(img_width, img_height, img, bbox)
-        
-            new_images_name += 1
-        
-        # if a == 27:
-            # break            
-        
     column_name = ['image', 'xmin', 'ymin', 'xmax', 'ymax', 'label']
     csv_converter = pd.DataFrame(csv_list, columns=column_name)
     return csv_converter
@@ -121,17 +228,16 @@ if __name__ == "__main__":
     images_path_save = 'images_augmented/' # Folder that will contain the resized images
     csv_path_save = 'images_augmented/csv/val_dataset.csv'
 
+    # TODO: Set a .rec file path to also pack the new images into a record file
+    record_path = None
+
     img_height = 300
     img_width = 300
-    
-    csv_converter = load_images_from_csv_and_augment(source_images_path, source_csv_path, images_path_save, img_width, img_height)
-
-    if not os.path.exists(images_path_save):
-        try:
-            os.makedirs(images_path_save + 'csv') 
-        except OSError as e:
-            if e.errno != errno.EEXIST:
-                raise   
-    
+
+    os.makedirs(images_path_save + 'csv', exist_ok=True)
+
+    csv_converter = load_images_from_csv_and_augment(source_images_path, source_csv_path, images_path_save, img_width, img_height,
+                                                     record_path=record_path)
+
     csv_converter.to_csv(csv_path_save, index=None)
     print('Successfully converted to a new csv file.')
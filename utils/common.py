@@ -1,5 +1,6 @@
 import os
 import json
+import glob
 
 def get_dataset_files():
     json_path = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'config_files/config.json'))
@@ -16,14 +17,37 @@ def get_dataset_files():
         'video_folder' : config["video_folder"],
         'csv_train' : config["csv_train"],
         'csv_validation' : config["csv_validation"],
+        'csv_path' : config.get("csv_path", config["csv_train"]),
         'lst_train_path' : config["lst_train_path"],
         'lst_val_path' : config["lst_val_path"],
         'record_train_path' : config["record_train_path"],
-        'record_val_path' : config["record_val_path"]
+        'record_val_path' : config["record_val_path"],
+        'detection_cache_folder' : config.get("detection_cache_folder",
+                                              os.path.join(config["checkpoint_folder"], "detection_cache")),
+        'target_cache_folder' : config.get("target_cache_folder",
+                                           os.path.join(config["checkpoint_folder"], "target_cache")),
+        'validation_cache_folder' : config.get("validation_cache_folder",
+                                               os.path.join(config["checkpoint_folder"], "validation_cache"))
     }    
 
     return dir_
 
+def list_checkpoints(checkpoint_folder):
+    '''
+    Lists the trained params organized as checkpoint_folder/network_name/experiment_id/*.params
+
+    Returns:
+        list: (model_name, experiment_id, param_path) tuples grouped by model name
+    '''
+    checkpoints = []
+    for model_path in sorted(glob.glob(os.path.join(checkpoint_folder, '*', ''))):
+        model_name = os.path.basename(os.path.normpath(model_path))
+        for experiment_path in sorted(glob.glob(os.path.join(model_path, '*', ''))):
+            experiment_id_name = os.path.basename(os.path.normpath(experiment_path))
+            for param_path in sorted(glob.glob(os.path.join(experiment_path, '*.params'))):
+                checkpoints.append((model_name, experiment_id_name, param_path))
+    return checkpoints
+
 def get_model_prop(model):
     if model.lower() == 'ssd_300_vgg16_atrous_voc':
         network = 'ssd'
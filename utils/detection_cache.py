@@ -0,0 +1,181 @@
+import os
+import hashlib
+import numpy as np
+from mxnet import gluon
+from gluoncv.utils.metrics.voc_detection import VOC07MApMetric
+from utils.detection_matching import DetectionMatcher, as_numpy
+from utils.sharded_record import record_files
+
+'''
+Caches the detections of a network over the validation set, so that any number
+of metrics (e.g. the VOC mAP for all the IoU thresholds from 0.5 to 0.95) can be
+computed from a single forward pass.
+
+The detections are stored as a dict of numpy arrays padded with -1:
+    det_ids (N, K, 1), det_scores (N, K, 1), det_bboxes (N, K, 4)
+    gt_ids (N, M, 1), gt_bboxes (N, M, 4)
+where N is the number of validation images, K the post_nms value and M the
+maximum number of ground truths in a single image.
+
+The detections can also be persisted in a compressed .npz file per checkpoint.
+The file name is a hash of the params file content, the validation .rec/.idx
+content and the nms settings, so a cached file is only reused when none of them
+changed.
+'''
+
+DETECTION_KEYS = ['det_ids', 'det_scores', 'det_bboxes', 'gt_ids', 'gt_bboxes']
+
+# file digests already computed in this process: {(path, size, mtime): digest}
+_digests = {}
+
+def file_digest(path, chunk_size=1 << 20):
+    """Returns the sha1 of the file content. The .rec file is hashed only once per process."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if memo_key not in _digests:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha1.update(chunk)
+        _digests[memo_key] = sha1.hexdigest()
+    return _digests[memo_key]
+
+def detection_cache_key(param_path, record_path, nms_threshold, post_nms, nms_topk=200):
+    """
+    Builds the cache key of a checkpoint evaluated over a validation record file.
+
+    Arguments:
+        param_path (str): the .params file path
+        record_path (str): the validation .rec file path (the .idx file next to it is also hashed)
+            or shard manifest (all the shards are hashed)
+        nms_threshold (float): nms threshold set in the network
+        post_nms (int): maximum number of detections per image
+        nms_topk (int, default: 200): nms topk set in the network
+    """
+    parts = [file_digest(param_path)] + [file_digest(path) for path in record_files(record_path)]
+    parts += [repr(float(nms_threshold)), str(int(post_nms)), str(int(nms_topk))]
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+def save_detections(path, detections):
+    """Saves the detections into a compressed .npz file (written atomically)."""
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, **detections)
+    os.replace(tmp_path, path)
+
+def load_detections(path):
+    """Loads the detections saved by save_detections."""
+    with np.load(path) as data:
+        return {key: data[key] for key in DETECTION_KEYS}
+
+def pad_concat(arrays, pad_val=-1):
+    """Concatenates (B, M, C) arrays along the first axis padding the second one."""
+    max_len = max(array.shape[1] for array in arrays)
+    out = []
+    for array in arrays:
+        pad = max_len - array.shape[1]
+        if pad:
+            array = np.pad(array, ((0, 0), (0, pad), (0, 0)), mode='constant', constant_values=pad_val)
+        out.append(array)
+    return np.concatenate(out, axis=0)
+
+def collect_detections(net, val_loader, ctx):
+    """
+    Runs the network once over the validation loader and keeps the detections.
+    The nms settings must be configured in the network before calling it.
+
+    Arguments:
+        net (HybridBlock): the detection network
+        val_loader (DataLoader): validation loader returning (image, padded label) batches
+        ctx (list): list of contexts
+
+    Returns:
+        dict: the detections and ground truths of the whole validation set
+    """
+    detections = {key: [] for key in DETECTION_KEYS}
+    for batch in val_loader:
+        data = gluon.utils.split_and_load(batch[0], ctx_list=ctx, batch_axis=0, even_split=False)
+        label = gluon.utils.split_and_load(batch[1], ctx_list=ctx, batch_axis=0, even_split=False)
+
+        det_ids, det_scores, det_bboxes, gt_ids, gt_bboxes = [], [], [], [], []
+        for x, y in zip(data, label):
+            ids, scores, bboxes = net(x)
+            det_ids.append(ids)
+            det_scores.append(scores)
+            # clip to image size
+            det_bboxes.append(bboxes.clip(0, batch[0].shape[2]))
+            # split ground truths
+            gt_ids.append(y.slice_axis(axis=-1, begin=4, end=5))
+            gt_bboxes.append(y.slice_axis(axis=-1, begin=0, end=4))
+
+        for key, value in zip(DETECTION_KEYS, [det_ids, det_scores, det_bboxes, gt_ids, gt_bboxes]):
+            detections[key].append(as_numpy(value))
+
+    return {key: pad_concat(value) for key, value in detections.items()}
+
+def get_detections(net, val_loader, ctx, param_path, record_path, nms_threshold, post_nms,
+                   nms_topk=200, cache_folder=None):
+    """
+    Configures the nms of the network and returns its detections over the validation set.
+    If cache_folder is set, the detections are loaded from it when available or saved
+    into it after the forward pass.
+
+    Arguments:
+        net (HybridBlock): the detection network loaded with param_path
+        val_loader (DataLoader): validation loader built from record_path
+        ctx (list): list of contexts
+        param_path (str): the .params file loaded in the network
+        record_path (str): the validation .rec file path
+        nms_threshold (float): nms threshold
+        post_nms (int): maximum number of detections per image
+        nms_topk (int, default: 200): nms topk
+        cache_folder (str, default: None): folder of the .npz files. None disables the disk cache
+
+    Returns:
+        dict: the detections and ground truths of the whole validation set
+    """
+    if cache_folder is not None:
+        key = detection_cache_key(param_path, record_path, nms_threshold, post_nms, nms_topk)
+        cache_path = os.path.join(cache_folder, key + '.npz')
+        if os.path.exists(cache_path):
+            print('Loading cached detections: ', cache_path)
+            return load_detections(cache_path)
+
+    # post_nms = maximum number of objects per image
+    net.set_nms(nms_thresh=nms_threshold, nms_topk=nms_topk, post_nms=post_nms)
+    # allow the MXNet engine to perform graph optimization for best performance.
+    net.hybridize(static_alloc=True, static_shape=True)
+    detections = collect_detections(net, val_loader, ctx)
+
+    if cache_folder is not None:
+        save_detections(cache_path, detections)
+    return detections
+
+def evaluate_detections(detections, class_names, iou_thresholds, first_gt=False):
+    """
+    Computes the VOC mAP and the micro averaging metrics for several IoU thresholds
+    from cached detections.
+
+    Arguments:
+        detections (dict): detections returned by collect_detections
+        class_names (list): list of class names
+        iou_thresholds (list): list of IoU thresholds
+        first_gt (bool, default: False): matching rule of predict.py (see DetectionMatcher)
+
+    Returns:
+        list: one tuple ((map_name, mean_ap), rec_by_class, prec_by_class, fp_sum, tp_sum, confusion_matrix)
+            for each IoU threshold
+    """
+    results = []
+    for iou_threshold in iou_thresholds:
+        val_metric = VOC07MApMetric(iou_thresh=iou_threshold, class_names=class_names)
+        val_metric.update(detections['det_bboxes'], detections['det_ids'], detections['det_scores'],
+                          detections['gt_bboxes'], detections['gt_ids'])
+        matcher = DetectionMatcher(len(class_names), iou_threshold, first_gt)
+        matcher.update(detections['det_bboxes'], detections['det_ids'],
+                       detections['gt_bboxes'], detections['gt_ids'])
+        results.append((val_metric.get(),) + matcher.get())
+    return results
@@ -0,0 +1,157 @@
+import numpy as np
+
+'''
+Vectorized replacement for the per-box matching loop used by the validate()
+methods of the evaluation and training scripts.
+
+Each batch is copied to the host once and the IoU between every prediction and
+every ground truth of an image is computed with NumPy broadcasting. The counting
+rules are the same ones used by the old nested loops:
+    - IoU > threshold and same class: true positive of the gt class
+    - IoU > threshold and other class: false positive of the predicted class
+    - no gt with IoU > threshold: false positive of the predicted class
+Every (gt, prediction) pair above the threshold is also added to the confusion
+matrix (rows: true label, columns: predicted label).
+
+predict.py used a different rule, kept with first_gt=True: each prediction is
+only compared with the first gt of its own class in the image. It is a true
+positive if their IoU > threshold, otherwise (or if the image has no gt of that
+class) a false positive of the predicted class.
+
+Padded entries (class id -1, added by Pad(pad_val=-1) and by the NMS output) are
+ignored.
+'''
+
+def as_numpy(array):
+    """Converts an NDArray (or a list of NDArrays split by context) to a numpy array."""
+    if isinstance(array, (list, tuple)):
+        return np.concatenate([as_numpy(x) for x in array], axis=0)
+    if hasattr(array, 'asnumpy'):
+        return array.asnumpy()
+    return np.asarray(array)
+
+def bbox_iou_matrix(bbox_a, bbox_b):
+    """
+    Computes the IoU between every box of bbox_a and every box of bbox_b.
+    Same formula as gluoncv.utils.bbox.bbox_iou with offset=0.
+
+    Arguments:
+        bbox_a (np.ndarray): (N, 4) array in the (xmin, ymin, xmax, ymax) format
+        bbox_b (np.ndarray): (M, 4) array in the (xmin, ymin, xmax, ymax) format
+
+    Returns:
+        np.ndarray: (N, M) IoU matrix
+    """
+    tl = np.maximum(bbox_a[:, None, :2], bbox_b[None, :, :2])
+    br = np.minimum(bbox_a[:, None, 2:4], bbox_b[None, :, 2:4])
+
+    area_i = np.prod(br - tl, axis=2) * (tl < br).all(axis=2)
+    area_a = np.prod(bbox_a[:, 2:4] - bbox_a[:, :2], axis=1)
+    area_b = np.prod(bbox_b[:, 2:4] - bbox_b[:, :2], axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return area_i / (area_a[:, None] + area_b[None, :] - area_i)
+
+def match_image(pred_bboxes, pred_ids, gt_bboxes, gt_ids, num_classes, iou_threshold, first_gt=False):
+    """
+    Matches the predictions of a single image against its ground truths.
+
+    Arguments:
+        pred_bboxes (np.ndarray): (N, 4) predicted boxes
+        pred_ids (np.ndarray): (N,) predicted class ids (-1 for padding)
+        gt_bboxes (np.ndarray): (M, 4) ground truth boxes
+        gt_ids (np.ndarray): (M,) ground truth class ids (-1 for padding)
+        num_classes (int): number of classes
+        iou_threshold (float): minimum IoU (exclusive) to consider a match
+        first_gt (bool, default: False): compare each prediction only with the first gt of its class
+
+    Returns:
+        tuple: tp, fp, gt_count (num_classes,) and confusion_matrix (num_classes, num_classes)
+    """
+    pred_valid = pred_ids >= 0
+    gt_valid = gt_ids >= 0
+    pred_bboxes, pred_ids = pred_bboxes[pred_valid], pred_ids[pred_valid].astype(int)
+    gt_bboxes, gt_ids = gt_bboxes[gt_valid], gt_ids[gt_valid].astype(int)
+
+    gt_count = np.bincount(gt_ids, minlength=num_classes)
+
+    hit = bbox_iou_matrix(pred_bboxes, gt_bboxes) > iou_threshold
+    same_class = pred_ids[:, None] == gt_ids[None, :]
+    pred_grid = np.broadcast_to(pred_ids[:, None], hit.shape)
+    gt_grid = np.broadcast_to(gt_ids[None, :], hit.shape)
+
+    if first_gt:
+        correct = np.zeros(len(pred_ids), dtype=bool)
+        if len(gt_ids):
+            first = same_class.argmax(axis=1)
+            correct = same_class.any(axis=1) & hit[np.arange(len(pred_ids)), first]
+        tp = np.bincount(pred_ids[correct], minlength=num_classes)
+        fp = np.bincount(pred_ids[~correct], minlength=num_classes)
+    else:
+        tp = np.bincount(gt_grid[hit & same_class], minlength=num_classes)
+        fp = np.bincount(pred_grid[hit & ~same_class], minlength=num_classes) + \
+            np.bincount(pred_ids[~hit.any(axis=1)], minlength=num_classes)
+
+    confusion_matrix = np.zeros((num_classes, num_classes))
+    np.add.at(confusion_matrix, (gt_grid[hit], pred_grid[hit]), 1)
+    return tp, fp, gt_count, confusion_matrix
+
+class DetectionMatcher(object):
+    """
+    Accumulates the true positives, false positives, number of ground truths and the
+    confusion matrix by class. It follows the reset/update/get interface of the
+    gluoncv VOC07MApMetric, so it can be updated with the same lists used by it.
+
+    Arguments:
+        num_classes (int): number of classes
+        iou_threshold (float, default: 0.5): minimum IoU (exclusive) to consider a match
+        first_gt (bool, default: False): compare each prediction only with the first gt of its
+            class (rule of predict.py)
+    """
+    def __init__(self, num_classes, iou_threshold=0.5, first_gt=False):
+        self.num_classes = num_classes
+        self.iou_threshold = iou_threshold
+        self.first_gt = first_gt
+        self.reset()
+
+    def reset(self):
+        num_classes = self.num_classes
+        self.tp = np.zeros(num_classes, dtype=int)
+        self.fp = np.zeros(num_classes, dtype=int)
+        self.gt_by_class = np.zeros(num_classes, dtype=int)
+        self.confusion_matrix = np.zeros((num_classes, num_classes))
+
+    def update(self, pred_bboxes, pred_labels, gt_bboxes, gt_labels):
+        """
+        Updates the counts with a batch of predictions.
+
+        Arguments:
+            pred_bboxes (NDArray, np.ndarray or list): (B, N, 4) predicted boxes
+            pred_labels (NDArray, np.ndarray or list): (B, N, 1) predicted class ids
+            gt_bboxes (NDArray, np.ndarray or list): (B, M, 4) ground truth boxes
+            gt_labels (NDArray, np.ndarray or list): (B, M, 1) ground truth class ids
+        """
+        pred_bboxes = as_numpy(pred_bboxes)
+        pred_labels = as_numpy(pred_labels).reshape(pred_bboxes.shape[:2])
+        gt_bboxes = as_numpy(gt_bboxes)
+        gt_labels = as_numpy(gt_labels).reshape(gt_bboxes.shape[:2])
+
+        for pred_bbox, pred_label, gt_bbox, gt_label in zip(pred_bboxes, pred_labels, gt_bboxes, gt_labels):
+            tp, fp, gt_count, confusion_matrix = match_image(pred_bbox, pred_label, gt_bbox, gt_label,
+                                                             self.num_classes, self.iou_threshold,
+                                                             self.first_gt)
+            self.tp += tp
+            self.fp += fp
+            self.gt_by_class += gt_count
+            self.confusion_matrix += confusion_matrix
+
+    def get(self):
+        """
+        Returns:
+            tuple: rec_by_class, prec_by_class (micro averaging), fp_sum, tp_sum and the confusion matrix
+        """
+        # If an element of gt or fp + tp is 0,
+        # the corresponding element of rec or prec is nan.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rec_by_class = self.tp / self.gt_by_class
+            prec_by_class = self.tp / (self.tp + self.fp)
+        return rec_by_class, prec_by_class, int(self.fp.sum()), int(self.tp.sum()), self.confusion_matrix
@@ -0,0 +1,85 @@
+import mxnet as mx
+from gluoncv.model_zoo.ssd import SSD
+
+'''
+Outputs of a gluoncv SSD network needed to validate it with a single forward pass.
+
+In training mode the SSD networks return the class and box predictions of every
+anchor (used by the multibox loss) and in inference mode the detections after
+the box decoding and nms (used by the mAP metric). Running the network twice
+over the validation set, once in each mode, decodes and forwards every image
+twice. SSDValidationOutputs runs the layers of the network once, in inference
+mode, and returns both: the raw predictions and the same detections as
+net(x), with the nms settings of net.set_nms().
+
+tests/test_fused_validation.py checks that the detections are equal to net(x)
+with the installed gluoncv.
+'''
+
+SSD_ATTRIBUTES = ('features', 'class_predictors', 'box_predictors', 'anchor_generators', 'bbox_decoder',
+                  'cls_decoder', 'num_classes', 'nms_thresh', 'nms_topk', 'post_nms')
+
+class SSDValidationOutputs(object):
+    """
+    Mirrors the SSD.hybrid_forward of gluoncv 0.7.0 (the version of requirements.txt):
+    the per-class concat of the decoded detections, box_nms with valid_thresh=0.01 and
+    the post_nms slicing.
+
+    Arguments:
+        net (SSD): gluoncv SSD network. Its blocks keep their hybridization. Raises a
+            TypeError for other networks (see supports())
+    """
+    def __init__(self, net):
+        if not self.supports(net):
+            raise TypeError('SSDValidationOutputs requires a gluoncv SSD network, got {}'.format(type(net).__name__))
+        self.net = net
+
+    @staticmethod
+    def supports(net):
+        """Whether the network is a gluoncv SSD with the blocks used by this class."""
+        return isinstance(net, SSD) and all(hasattr(net, name) for name in SSD_ATTRIBUTES)
+
+    def predictions(self, x):
+        """Returns the (B, N, num_classes + 1) class predictions, the (B, N, 4) box predictions and the anchors."""
+        net = self.net
+        F = mx.nd
+        features = net.features(x)
+        cls_preds = [F.flatten(F.transpose(cp(feat), (0, 2, 3, 1)))
+                     for feat, cp in zip(features, net.class_predictors)]
+        box_preds = [F.flatten(F.transpose(bp(feat), (0, 2, 3, 1)))
+                     for feat, bp in zip(features, net.box_predictors)]
+        anchors = [F.reshape(ag(feat), shape=(1, -1))
+                   for feat, ag in zip(features, net.anchor_generators)]
+        cls_preds = F.concat(*cls_preds, dim=1).reshape((0, -1, net.num_classes + 1))
+        box_preds = F.concat(*box_preds, dim=1).reshape((0, -1, 4))
+        anchors = F.concat(*anchors, dim=1).reshape((1, -1, 4))
+        return cls_preds, box_preds, anchors
+
+    def detections(self, cls_preds, box_preds, anchors):
+        """Returns the ids, scores and bboxes of the detections, as net(x) does in inference mode."""
+        net = self.net
+        F = mx.nd
+        bboxes = net.bbox_decoder(box_preds, anchors)
+        cls_ids, scores = net.cls_decoder(F.softmax(cls_preds, axis=-1))
+        results = []
+        for i in range(net.num_classes):
+            cls_id = cls_ids.slice_axis(axis=-1, begin=i, end=i+1)
+            score = scores.slice_axis(axis=-1, begin=i, end=i+1)
+            # per class results
+            results.append(F.concat(*[cls_id, score, bboxes], dim=-1))
+        result = F.concat(*results, dim=1)
+        if 0 < net.nms_thresh < 1:
+            result = F.contrib.box_nms(
+                result, overlap_thresh=net.nms_thresh, topk=net.nms_topk, valid_thresh=0.01,
+                id_index=0, score_index=1, coord_start=2, force_suppress=False)
+            if net.post_nms > 0:
+                result = result.slice_axis(axis=1, begin=0, end=net.post_nms)
+        ids = F.slice_axis(result, axis=2, begin=0, end=1)
+        scores = F.slice_axis(result, axis=2, begin=1, end=2)
+        bboxes = F.slice_axis(result, axis=2, begin=2, end=6)
+        return ids, scores, bboxes
+
+    def __call__(self, x):
+        """Returns cls_preds, box_preds, ids, scores and bboxes."""
+        cls_preds, box_preds, anchors = self.predictions(x)
+        return (cls_preds, box_preds) + self.detections(cls_preds, box_preds, anchors)
@@ -0,0 +1,125 @@
+import struct
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Reads the width and height of JPEG and PNG images from their headers, without
+decoding the pixels. Only the first few KB of each file are read, so the sizes
+of a whole dataset can be collected in seconds.
+
+The EXIF orientation of JPEG files is taken into account (orientations 5 to 8
+swap the width and the height), so the sizes match the ones of cv2.imread.
+Other formats fall back to a full cv2.imread decode.
+'''
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# JPEG start of frame markers (0xC4, 0xC8 and 0xCC are not frames)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+EXIF_ORIENTATION_TAG = 0x0112
+
+def _exif_orientation(segment):
+    """Returns the orientation stored in an APP1 EXIF segment (1 if it is not present)."""
+    if segment[:6] != b'Exif\x00\x00':
+        return 1
+    tiff = segment[6:]
+    if len(tiff) < 8 or tiff[:2] not in (b'II', b'MM'):
+        return 1
+    endian = '<' if tiff[:2] == b'II' else '>'
+    ifd_offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+    if ifd_offset + 2 > len(tiff):
+        return 1
+    num_entries = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])[0]
+    for i in range(num_entries):
+        entry = ifd_offset + 2 + 12 * i
+        if entry + 12 > len(tiff):
+            break
+        tag, = struct.unpack(endian + 'H', tiff[entry:entry + 2])
+        if tag == EXIF_ORIENTATION_TAG:
+            return struct.unpack(endian + 'H', tiff[entry + 8:entry + 10])[0]
+    return 1
+
+def _jpeg_size(f):
+    """Returns the (width, height) of a JPEG file or None if the header is truncated or unusual."""
+    orientation = 1
+    f.read(2)  # SOI
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        # skip fill bytes
+        while marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+            if len(marker) < 2:
+                return None
+        code = marker[1]
+        if code in (0x01, 0xD8) or 0xD0 <= code <= 0xD7:
+            # markers without a length field
+            continue
+        if code == 0xD9:
+            return None
+        data = f.read(2)
+        if len(data) < 2:
+            return None
+        length, = struct.unpack('>H', data)
+        if length < 2:
+            return None
+        if code in JPEG_SOF_MARKERS:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack('>xHH', data)
+            if orientation >= 5:
+                width, height = height, width
+            return width, height
+        segment = f.read(length - 2)
+        if len(segment) < length - 2:
+            return None
+        if code == 0xE1:
+            orientation = _exif_orientation(segment)
+
+def read_image_size(path):
+    """
+    Reads the size of an image.
+
+    Arguments:
+        path (str): image file path
+
+    Returns:
+        tuple: (width, height)
+    """
+    with open(path, 'rb') as f:
+        head = f.read(24)
+        if head[:8] == PNG_SIGNATURE and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:2] == b'\xff\xd8':
+            f.seek(0)
+            try:
+                size = _jpeg_size(f)
+            except (struct.error, IndexError):
+                size = None
+            if size is not None:
+                return size
+
+    # unknown format or unusual header, decode the whole image
+    img = cv2.imread(path)
+    if img is None:
+        raise IOError('Could not read the image: {}'.format(path))
+    return img.shape[1], img.shape[0]
+
+def read_image_sizes(paths, num_threads=16):
+    """
+    Reads the size of several images with a thread pool.
+
+    Arguments:
+        paths (list): image file paths
+        num_threads (int, default: 16): number of threads
+
+    Returns:
+        np.ndarray: (N, 2) array with the width and height of each image
+    """
+    paths = list(paths)
+    if not paths:
+        return np.zeros((0, 2), dtype=np.int64)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return np.array(list(executor.map(read_image_size, paths)), dtype=np.int64)
@@ -0,0 +1,173 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+'''
+Dynamic micro-batching of concurrent requests.
+
+Requests submitted from any number of threads are queued. A single worker thread
+takes the first queued request, waits at most max_wait_ms for more requests (or
+until max_batch_size requests are collected) and runs the whole batch at once.
+Each result is routed back to the future returned to its caller.
+
+Queue depth and batch fill ratio counters are available in batcher.stats.
+'''
+
+class BatcherStats(object):
+    """Queue depth and batch fill ratio counters of a micro-batcher."""
+    def __init__(self, max_batch_size):
+        self.max_batch_size = max_batch_size
+        self.requests = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.total_latency = 0.0
+        self._lock = threading.Lock()
+
+    def submitted(self):
+        with self._lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def batch(self, size, wait, latency, failed=False):
+        with self._lock:
+            self.queue_depth -= size
+            self.requests += size
+            self.batches += 1
+            self.failed_batches += int(failed)
+            self.total_wait += wait
+            self.total_latency += latency
+
+    @property
+    def fill_ratio(self):
+        """Mean number of requests per batch divided by max_batch_size."""
+        return self.requests / float(self.batches * self.max_batch_size) if self.batches else 0.0
+
+    @property
+    def mean_batch_size(self):
+        return self.requests / float(self.batches) if self.batches else 0.0
+
+    @property
+    def mean_wait(self):
+        """Mean time the first request of a batch waited for the batch to be formed."""
+        return self.total_wait / self.batches if self.batches else 0.0
+
+    @property
+    def mean_latency(self):
+        """Mean time spent running a batch."""
+        return self.total_latency / self.batches if self.batches else 0.0
+
+    def as_dict(self):
+        return {'requests': self.requests, 'batches': self.batches, 'failed_batches': self.failed_batches,
+                'queue_depth': self.queue_depth, 'max_queue_depth': self.max_queue_depth,
+                'mean_batch_size': self.mean_batch_size, 'fill_ratio': self.fill_ratio,
+                'mean_wait_ms': self.mean_wait * 1000, 'mean_latency_ms': self.mean_latency * 1000}
+
+    def __repr__(self):
+        return 'batches {} | requests {} | fill ratio {:.2f} | queue depth {} (max {}) | wait {:.1f} ms | latency {:.1f} ms'.format(
+            self.batches, self.requests, self.fill_ratio, self.queue_depth, self.max_queue_depth,
+            self.mean_wait * 1000, self.mean_latency * 1000)
+
+class MicroBatcher(object):
+    """
+    Groups concurrent requests into batches and runs them in a worker thread.
+
+    Arguments:
+        process_batch (function): maps a list of items to a list with one result per item
+        max_batch_size (int, default: 8): maximum number of requests per batch
+        max_wait_ms (float, default: 5): maximum time to wait for more requests after the
+            first one of a batch
+    """
+    def __init__(self, process_batch, max_batch_size=8, max_wait_ms=5):
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1.')
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.stats = BatcherStats(max_batch_size)
+        self._requests = queue.Queue()
+        self._thread = None
+        # no request is queued behind the stop sentinel
+        self._lock = threading.Lock()
+        self._closed = True
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+                self._closed = False
+        return self
+
+    def stop(self):
+        """Runs the requests already queued and stops the worker thread."""
+        with self._lock:
+            thread = self._thread
+            if thread is None or self._closed:
+                return
+            self._closed = True
+            self._requests.put(None)
+        thread.join()
+        with self._lock:
+            self._thread = None
+
+    def submit(self, item):
+        """Queues an item and returns a Future with its result. Raises a RuntimeError after stop()."""
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('The micro-batcher is not running. Call start() first.')
+            self.stats.submitted()
+            self._requests.put((item, future))
+        return future
+
+    def __call__(self, item):
+        """Blocking version of submit()."""
+        return self.submit(item).result()
+
+    def _next_batch(self):
+        """Returns the next batch, the time spent forming it and whether the batcher was stopped."""
+        first = self._requests.get()
+        if first is None:
+            return [], 0.0, True
+        requests = [first]
+        start = time.time()
+        deadline = start + self.max_wait_ms / 1000.0
+        while len(requests) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                return requests, time.time() - start, True
+            requests.append(request)
+        return requests, time.time() - start, False
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            requests, wait, stopped = self._next_batch()
+            if not requests:
+                continue
+
+            tic = time.time()
+            try:
+                results = list(self.process_batch([item for item, _ in requests]))
+                if len(results) != len(requests):
+                    raise RuntimeError('process_batch returned {} results for {} requests.'.format(
+                        len(results), len(requests)))
+            except Exception as e:
+                self.stats.batch(len(requests), wait, time.time() - tic, failed=True)
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+            self.stats.batch(len(requests), wait, time.time() - tic)
+            for (_, future), result in zip(requests, results):
+                future.set_result(result)
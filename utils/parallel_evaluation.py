@@ -0,0 +1,76 @@
+import os
+import multiprocessing
+
+'''
+Spreads the evaluation of several checkpoints across CPU worker processes.
+
+Each worker receives a contiguous chunk of the checkpoint list (so consecutive
+checkpoints of the same network keep reusing the same graph) and a fixed thread
+budget through OMP_NUM_THREADS and MXNET_CPU_WORKER_NTHREADS. The workers are
+started with the 'spawn' method, so mxnet is imported again in each one of them
+with the thread budget already set in its environment.
+'''
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MXNET_CPU_WORKER_NTHREADS']
+
+def chunk_checkpoints(checkpoints, num_chunks):
+    """
+    Splits the checkpoint list into contiguous chunks of similar size.
+
+    Arguments:
+        checkpoints (list): list of checkpoints (any picklable items)
+        num_chunks (int): maximum number of chunks
+
+    Returns:
+        list: list of non empty chunks
+    """
+    num_chunks = max(1, min(num_chunks, len(checkpoints)))
+    size, rest = divmod(len(checkpoints), num_chunks)
+    chunks, start = [], 0
+    for i in range(num_chunks):
+        end = start + size + (1 if i < rest else 0)
+        chunks.append(checkpoints[start:end])
+        start = end
+    return [chunk for chunk in chunks if chunk]
+
+def run_parallel(worker_fn, checkpoints, num_workers, threads_per_worker=None):
+    """
+    Evaluates the checkpoints with a process pool.
+
+    Arguments:
+        worker_fn (function): module level function receiving a list of checkpoints and
+            returning a list with one result per checkpoint
+        checkpoints (list): list of checkpoints
+        num_workers (int): number of worker processes
+        threads_per_worker (int, default: None): number of threads of each worker.
+            None splits the CPU cores evenly between the workers
+
+    Returns:
+        list: the results of all the checkpoints, in the same order as the checkpoints
+    """
+    if not checkpoints:
+        return []
+    if threads_per_worker is None:
+        threads_per_worker = max(1, multiprocessing.cpu_count() // num_workers)
+
+    chunks = chunk_checkpoints(checkpoints, num_workers)
+
+    # the spawned workers inherit the environment of the parent when they are created
+    saved_env = {name: os.environ.get(name) for name in THREAD_ENV_VARS}
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(threads_per_worker)
+    try:
+        pool = multiprocessing.get_context('spawn').Pool(processes=len(chunks))
+    finally:
+        for name, value in saved_env.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+    try:
+        chunk_results = pool.map(worker_fn, chunks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return [result for chunk_result in chunk_results for result in chunk_result]
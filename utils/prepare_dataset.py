@@ -1,13 +1,15 @@
 import os
-import mxnet as mx
+import sys
 import numpy as np
-import pandas as pd
-import common as dataset_common
-import glob
-import cv2
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..')))
+import utils.common as dataset_commons
+from utils.image_size import read_image_sizes
+from utils.annotation_store import open_annotations
+import im2rec
 '''
-This python script transforms the csv file into the lst file used by GluonCV in order
-to later transform it into a record file.
+This python script transforms the csv file into the lst file used by GluonCV and
+then into the record file. The labels are passed in memory to the im2rec record
+builder, so the whole csv -> rec conversion runs in a single process.
 
 By default, the csv files are located in the csv folder, the lst files will be saved
 in the data folder and the images should be configured in config.json file, since
@@ -31,65 +33,89 @@ lst_train_path = data_common['lst_train_path']
 lst_val_path = data_common['lst_val_path']
 classes = data_common['classes']
 
-def save_rec_from_csv(img_path, csv_path, lst_paths, h, w, resize_images):
+def build_label_table(img_path, csv_path, num_threads=16):
+    """
+    Loads the csv file (or annotation store) and builds the normalized labels of all the images.
+    The image sizes are read from the JPEG/PNG headers (without decoding the images)
+    by a thread pool, and all the boxes are normalized at once.
+
+    Arguments:
+        img_path (str): folder of the images pointed in the csv file
+        csv_path (str): the .csv file path or annotation store folder
+        num_threads (int, default: 16): number of threads reading the image headers
+
+    Returns:
+        tuple: image_paths (list), offsets (np.ndarray with N+1 elements) and labels
+            (np.ndarray (num_boxes, 5) with class id, xmin, ymin, xmax, ymax). The labels
+            of the image i are labels[offsets[i]:offsets[i + 1]]
+    """
+    # same image order as groupby('image'), keeping the row order of each image.
+    # A label missing from the classes of config.json raises a ValueError
+    store = open_annotations(csv_path, classes, sort=True)
+    image_paths = [os.path.join(img_path, name) for name in store.names]
+    offsets = np.asarray(store.offsets)
+
+    sizes = read_image_sizes(image_paths, num_threads).astype(float)
+    sizes = np.repeat(sizes, store.counts, axis=0)
+
+    labels = np.empty((store.num_boxes, 5), dtype=float)
+    labels[:, 0] = store.label_ids(classes)
+    labels[:, 1:] = store.boxes
+    labels[:, (1, 3)] /= sizes[:, 0:1] # width
+    labels[:, (2, 4)] /= sizes[:, 1:2] # height
+    return image_paths, offsets, labels
+
+def write_lst(lst_path, image_paths, offsets, labels, h, w):
+    """
+    Writes the .lst file of a label table built by build_label_table.
+
+    Arguments:
+        lst_path (str): the .lst file path
+        image_paths, offsets, labels: the label table
+        h (int): The output image height
+        w (int): The output image width
+    """
+    A = 4 # length of header
+    B = 5 # length of label for each object, usually 5
+    C = w # optional
+    D = h # optional
+    str_header = '\t'.join(str(x) for x in [A, B, C, D])
+
+    label_cells = labels.astype(str)
+    lines = []
+    for idx, path in enumerate(image_paths):
+        cells = label_cells[offsets[idx]:offsets[idx + 1]].ravel()
+        lines.append('\t'.join([str(idx), str_header] + cells.tolist() + [path]) + '\n')
+
+    with open(lst_path, 'w') as fw:
+        fw.write(''.join(lines))
+
+def save_rec_from_csv(img_path, csv_path, lst_paths, h, w, resize_images, num_threads=16):
     """
     This script:
         1 - loads the csv file configured in the config.json file
         2 - Creates a .lst file in the folder specified in config.json
-        3 - Creates a .rec file in the folder specified in config.json
 
     Arguments:
         csv_path (str) : the .csv file paths configured in config.json file
         lst_paths (str) : the .lst file paths configured in config.json file
         h (int) : The output image height
         w (int) : The output image width
+        num_threads (int, default: 16) : number of threads reading the image sizes
     """
-    train_samples = pd.read_csv(csv_path)
-    
-    train_samples = train_samples.groupby('image')
-    with open(lst_paths, 'w') as fw:
-        idx = 0
-        for name, group in train_samples:
-            all_boxes, all_ids, all_class_names, all_images_paths = [], [], [], []
-            for i, row in group.iterrows():
-                image_name_with_extension = row['image']
-                label = row['label']
-                xmin = row['xmin'] 
-                ymin = row['ymin']
-                xmax = row['xmax'] 
-                ymax = row['ymax']
-
-                img_path_ = os.path.join(img_path, image_name_with_extension) 
-                all_images_paths.append(img_path_)
-                all_boxes.append([xmin, ymin, xmax, ymax])
-                all_ids.extend([classes[label]])
-                all_class_names.extend([label])       
-
-            all_boxes = np.array(all_boxes, dtype=float)
-            all_ids = np.array(all_ids)
-            labels = np.hstack((all_ids.reshape(-1, 1), all_boxes)).astype('float')
-                
-            filename = glob.glob(img_path_)[0]
-            img = cv2.imread(filename)
-            labels[:, (1, 3)] /= float(img.shape[1]) # width
-            labels[:, (2, 4)] /= float(img.shape[0]) # height
-
-            A = 4 # length of header
-            B = 5 # length of label for each object, usually 5
-            C = w # optional
-            D = h # optional
-
-            # flatten
-            labels = labels.flatten().tolist()
-            str_idx = [str(idx)]
-            str_header = [str(x) for x in [A, B, C, D]]
-            str_labels = [str(x) for x in labels]      
-            str_path = [img_path_]
-            line = '\t'.join(str_idx + str_header + str_labels + str_path) + '\n'
-            fw.write(line)
-            idx += 1
-
-def main():
+    image_paths, offsets, labels = build_label_table(img_path, csv_path, num_threads)
+    write_lst(lst_paths, image_paths, offsets, labels, h, w)
+
+def label_table_items(image_paths, offsets, labels, h, w):
+    """
+    Converts a label table built by build_label_table into the items used by the im2rec
+    record builder, the same ones it would read from the .lst file.
+    """
+    header = [4, 5, w, h]
+    return [[idx, path] + header + labels[offsets[idx]:offsets[idx + 1]].ravel().tolist()
+            for idx, path in enumerate(image_paths)]
+
+def main(num_workers=None, num_shards=0, incremental=False):
     csv_paths = [csv_train_path, csv_validation_path]
     lst_paths = [lst_train_path, lst_val_path]
     img_paths = [image_folder, image_val_folder]
@@ -107,29 +133,32 @@ def main():
     print("\n Generating the lst files from the csv files. Please wait...")
 
     # Please adjust the width and height according to the desired one
+    items = []
     for i, csv_path in enumerate(csv_paths):
-        save_rec_from_csv(img_paths[i], csv_path, lst_paths[i], height, width, resize_images)
+        image_paths, offsets, labels = build_label_table(img_paths[i], csv_path)
+        write_lst(lst_paths[i], image_paths, offsets, labels, height, width)
+        items.append(label_table_items(image_paths, offsets, labels, height, width))
 
     print("\n Successfully generated the train and val .lst files")
 
-    print("\n Generating the train record file. Please wait...")
-
     if not resize_images:
-        os.system('python im2rec.py ' + lst_train_path + ' . --pass-through --pack-label')
-        print("\n Successfully generated the record files for training")
-
-        print("\n Generating the validation record file. Please wait...")
-
-        os.system('python im2rec.py ' + lst_val_path + ' . --pass-through --pack-label')
-        print("\n Successfully generated the record files for validation")
+        args = im2rec.make_args('.', pass_through=True, pack_label=True)
     else:
-        os.system('python im2rec.py ' + lst_train_path + ' . --resize ' + str(width) + ' --pack-label')
-        print("\n Successfully generated the record files for training")
-
-        print("\n Generating the validation record file. Please wait...")
-
-        os.system('python im2rec.py ' + lst_val_path + ' . --resize ' + str(width) + ' --pack-label')
-        print("\n Successfully generated the record files for validation")
+        args = im2rec.make_args('.', resize=width, pack_label=True)
+
+    # the same worker pool encodes the train and the validation images
+    with im2rec.RecordBuilder(args, num_workers) as builder:
+        for name, lst_path, split_items in zip(['training', 'validation'], lst_paths, items):
+            print("\n Generating the {} record file. Please wait...".format(name))
+            if incremental:
+                # only the new or changed images are packed, into the .shards.json manifests
+                builder.write_incremental(split_items, os.path.splitext(lst_path)[0], strict=True)
+            elif num_shards > 0:
+                # set the record paths in config.json to the .shards.json manifests
+                builder.write_sharded(split_items, os.path.splitext(lst_path)[0], num_shards, strict=True)
+            else:
+                builder.write(split_items, os.path.splitext(lst_path)[0] + '.rec', strict=True)
+            print("\n Successfully generated the record files for {}".format(name))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
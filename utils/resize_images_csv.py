@@ -1,8 +1,12 @@
 import cv2
 import numpy as np
 import os
-import glob
-import pandas as pd
+import sys
+import multiprocessing
+import mxnet as mx
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..')))
+import utils.common as dataset_commons
+from utils.annotation_store import AnnotationStore, open_annotations
 
 '''
 This python script resizes the images pointed in a csv file and generates a new
@@ -12,6 +16,9 @@ This script does not take the config.json paths. Please configure in the main fu
 
 It will loop over the images, resizing it and showing it to you so you can verify
 if the bounding boxes are correct. Disable this function if you want to.
+
+The resized images can also be packed directly into a record file (record_path in
+the main function), without running prepare_dataset.py afterwards.
 '''
 
 def convert_image(image):
@@ -55,60 +62,131 @@ def convert_min_max_to_centroids(xmin, ymin, xmax, ymax):
     h = ymax - ymin # Set h
     return cx, cy, w, h
 
-def load_image(images_path, images_path_save, csv_path, target_res, show_images):
+def resize_bounding_boxes(targetSize, image_height, image_width, boxes):
+    '''
+    Vectorized version of the box scaling of resize_image_and_bounding_box
+
+    Arguments:
+        boxes (array): (N, 4) array of xmin, ymin, xmax, ymax
+
+    Returns:
+        array: (N, 4) int array with the resized boxes
+    '''
+    x_scale = targetSize[0] / image_width
+    y_scale = targetSize[1] / image_height
+    return np.round(np.asarray(boxes, dtype=float) * [x_scale, y_scale, x_scale, y_scale]).astype(int)
+
+def resize_image_file(task):
+    '''
+    Decodes an image once, resizes it with all its bounding boxes and encodes it.
+
+    Arguments:
+        task (tuple): image name, source path, save path (None to not save the image),
+            target resolution, (N, 4) boxes and whether to return the encoded image
+
+    Returns:
+        tuple: image name, resized boxes, new height, new width and the encoded image (or None)
+    '''
+    name, filename, save_path, target_res, boxes, return_encoded = task
+    img = cv2.imread(filename)
+    if img is None:
+        raise IOError('Could not read the image: {}'.format(filename))
+    height, width = img.shape[:2]
+    img = cv2.resize(img, target_res, interpolation = cv2.INTER_AREA)
+    boxes = resize_bounding_boxes(target_res, height, width, boxes)
+
+    ext = os.path.splitext(name)[1] or '.jpg'
+    encoded = cv2.imencode(ext, img)[1].tobytes()
+    if save_path is not None:
+        with open(save_path, 'wb') as f:
+            f.write(encoded)
+    return name, boxes, img.shape[0], img.shape[1], encoded if return_encoded else None
+
+def show_image(images_path_save, name, boxes):
+    '''
+    Shows a resized image with its bounding boxes. Returns False if ESC was pressed
+    '''
+    img = cv2.imread(images_path_save + name)
+    for xmin, ymin, xmax, ymax in boxes:
+        cv2.rectangle(img, (int(xmin), int(ymin)), (int(xmax), int(ymax)), (255, 0, 0), 1)
+    cv2.startWindowThread()
+    cv2.imshow('img', img)
+    a = cv2.waitKey(200) # close window when ESC is pressed
+    cv2.destroyWindow('img')
+    return a != 27
+
+def load_image(images_path, images_path_save, csv_path, target_res, show_images, num_workers=None,
+               record_path=None, classes=None):
     '''
     Load images from disk and save in a new size
 
+    Each image is decoded, resized and encoded once (whatever its number of bounding
+    boxes) by a process pool, and all its boxes are rescaled at once.
+
     Arguments:
         images_path (str): The absolute path of the images folder
-        images_path_save (str): The absolute path of the resized image folder
-        csv_path (str): The absolute path of the csv file
+        images_path_save (str): The absolute path of the resized image folder (None to
+            only write the record file)
+        csv_path (str): The absolute path of the csv file (or annotation store)
+        num_workers (int, default: None): number of processes. Defaults to the number of CPU
+            cores. 0 processes the images in this process (always the case when show_images is set)
+        record_path (str, default: None): if set, the resized images and their labels are also
+            packed into this .rec file (and the .idx file next to it), as prepare_dataset.py does
+        classes (dict, default: None): class ids of the labels for the record file. Defaults
+            to the classes of config.json. A ValueError is raised if a box has another label
     '''
 
-    train_samples = pd.read_csv(csv_path) # 'adversarial_dataset_converted.csv')
-    csv_list = []
-    for i, row in train_samples.iterrows():
-        # Reading data from the csv file
-        image_name_with_extension = row['image']
-        label = row['label']
-        xmin = row['xmin'] 
-        ymin = row['ymin'] 
-        xmax = row['xmax'] 
-        ymax = row['ymax']
-
-        print('File: ', image_name_with_extension)
-
-        filename = glob.glob(images_path + '/' + str(image_name_with_extension))[0]
-        img = cv2.imread(filename)
-        height = img.shape[0]
-        width = img.shape[1]
-
-        img, xmin, ymin, xmax, ymax = resize_image_and_bounding_box(target_res, img, height, width, xmin, ymin, xmax, ymax)
-
-        cv2.imwrite(images_path_save + image_name_with_extension, img) 
-        cv2.rectangle(img, (xmin, ymin), (xmax, ymax), (255, 0, 0), 1)
-        
-        if show_images:
-            cv2.startWindowThread()
-            cv2.imshow('img', img)
-            a = cv2.waitKey(200) # close window when ESC is pressed
-            if a == 27:
-                break
-            cv2.destroyWindow('img')
-
-        value = (image_name_with_extension,
-                 xmin,
-                 ymin,
-                 xmax,
-                 ymax,
-                 label,
-                 str(img.shape[0]),
-                 str(img.shape[1])
-                 )
-        csv_list.append(value)
-    
-    column_name = ['image', 'xmin', 'ymin', 'xmax', 'ymax', 'label', 'height', 'width']
-    csv_converter = pd.DataFrame(csv_list, columns=column_name)
+    if record_path is not None and classes is None:
+        classes = dataset_commons.get_dataset_files()['classes']
+    # the labels are checked against the classes only when the record file is written
+    annotations = open_annotations(csv_path, classes if record_path is not None else None) # 'adversarial_dataset_converted.csv')
+
+    tasks = []
+    for i, name in enumerate(annotations.names):
+        save_path = None if images_path_save is None else images_path_save + name
+        tasks.append((name, os.path.join(images_path, str(name)), save_path, target_res, annotations.image_boxes(i),
+                      record_path is not None))
+
+    record = None
+    if record_path is not None:
+        class_ids = annotations.label_ids(classes)
+        record = mx.recordio.MXIndexedRecordIO(os.path.splitext(record_path)[0] + '.idx', record_path, 'w')
+
+    if show_images or num_workers == 0:
+        pool = None
+        results = map(resize_image_file, tasks)
+    else:
+        pool = multiprocessing.Pool(num_workers)
+        results = pool.imap(resize_image_file, tasks, chunksize=4)
+
+    offsets = annotations.offsets
+    new_boxes = np.zeros((annotations.num_boxes, 4), dtype=np.float64)
+    new_sizes = np.full((len(annotations), 2), -1, dtype=np.int32)
+    try:
+        for idx, (name, resized_boxes, height, width, encoded) in enumerate(results):
+            print('File: ', name)
+            new_boxes[offsets[idx]:offsets[idx + 1]] = resized_boxes
+            new_sizes[idx] = (height, width)
+
+            if record is not None:
+                labels = np.hstack((class_ids[offsets[idx]:offsets[idx + 1]].reshape(-1, 1),
+                                    resized_boxes / [width, height, width, height]))
+                header = mx.recordio.IRHeader(0, [4, 5, width, height] + labels.flatten().tolist(), idx, 0)
+                record.write_idx(idx, mx.recordio.pack(header, encoded))
+
+            if show_images and images_path_save is not None:
+                if not show_image(images_path_save, name, resized_boxes):
+                    break
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if record is not None:
+            record.close()
+
+    resized = AnnotationStore(annotations.names, offsets, new_boxes, annotations.labels,
+                              annotations.label_names, new_sizes, rows=annotations.rows)
+    # without the images not processed (ESC pressed), in the row order of the csv file
+    csv_converter = resized.select(np.flatnonzero(new_sizes[:, 0] >= 0)).to_dataframe(row_order=True)
     return csv_converter    
 
 
@@ -138,7 +216,11 @@ def main():
     target_resolution = (300, 300)
     show_images = False
 
-    csv_converter = load_image(images_source_path, images_path_save, csv_path, target_resolution, show_images)
+    # TODO: Set a .rec file path to also pack the resized images into a record file
+    record_path = None
+
+    csv_converter = load_image(images_source_path, images_path_save, csv_path, target_resolution, show_images,
+                               record_path=record_path)
 
     csv_converter.to_csv(csv_path_save, index=None)
     print('Successfully converted to a new csv file.')
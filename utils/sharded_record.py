@@ -0,0 +1,76 @@
+import os
+import json
+import numpy as np
+from mxnet.gluon.data import Dataset
+from gluoncv import data as gdata
+
+'''
+Reads a set of .rec/.idx shards written by im2rec.py (--num-shards or
+RecordBuilder.write_sharded) as a single detection dataset.
+
+The shards are described by a <prefix>.shards.json manifest:
+    {"shards": [{"rec": "train-00000-of-00004.rec", "idx": "train-00000-of-00004.idx",
+                 "num_records": 1234}, ...],
+     "num_records": 4936}
+with the shard paths relative to the manifest folder.
+
+The record paths configured in config.json (record_train_path and
+record_val_path) can point either to a .rec file or to a manifest.
+'''
+
+MANIFEST_SUFFIX = '.shards.json'
+
+def is_manifest(path):
+    return path.endswith('.json')
+
+def load_manifest(path):
+    """Loads a shard manifest, with the shard paths relative to the current folder."""
+    with open(path) as f:
+        manifest = json.load(f)
+    folder = os.path.dirname(path)
+    for shard in manifest['shards']:
+        shard['rec'] = os.path.join(folder, shard['rec'])
+        shard['idx'] = os.path.join(folder, shard['idx'])
+    return manifest
+
+def record_files(path):
+    """Returns the files holding the content of a record dataset (.rec file or manifest)."""
+    if is_manifest(path):
+        files = [path]
+        for shard in load_manifest(path)['shards']:
+            files += [shard['rec'], shard['idx']]
+        return files
+    return [path, os.path.splitext(path)[0] + '.idx']
+
+class ShardedRecordFileDetection(Dataset):
+    """
+    Detection dataset made of the shards of a manifest, in the manifest order.
+    Each shard is read by a gluoncv RecordFileDetection, so the samples are the
+    same (image, label) pairs.
+
+    Arguments:
+        manifest_path (str): the .shards.json file path
+        coord_normalized (bool, default: True): whether the boxes are stored normalized
+    """
+    def __init__(self, manifest_path, coord_normalized=True):
+        manifest = load_manifest(manifest_path)
+        self._shards = [gdata.RecordFileDetection(shard['rec'], coord_normalized)
+                        for shard in manifest['shards']]
+        self._offsets = np.cumsum([0] + [len(shard) for shard in self._shards])
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('Index {} out of range for a dataset of size {}'.format(idx, len(self)))
+        shard = int(np.searchsorted(self._offsets, idx, side='right')) - 1
+        return self._shards[shard][idx - int(self._offsets[shard])]
+
+def open_record_dataset(path):
+    """Opens a .rec file or a shard manifest as a detection dataset."""
+    if is_manifest(path):
+        return ShardedRecordFileDetection(path)
+    return gdata.RecordFileDetection(path)
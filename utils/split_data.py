@@ -4,9 +4,11 @@ Code adapted from:
 https://github.com/yinguobing/tfrecord_utility
 """
 
+import os
 import numpy as np
 import pandas as pd
 import common as dataset_commons
+from annotation_store import open_annotations
 
 '''
 This script shuffle and split the data if needed.
@@ -19,85 +21,158 @@ Example:
 "csv_path" : "validacao_300_300/csv/val_dataset.csv"
 
 If you have different files for train and validation, change the path
-in each shuffle process.
+in each shuffle process. Without "csv_path", the csv_train file is used.
+
+The split is made per image, so all the objects of an image are in the same
+file, and stratified by class: each image is assigned to the class of its
+least frequent object and the images of each class are split with the given
+percentages. All the assignments are computed at once from the arrays of the
+annotation store. The same seed always gives the same files.
+k_fold_split writes k stratified train/validation pairs instead.
 '''
 
 
-def split_and_shuffle_dataset(train_percentage, val_percentage):
+def image_strata(annotations, classes):
     '''
-    Split and shuffle the dataset
+    Assigns each image to a class.
 
     Arguments:
-        train_percentage (float) : percentage of training data. Set this to 1.0 if you want just to
-            shuffle the training data separately
-        val_percentage (float) : percentage of floating data. . Set this to 1.0 if you want just to
-            shuffle the validation data separately
-    '''
-    np.random.seed(1)
-
-    data_common = dataset_commons.get_dataset_files()
+        annotations (AnnotationStore): the annotations
+        classes (dict): the classes of config.json. The boxes of the other labels are ignored
 
-    full_data = pd.read_csv(data_common['csv_path'])
-
-    full_train_csv = pd.DataFrame(columns=['image', 'xmin', 'ymin','xmax', 'ymax', 'label'])
-    full_validation_csv = pd.DataFrame(columns=['image', 'xmin', 'ymin','xmax', 'ymax', 'label'])
+    Returns:
+        tuple: the image index of each box (-1 for the ignored boxes) and the class
+            (stratum) of each image
+    '''
+    class_ids = annotations.label_ids(classes)
+    valid = class_ids >= 0
+    image_codes = np.where(valid, annotations.box_images(), -1)
+
+    # an image belongs to the class of its least frequent object. The images without
+    # any object of the classes get an extra stratum, their boxes are all ignored
+    class_count = np.bincount(class_ids[valid], minlength=max(classes.values()) + 1)
+    order = np.lexsort((class_count[class_ids[valid]], image_codes[valid]))
+    images = image_codes[valid][order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = images[1:] != images[:-1]
+    strata = np.full(len(annotations), len(class_count), dtype=np.int64)
+    strata[images[first]] = class_ids[valid][order][first]
+    return image_codes, strata
+
+def rank_in_strata(strata, random_state):
+    '''
+    Shuffles the images of each stratum.
 
-    classes = data_common['classes']
+    Returns:
+        tuple: the random rank of each image in its stratum and the size of its stratum
+    '''
+    order = np.lexsort((random_state.random_sample(len(strata)), strata))
+    sizes = np.bincount(strata)
+    starts = np.cumsum(sizes) - sizes
+    rank = np.empty(len(strata), dtype=np.int64)
+    rank[order] = np.arange(len(strata)) - starts[strata[order]]
+    return rank, sizes[strata]
+
+def assign_splits(annotations, classes, train_percentage, val_percentage, seed=1):
+    '''
+    Assigns the images to train, validation and test, stratified by class.
 
-    for key in classes:
-        print(key)
-        class_ = full_data.loc[full_data['label'] == key]
+    Returns:
+        np.ndarray: the split of each box: 0 train, 1 validation, 2 test and -1 for the
+            ignored boxes
+    '''
+    assert train_percentage + val_percentage <= 1.0 + 1e-9, "Not enough examples for your choice."
+    image_codes, strata = image_strata(annotations, classes)
+    rank, size = rank_in_strata(strata, np.random.RandomState(seed))
 
-        # number of ground truth images
-        total_file_number = len(class_)
+    num_train = (size * train_percentage).astype(np.int64)
+    num_validation = (size * val_percentage).astype(np.int64)
+    image_split = np.where(rank < num_train, 0, np.where(rank < num_train + num_validation, 1, 2))
+    return np.where(image_codes >= 0, image_split[image_codes], -1)
 
-        print("There are total {} examples in this dataset per class.".format(total_file_number))
-        class_.head()
+def assign_folds(annotations, classes, num_folds, seed=1):
+    '''
+    Assigns the images to num_folds folds, stratified by class.
 
-        # 80/20 train/validation
-        # Please keep the dataset balanced
-        num_train = int(total_file_number * train_percentage) 
-        num_validation = int(total_file_number * val_percentage) 
-        num_test = 0
+    Returns:
+        np.ndarray: the fold of each box (-1 for the ignored boxes)
+    '''
+    image_codes, strata = image_strata(annotations, classes)
+    rank, _ = rank_in_strata(strata, np.random.RandomState(seed))
+    # the fold of the first image of each class is random, so the small classes
+    # are not always in the first folds
+    offset = np.random.RandomState(seed).randint(num_folds, size=strata.max() + 1)
+    image_fold = (rank + offset[strata]) % num_folds
+    return np.where(image_codes >= 0, image_fold[image_codes], -1)
+
+def shuffle_rows(data, random_state):
+    return data.iloc[random_state.permutation(len(data))]
+
+def print_split(full_data, split, names):
+    # number of objects of each class in each split
+    print(pd.crosstab(full_data['label'][split >= 0], np.array(names)[split[split >= 0]], colnames=['split']))
+
+def split_and_shuffle_dataset(train_percentage, val_percentage, seed=1, csv_path=None):
+    '''
+    Split and shuffle the dataset
 
-        assert num_train + num_validation + num_test <= total_file_number, "Not enough examples for your choice."
-        print("Looks good! {} for train, {} for validation and {} for test.".format(num_train, num_validation, num_test))
+    Arguments:
+        train_percentage (float) : percentage of training data. Set this to 1.0 if you want just to
+            shuffle the training data separately
+        val_percentage (float) : percentage of floating data. . Set this to 1.0 if you want just to
+            shuffle the validation data separately
+        seed (int, default: 1): seed of the split and of the shuffle
+        csv_path (str, default: None): csv file or annotation store to split. Defaults to the csv_path of config.json
+    '''
+    data_common = dataset_commons.get_dataset_files()
 
-        # Choose x numbers considering the number of the total files
-        index_train = np.random.choice(total_file_number, size=num_train, replace=False)
-        # Find the set difference of two arrays. It avoid to choose the same data for train and validation
-        index_validation_test = np.setdiff1d(list(range(total_file_number)), index_train)
-        # Choose \x number considering the numbers present in index_validation_test
-        index_validation = np.random.choice(index_validation_test, size=num_validation, replace=False)
+    annotations = open_annotations(csv_path or data_common['csv_path'])
+    full_data = annotations.to_dataframe()
+    print("There are total {} examples of {} images in this dataset.".format(annotations.num_boxes, len(annotations)))
 
-        if train_percentage:
-            train = class_.iloc[index_train]
-            full_train_csv = full_train_csv.append(train)
-        
-        if val_percentage:
-            validation = class_.iloc[index_validation]
-            full_validation_csv = full_validation_csv.append(validation)
+    split = assign_splits(annotations, data_common['classes'], train_percentage, val_percentage, seed)
+    print_split(full_data, split, ['train', 'validation', 'test'])
 
+    random_state = np.random.RandomState(seed)
     if train_percentage:
         # Shuffle the full train file
-        train_total_file_number = len(full_train_csv)
-        # Choose x numbers considering the number of the total files
-        index_train = np.random.choice(train_total_file_number, size=train_total_file_number, replace=False)
-        full_train_csv = full_train_csv.iloc[index_train]
+        full_train_csv = shuffle_rows(full_data[split == 0], random_state)
         full_train_csv.to_csv(data_common['csv_train'], index=None)
 
     if val_percentage:
         # Shuffle the full validation file
-        validation_total_file_number = len(full_validation_csv)
-        # Choose x numbers considering the number of the total files
-        index_validation = np.random.choice(validation_total_file_number, size=validation_total_file_number, replace=False)
-        full_validation_csv = full_validation_csv.iloc[index_validation]
+        full_validation_csv = shuffle_rows(full_data[split == 1], random_state)
         full_validation_csv.to_csv(data_common['csv_validation'], index=None)
 
-    # if num_test:
-    #     index_test = np.setdiff1d(index_validation_test, index_validation)
-    #     test = class_.iloc[index_test]
-    #     test.to_csv(data_common['csv_test'], index=None)
+    print("All done!")
+
+def k_fold_split(num_folds, seed=1, csv_path=None, output_folder=None):
+    '''
+    Writes num_folds train/validation csv files pairs: fold_<i>_train.csv and fold_<i>_val.csv,
+    with the images of the fold i for validation and the other ones for training.
+
+    Arguments:
+        num_folds (int): number of folds
+        seed (int, default: 1): seed of the split and of the shuffle
+        csv_path (str, default: None): csv file or annotation store to split. Defaults to the csv_path of config.json
+        output_folder (str, default: None): folder of the csv files. Defaults to the folder of
+            the csv_train file
+    '''
+    data_common = dataset_commons.get_dataset_files()
+    if output_folder is None:
+        output_folder = os.path.dirname(data_common['csv_train'])
+
+    annotations = open_annotations(csv_path or data_common['csv_path'])
+    full_data = annotations.to_dataframe()
+    fold = assign_folds(annotations, data_common['classes'], num_folds, seed)
+    print_split(full_data, fold, ['fold {}'.format(i) for i in range(num_folds)])
+
+    random_state = np.random.RandomState(seed)
+    for i in range(num_folds):
+        train = shuffle_rows(full_data[(fold >= 0) & (fold != i)], random_state)
+        validation = shuffle_rows(full_data[fold == i], random_state)
+        train.to_csv(os.path.join(output_folder, 'fold_{}_train.csv'.format(i)), index=None)
+        validation.to_csv(os.path.join(output_folder, 'fold_{}_val.csv'.format(i)), index=None)
 
     print("All done!")
 
@@ -13,12 +13,14 @@ class SSDCustomValTransform(object):
 
     def __init__(self, width, height, anchors=None, mean=(0.485, 0.456, 0.406),
                  std=(0.229, 0.224, 0.225), iou_thresh=0.5, box_norm=(0.1, 0.1, 0.2, 0.2),
-                 **kwargs):
+                 return_label=False, **kwargs):
         self._width = width
         self._height = height
         self._anchors = anchors
         self._mean = mean
         self._std = std
+        # also return the resized label, for the validation metrics
+        self._return_label = return_label
         if anchors is None:
             return
 
@@ -46,4 +48,6 @@ class SSDCustomValTransform(object):
         gt_ids = mx.nd.array(bbox[np.newaxis, :, 4:5])
         cls_targets, box_targets, _ = self._target_generator(
             self._anchors, None, gt_bboxes, gt_ids)
+        if self._return_label:
+            return img, bbox.astype(img.dtype), cls_targets[0], box_targets[0]
         return img, cls_targets[0], box_targets[0]
\ No newline at end of file
@@ -0,0 +1,163 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+import mxnet as mx
+from mxnet import gluon
+from mxnet.gluon.data import Dataset
+from gluoncv.data.batchify import Tuple, Stack
+from utils.ssd_custom_val_transform import SSDCustomValTransform
+from utils.detection_cache import file_digest
+from utils.sharded_record import record_files
+
+'''
+Cache of the SSD training targets of a dataset without augmentation.
+
+SSDCustomValTransform matches the boxes of every sample with the anchors
+(SSDTargetGenerator) each time it is loaded. Without random augmentation the
+resized boxes, and so the targets, are the same every epoch: they are computed
+once and saved as two .npy files memory-mapped by the data loader:
+    <key>.cls.npy  (N, num_anchors) int16 class targets (0 for the background)
+    <key>.box.npy  (N, num_anchors, 4) float32 box targets
+The key is a hash of the record files content, the input size, the anchors and
+the target generator settings, so the files are computed again when any of
+them changes.
+
+CachedTargetDataset still decodes and normalizes the images, only the target
+generation is skipped. For the validation set, MappedValidationSet.with_targets
+(utils/validation_cache.py) also serves the images from a cache.
+'''
+
+def target_cache_key(record_path, width, height, anchors, iou_thresh=0.5, box_norm=(0.1, 0.1, 0.2, 0.2)):
+    """
+    Builds the cache key of the targets of a record file.
+
+    Arguments:
+        record_path (str): the .rec file path or shard manifest
+        width (int), height (int): the network input size
+        anchors (NDArray): the network anchors
+        iou_thresh (float, default: 0.5): iou threshold of the target generator
+        box_norm (tuple, default: (0.1, 0.1, 0.2, 0.2)): box target normalization
+    """
+    parts = [file_digest(path) for path in record_files(record_path)]
+    parts += [str(int(width)), str(int(height)), hashlib.sha1(anchors.asnumpy().tobytes()).hexdigest(),
+              repr(float(iou_thresh)), repr(tuple(float(x) for x in box_norm))]
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+def compute_targets(dataset, width, height, anchors, cls_path, box_path, batch_size=32, num_workers=0, **kwargs):
+    """
+    Generates the targets of all the samples of a dataset and writes them into the .npy
+    files cls_path and box_path (written atomically).
+
+    Arguments:
+        dataset (Dataset): detection dataset returning (image, label)
+        width (int), height (int): the network input size
+        anchors (NDArray): the network anchors
+        batch_size (int, default: 32): loader batch size
+        num_workers (int, default: 0): loader workers
+        kwargs: SSDCustomValTransform target generator settings
+    """
+    transform = SSDCustomValTransform(width, height, anchors, **kwargs)
+    loader = gluon.data.DataLoader(dataset.transform(transform), batch_size, False,
+                                   batchify_fn=Tuple(Stack(), Stack(), Stack()),
+                                   last_batch='keep', num_workers=num_workers)
+    num_anchors = anchors.reshape((-1, 4)).shape[0]
+
+    folder = os.path.dirname(cls_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    # unique temporary files, so the processes computing the same targets do not overwrite each other
+    tmp_paths = []
+    for path in (cls_path, box_path):
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(path) + '.', dir=folder or None)
+        os.close(fd)
+        tmp_paths.append(tmp_path)
+    cls_tmp, box_tmp = tmp_paths
+    try:
+        cls_targets = np.lib.format.open_memmap(cls_tmp, mode='w+', dtype=np.int16, shape=(len(dataset), num_anchors))
+        box_targets = np.lib.format.open_memmap(box_tmp, mode='w+', dtype=np.float32,
+                                                shape=(len(dataset), num_anchors, 4))
+        start = 0
+        for _, cls_batch, box_batch in loader:
+            end = start + cls_batch.shape[0]
+            cls_targets[start:end] = cls_batch.asnumpy()
+            box_targets[start:end] = box_batch.asnumpy()
+            start = end
+        cls_targets.flush()
+        box_targets.flush()
+        del cls_targets, box_targets
+        os.replace(cls_tmp, cls_path)
+        os.replace(box_tmp, box_path)
+    finally:
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+class CachedTargetDataset(Dataset):
+    """
+    Detection dataset returning (image, cls_targets, box_targets) like
+    dataset.transform(SSDCustomValTransform(width, height, anchors)), with the targets
+    read from the cache files.
+
+    Arguments:
+        dataset (Dataset): detection dataset returning (image, label)
+        width (int), height (int): the network input size
+        cls_path (str), box_path (str): the target files written by compute_targets
+    """
+    def __init__(self, dataset, width, height, cls_path, box_path):
+        self._dataset = dataset
+        self._transform = SSDCustomValTransform(width, height)
+        self._cls_path = cls_path
+        self._box_path = box_path
+        # opened in each loader worker
+        self._cls_targets = None
+        self._box_targets = None
+
+    def __len__(self):
+        return len(self._dataset)
+
+    def __getitem__(self, idx):
+        if self._cls_targets is None:
+            self._cls_targets = np.load(self._cls_path, mmap_mode='r')
+            self._box_targets = np.load(self._box_path, mmap_mode='r')
+        img, _ = self._transform(*self._dataset[idx])
+        return (img, mx.nd.array(self._cls_targets[idx], dtype='float32'),
+                mx.nd.array(self._box_targets[idx], dtype='float32'))
+
+    def __getstate__(self):
+        # the memory maps are not sent to the loader workers
+        state = self.__dict__.copy()
+        state['_cls_targets'] = None
+        state['_box_targets'] = None
+        return state
+
+def target_files(dataset, record_path, width, height, anchors, cache_folder, num_workers=0, **kwargs):
+    """
+    Returns the cls and box target files of a record file, computing them first if they
+    are not in the cache folder yet.
+
+    Arguments:
+        dataset (Dataset): the dataset of the record file
+        record_path (str): the .rec file path or shard manifest
+        width (int), height (int): the network input size
+        anchors (NDArray): the network anchors
+        cache_folder (str): folder of the target files
+        num_workers (int, default: 0): loader workers used to compute the targets
+        kwargs: SSDCustomValTransform target generator settings (iou_thresh and box_norm)
+    """
+    key = target_cache_key(record_path, width, height, anchors, kwargs.get('iou_thresh', 0.5),
+                           kwargs.get('box_norm', (0.1, 0.1, 0.2, 0.2)))
+    cls_path = os.path.join(cache_folder, key + '.cls.npy')
+    box_path = os.path.join(cache_folder, key + '.box.npy')
+    if os.path.exists(cls_path) and os.path.exists(box_path):
+        print('Loading the cached targets of {}'.format(record_path))
+    else:
+        print('Computing the targets of {}. Please wait...'.format(record_path))
+        compute_targets(dataset, width, height, anchors, cls_path, box_path, num_workers=num_workers, **kwargs)
+    return cls_path, box_path
+
+def cached_target_dataset(dataset, record_path, width, height, anchors, cache_folder, num_workers=0, **kwargs):
+    """Returns a CachedTargetDataset of a record file. See target_files."""
+    cls_path, box_path = target_files(dataset, record_path, width, height, anchors, cache_folder,
+                                      num_workers, **kwargs)
+    return CachedTargetDataset(dataset, width, height, cls_path, box_path)
@@ -0,0 +1,249 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+import mxnet as mx
+from mxnet import gluon
+from gluoncv.data.batchify import Stack
+import gluoncv.data.transforms.bbox as tbbox
+import gluoncv.data.transforms.image as timage
+from utils.detection_cache import file_digest
+from utils.sharded_record import record_files
+
+'''
+Caches of the transformed validation batches.
+
+The validation transform is deterministic, so the .rec file only needs to be
+decoded and transformed once.
+
+CachedValidationSet keeps the batches of a DataLoader in memory after its first
+iteration, for the checkpoints evaluated in the same process.
+
+MappedValidationSet materializes the transformed validation set once into .npy
+files memory-mapped in the following runs and epochs:
+    <key>.images.npy  (N, H, W, 3) uint8 resized images, normalized when the batches
+                      are served (exactly the SSDDefaultValTransform and
+                      YOLO3DefaultValTransform output), or (N, 3, H, W) float16
+                      normalized images
+    <key>.labels.npy  (N, M, K) float32 resized labels padded with -1
+    <key>.counts.npy  (N,) number of labels of each image
+The batches are sliced from the arrays, so no image is decoded after the first
+pass. The key is a hash of the record files content, the input size, the
+storage type and the normalization.
+'''
+
+class CachedValidationSet(object):
+    """
+    Wraps a validation DataLoader and keeps its batches in memory after the first pass.
+    It can be used everywhere the validation loader is iterated.
+
+    Arguments:
+        loader (DataLoader): validation loader returning (image, padded label) batches
+    """
+    def __init__(self, loader):
+        self._loader = loader
+        self._batches = None
+
+    def __iter__(self):
+        if self._batches is None:
+            # copy out of the worker shared memory so the batches outlive the loader workers
+            self._batches = [[x.as_in_context(mx.cpu()) for x in batch] for batch in self._loader]
+        return iter(self._batches)
+
+    def __len__(self):
+        return len(self._loader)
+
+class ValResizeTransform(object):
+    """
+    The resize of SSDDefaultValTransform and YOLO3DefaultValTransform, without the
+    conversion to a normalized tensor. Returns the uint8 image and the resized label.
+    """
+    def __init__(self, width, height):
+        self._width = width
+        self._height = height
+
+    def __call__(self, src, label):
+        h, w, _ = src.shape
+        img = timage.imresize(src, self._width, self._height, interp=9)
+        bbox = tbbox.resize(label, in_size=(w, h), out_size=(self._width, self._height))
+        return img, bbox.astype('float32')
+
+class ValNormalizeTransform(ValResizeTransform):
+    """Same output as SSDDefaultValTransform."""
+    def __init__(self, width, height, mean, std):
+        super(ValNormalizeTransform, self).__init__(width, height)
+        self._mean = mean
+        self._std = std
+
+    def __call__(self, src, label):
+        img, bbox = super(ValNormalizeTransform, self).__call__(src, label)
+        img = mx.nd.image.normalize(mx.nd.image.to_tensor(img), mean=self._mean, std=self._std)
+        return img, bbox
+
+def stack_images(samples):
+    """Stacks the images of a batch and keeps the labels as a list."""
+    return Stack()([sample[0] for sample in samples]), [sample[1] for sample in samples]
+
+def validation_cache_key(record_path, width, height, dtype, mean, std):
+    parts = [file_digest(path) for path in record_files(record_path)]
+    parts += [str(int(width)), str(int(height)), dtype, repr(tuple(mean)), repr(tuple(std))]
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+class MappedValidationSet(object):
+    """
+    Validation set materialized into memory-mapped arrays. It is iterated like the
+    validation DataLoader, returning [image, padded label] batches, and can be shared by
+    several detectors with the same input size.
+
+    The arrays are written by the first iteration (or loaded if they are already in the
+    cache folder).
+
+    Arguments:
+        dataset (Dataset): the validation dataset returning (image, label)
+        record_path (str): the .rec file path or shard manifest of the dataset
+        width (int), height (int): the network input size
+        batch_size (int): batch size
+        cache_folder (str): folder of the cached arrays
+        dtype (str, default: 'uint8'): 'uint8' to store the resized images or 'float16' to
+            store the normalized images
+        num_workers (int, default: 0): loader workers used to build the cache
+        mean (tuple), std (tuple): normalization of the images
+    """
+    def __init__(self, dataset, record_path, width, height, batch_size, cache_folder, dtype='uint8',
+                 num_workers=0, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        if dtype not in ('uint8', 'float16'):
+            raise ValueError('Invalid validation cache type: {}'.format(dtype))
+        self._dataset = dataset
+        self._record_path = record_path
+        self._width = width
+        self._height = height
+        self._batch_size = batch_size
+        self._cache_folder = cache_folder
+        self._dtype = dtype
+        self._num_workers = num_workers
+        self._mean = mean
+        self._std = std
+        self._arrays = None
+
+    def __len__(self):
+        return (len(self._dataset) + self._batch_size - 1) // self._batch_size
+
+    def _paths(self):
+        key = validation_cache_key(self._record_path, self._width, self._height, self._dtype, self._mean, self._std)
+        prefix = os.path.join(self._cache_folder, key)
+        return [prefix + suffix for suffix in ('.images.npy', '.labels.npy', '.counts.npy')]
+
+    def _build(self, images_path, labels_path, counts_path):
+        if len(self._dataset) == 0:
+            raise ValueError('The validation set {} is empty'.format(self._record_path))
+        if self._dtype == 'uint8':
+            transform = ValResizeTransform(self._width, self._height)
+        else:
+            transform = ValNormalizeTransform(self._width, self._height, self._mean, self._std)
+        loader = gluon.data.DataLoader(self._dataset.transform(transform), self._batch_size, False,
+                                       batchify_fn=stack_images, last_batch='keep', num_workers=self._num_workers)
+        if not os.path.exists(self._cache_folder):
+            os.makedirs(self._cache_folder)
+
+        # unique temporary files, so the processes building the same cache do not overwrite each other
+        tmp_paths = []
+        for path in (images_path, labels_path, counts_path):
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(path) + '.', dir=self._cache_folder)
+            os.close(fd)
+            tmp_paths.append(tmp_path)
+        images_tmp, labels_tmp, counts_tmp = tmp_paths
+        try:
+            images, labels = None, []
+            start = 0
+            for image_batch, label_batch in loader:
+                image_batch = image_batch.asnumpy()
+                if images is None:
+                    images = np.lib.format.open_memmap(images_tmp, mode='w+', dtype=self._dtype,
+                                                       shape=(len(self._dataset),) + image_batch.shape[1:])
+                images[start:start + len(image_batch)] = image_batch
+                start += len(image_batch)
+                labels.extend(np.asarray(label, dtype=np.float32) for label in label_batch)
+            images.flush()
+            del images
+
+            counts = np.array([len(label) for label in labels], dtype=np.int64)
+            padded = np.full((len(labels), max(1, counts.max()), labels[0].shape[1]), -1, dtype=np.float32)
+            for i, label in enumerate(labels):
+                padded[i, :len(label)] = label
+            with open(labels_tmp, 'wb') as f:
+                np.save(f, padded)
+            with open(counts_tmp, 'wb') as f:
+                np.save(f, counts)
+            # the images last: _load only reads the cache when the images file exists
+            os.replace(labels_tmp, labels_path)
+            os.replace(counts_tmp, counts_path)
+            os.replace(images_tmp, images_path)
+        finally:
+            for tmp_path in tmp_paths:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def _load(self):
+        if self._arrays is None:
+            paths = self._paths()
+            if all(os.path.exists(path) for path in paths):
+                print('Loading the cached validation set of {}'.format(self._record_path))
+            else:
+                print('Caching the validation set of {}. Please wait...'.format(self._record_path))
+                self._build(*paths)
+            self._arrays = [np.load(path, mmap_mode='r') for path in paths]
+        return self._arrays
+
+    def __getstate__(self):
+        # the memory maps are opened again by each process
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def images(self, start, end):
+        """Normalized (B, 3, H, W) float32 images of a batch."""
+        images = self._load()[0][start:end]
+        if self._dtype == 'uint8':
+            batch = mx.nd.image.to_tensor(mx.nd.array(images, dtype='uint8'))
+            return mx.nd.image.normalize(batch, mean=self._mean, std=self._std)
+        return mx.nd.array(images, dtype='float32')
+
+    def labels(self, start, end):
+        """Labels of a batch padded with -1, as the Pad batchify function does."""
+        _, labels, counts = self._load()
+        return mx.nd.array(labels[start:end, :max(1, counts[start:end].max())], dtype='float32')
+
+    def batch_ranges(self):
+        size = len(self._dataset)
+        return [(start, min(start + self._batch_size, size)) for start in range(0, size, self._batch_size)]
+
+    def __iter__(self):
+        for start, end in self.batch_ranges():
+            yield [self.images(start, end), self.labels(start, end)]
+
+    def with_targets(self, cls_path, box_path, with_labels=False):
+        """
+        Returns the same batches with the SSD targets read from the files of
+        utils.ssd_target_cache: [image, cls_targets, box_targets], or
+        [image, padded label, cls_targets, box_targets] with with_labels.
+        """
+        return MappedTargetSet(self, cls_path, box_path, with_labels)
+
+class MappedTargetSet(object):
+    """Batches of a MappedValidationSet with their cached SSD targets."""
+    def __init__(self, images, cls_path, box_path, with_labels=False):
+        self._images = images
+        self._cls_targets = np.load(cls_path, mmap_mode='r')
+        self._box_targets = np.load(box_path, mmap_mode='r')
+        self._with_labels = with_labels
+
+    def __len__(self):
+        return len(self._images)
+
+    def __iter__(self):
+        for start, end in self._images.batch_ranges():
+            batch = [self._images.images(start, end)]
+            if self._with_labels:
+                batch.append(self._images.labels(start, end))
+            yield batch + [mx.nd.array(self._cls_targets[start:end], dtype='float32'),
+                           mx.nd.array(self._box_targets[start:end], dtype='float32')]
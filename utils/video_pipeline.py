@@ -0,0 +1,206 @@
+import time
+import threading
+import collections
+
+'''
+Threaded producer/consumer pipeline for live video inference.
+
+Capture, pre-processing and inference run in their own threads and are linked
+by small bounded queues. When a downstream stage is slower, the oldest item of
+its input queue is dropped (if drop_frames is set), so the displayed frames stay
+close to real time and the throughput is given by the slowest stage instead of
+the sum of all of them. The last stage (e.g. rendering with OpenCV, which must
+run in the main thread) consumes the pipeline by iterating over it.
+
+Per-stage latency and FPS counters are available in pipeline.stats.
+
+If the source or a stage raises, the pipeline is stopped and the first
+exception is raised again by the consumer loop.
+'''
+
+class StageStats(object):
+    """Latency and throughput counters of a pipeline stage."""
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.dropped = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+        self.start_time = None
+        self._lock = threading.Lock()
+
+    def update(self, latency):
+        with self._lock:
+            if self.start_time is None:
+                self.start_time = time.time() - latency
+            self.count += 1
+            self.total_latency += latency
+            self.last_latency = latency
+
+    def drop(self):
+        with self._lock:
+            self.dropped += 1
+
+    @property
+    def mean_latency(self):
+        return self.total_latency / self.count if self.count else 0.0
+
+    @property
+    def fps(self):
+        if not self.count:
+            return 0.0
+        return self.count / max(time.time() - self.start_time, 1e-6)
+
+    def __repr__(self):
+        return '{}: {:.1f} FPS | latency {:.1f} ms (mean {:.1f} ms) | dropped {}'.format(
+            self.name, self.fps, self.last_latency * 1000, self.mean_latency * 1000, self.dropped)
+
+class BoundedQueue(object):
+    """
+    Bounded FIFO queue. When it is full, put() either drops the oldest item
+    (drop_oldest=True) or blocks until there is room.
+    """
+    def __init__(self, maxsize, drop_oldest=True, stats=None):
+        self._items = collections.deque()
+        self._maxsize = maxsize
+        self._drop_oldest = drop_oldest
+        self._stats = stats
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def put(self, item):
+        with self._cond:
+            while len(self._items) >= self._maxsize and not self._closed:
+                if self._drop_oldest:
+                    self._items.popleft()
+                    if self._stats is not None:
+                        self._stats.drop()
+                else:
+                    self._cond.wait()
+            if self._closed:
+                return
+            self._items.append(item)
+            self._cond.notify_all()
+
+    def get(self):
+        """Returns the next item or None if the queue was closed and is empty."""
+        with self._cond:
+            while not self._items and not self._closed:
+                self._cond.wait()
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._items)
+
+class StreamingPipeline(object):
+    """
+    Runs a source and a chain of stages in background threads.
+
+    Arguments:
+        source (function): returns the next item or None when the stream has ended
+        stages (list): list of (name, function) tuples. Each function maps an item to the
+            next one; returning None skips the item
+        queue_size (int, default: 2): size of the queue in front of each stage and of the output
+        drop_frames (bool, default: True): drop the oldest queued item when a stage is slower
+            than the previous one, otherwise block the previous stage (no frame is lost)
+    """
+    def __init__(self, source, stages, queue_size=2, drop_frames=True):
+        self.stats = collections.OrderedDict()
+        self.stats['capture'] = StageStats('capture')
+        for name, _ in stages:
+            self.stats[name] = StageStats(name)
+
+        self._source = source
+        self._stages = stages
+        names = [name for name, _ in stages] + ['output']
+        self._queues = [BoundedQueue(queue_size, drop_frames, self.stats.get(name)) for name in names]
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._error = None
+        self._error_lock = threading.Lock()
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._run_source)]
+        for i, (name, function) in enumerate(self._stages):
+            self._threads.append(threading.Thread(target=self._run_stage,
+                                                  args=(name, function, self._queues[i], self._queues[i + 1])))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        for q in self._queues:
+            q.close()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _fail(self, error):
+        # keeps the first exception and stops every stage
+        with self._error_lock:
+            if self._error is None:
+                self._error = error
+        self.stop()
+
+    def _run_source(self):
+        stats = self.stats['capture']
+        out_queue = self._queues[0]
+        try:
+            while not self._stop_event.is_set():
+                tic = time.time()
+                item = self._source()
+                if item is None:
+                    break
+                stats.update(time.time() - tic)
+                out_queue.put(item)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            out_queue.close()
+
+    def _run_stage(self, name, function, in_queue, out_queue):
+        stats = self.stats[name]
+        try:
+            while not self._stop_event.is_set():
+                item = in_queue.get()
+                if item is None:
+                    break
+                tic = time.time()
+                item = function(item)
+                stats.update(time.time() - tic)
+                if item is not None:
+                    out_queue.put(item)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            out_queue.close()
+
+    def __iter__(self):
+        """
+        Yields the output of the last stage until the stream ends or stop() is called.
+        An exception raised by the source or a stage is raised again here.
+        """
+        out_queue = self._queues[-1]
+        while True:
+            item = out_queue.get()
+            if item is None:
+                break
+            yield item
+        if self._error is not None:
+            raise self._error
+
+    def summary(self):
+        return '\n'.join(repr(stats) for stats in self.stats.values())
@@ -1,9 +1,8 @@
 import cv2
 import numpy as np
 import os
-import glob
-import pandas as pd
 import common as dataset_commons
+from annotation_store import open_annotations
 
 '''
 This code only gives you a tool to visualize 
@@ -14,27 +13,13 @@ dir_files = dataset_commons.get_dataset_files()
 def load_images_from_csv(images_path, csv_path):
     images_path = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', images_path))
     csv_path = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', csv_path))
-    train_samples = pd.read_csv(csv_path)
-    csv_list = []
+    annotations = open_annotations(csv_path, sort=True)
 
-    train_samples = train_samples.groupby('image')
+    for idx in range(len(annotations)):
+        image_name_with_extension, all_boxes, labels = annotations[idx]
+        all_class_names = [annotations.label_names[label] for label in labels]
 
-    for name, group in train_samples:
-        all_boxes, all_class_names, all_images_paths = [], [], []
-        for i, row in group.iterrows():
-            image_name_with_extension = row['image']
-            label = row['label']
-            xmin = row['xmin'] 
-            ymin = row['ymin'] 
-            xmax = row['xmax'] 
-            ymax = row['ymax']
-
-            img_path = os.path.join(images_path, image_name_with_extension)  
-            all_images_paths.append(img_path)
-            all_boxes.append([xmin, ymin, xmax, ymax])
-            all_class_names.extend([label])   
-
-        filename = glob.glob(images_path + "/" + image_name_with_extension)[0]
+        filename = os.path.join(images_path, image_name_with_extension)
         print("Filename: ", filename)
         print("Bbs: ", len(all_boxes))
         img = cv2.imread(filename)
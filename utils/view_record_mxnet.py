@@ -1,7 +1,7 @@
-from gluoncv.data import recordio
 import numpy as np
 import cv2
 import common as dataset_commons
+from sharded_record import open_record_dataset
 
 data_common = dataset_commons.get_dataset_files()
 record_train_path = data_common['record_train_path']
@@ -13,9 +13,9 @@ def check_record_file(record_path):
     This function plots the image recorded in a .record file
 
     Arguments:
-        record_path (str): the relative path of the project root folder
+        record_path (str): the relative path of the project root folder (.rec file or .shards.json manifest)
     '''
-    record_file = recordio.detection.RecordFileDetection(record_path)
+    record_file = open_record_dataset(record_path)
     for img, labels in record_file: 
         print('Labels: ', len(labels))
         for label in labels: